@@ -2,6 +2,8 @@ from gwtm_cron import gwtm_listener
 
 if __name__ == "__main__":
     l = gwtm_listener.listener.Listener(listener_type="LIGO_ALERT", config_path="/home/azureuser/cron/listener_config.json")
-    l.run(write_to_s3=True, verbose=True, dry_run=False)
+    #imports, galaxy catalog, ephemeris caches and clients, while the consumer starts
+    l.warmup(background=True)
+    l.run(write_to_s3=True, verbose=True, dry_run=False, pipeline=True)
 
 
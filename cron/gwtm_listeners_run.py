@@ -0,0 +1,8 @@
+from gwtm_cron import gwtm_listener
+
+if __name__ == "__main__":
+    #LIGO alerts and IceCube notices on one consumer, in one process
+    l = gwtm_listener.listener.Listener(listener_type="ALL", config_path="/home/azureuser/cron/listener_config.json")
+    #imports, galaxy catalog, ephemeris caches and clients, while the consumer starts
+    l.warmup(background=True)
+    l.run(write_to_s3=True, verbose=True, dry_run=False, pipeline=True)
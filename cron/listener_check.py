@@ -22,15 +22,12 @@ if __name__ == '__main__':
 
     home_path   = "/home/azureuser"
     python_path = f"{home_path}/anaconda3/envs/gwtm_listener/bin/python"
+    #gwtm_listeners_run.py runs the alert and icecube listeners in one process,
+    #gwtm_listener_run.py and gwtm_icecube_run.py still run them one per process
     scripts = [
         {
-            "name"     : "alert_listener",
-            "script"   : f"{home_path}/git-clones/gwtm_cron/cron/gwtm_listener_run.py",
-            "log_file" : f"{home_path}/cron/listener.log"
-        }, 
-        {
-            "name"     : "icecube_listener",
-            "script"   : f"{home_path}/git-clones/gwtm_cron/cron/gwtm_icecube_run.py",
+            "name"     : "alert_and_icecube_listener",
+            "script"   : f"{home_path}/git-clones/gwtm_cron/cron/gwtm_listeners_run.py",
             "log_file" : f"{home_path}/cron/listener.log"
         },
     ]
@@ -1,8 +1,29 @@
+import os
+import json
+import threading
 import healpy as hp #  type: ignore[import]
 import numpy as np
 from astropy.table import Table #  type: ignore[import]
 from configparser import ConfigParser
-from scipy.stats import norm #  type: ignore[import]
+
+try:
+    from . import gw_skymap
+    from . import gw_warmup
+except ImportError:
+    import gw_skymap # type: ignore
+    import gw_warmup # type: ignore
+
+
+#raw catalog columns carried into the compiled catalog, and the columns derived from them
+CATALOG_COLUMNS = ['objname', 'ra', 'dec', 'DistMpc', 'Mstar']
+DERIVED_COLUMNS = ['theta', 'phi', 'log10dist']
+COMPILED_CATALOG_VERSION = 2
+
+#nested order of the catalog pixel index (nside 4096, ~0.86 arcmin pixels), at most 14 so pixels fit in 32 bits
+INDEX_ORDER = 12
+
+_catalog_cache: dict = {}
+_catalog_lock = threading.Lock()
 
 
 #defines EventLocalization class to match formatting of tom toolkit model, input into generate_galaxy_list
@@ -18,195 +39,520 @@ class EventLocalization(object):
         return self.graceid
 
 
+class GalaxyCatalog(object):
+    '''
+        Column arrays of the filtered galaxy catalog (no NaN Mstar, DistMpc > 0)
+        plus the derived columns used by the ranking:
+            theta, phi : healpy colatitude/longitude in radians
+            log10dist  : log10 of the distance in units of 10pc (DistMpc*10**5)
+    '''
+    def __init__(self, columns: dict, path=None, memmapped=False, index=None):
+        self.columns = columns
+        self.path = path
+        self.memmapped = memmapped
+        self._index = index
+        self._index_lock = threading.Lock()
 
-def generate_galaxy_list(eventlocalization: EventLocalization, galaxy_config_path: str, completeness=None, credzone=None, skymap_filepath=None):
-    """
-    An adaptation of the galaxy ranking algorithm described in
-    Arcavi et al. 2017 (doi:10.3847/2041-8213/aa910f)
-    
-    eventlocalization: an EventLocalization object (is still true, no longer tom toolkit model)
-    """
+    def __getitem__(self, key):
+        return self.columns[key]
 
-    # Parameters:
-    try:
-        galaxy_config = ConfigParser(inline_comment_prefixes=';')
-        galaxy_config.read(galaxy_config_path)
-        catalog_path = galaxy_config.get('GALAXIES', 'CATALOG_PATH') # Path to numpy file containing the galaxy catalog (faster than getting from the db)
-    except Exception as e:
-        print(e)
-    # Matching parameters:
-    if not credzone:
-        credzone = float(galaxy_config.get('GALAXIES', 'CREDZONE')) # Localization probability to consider credible (e.g. 0.99)
+    def __len__(self):
+        return len(self.columns['objname'])
+
+    def __str__(self):
+        return '{} ({} galaxies{})'.format(self.path, len(self), ', memory-mapped' if self.memmapped else '')
+
+    @property
+    def index(self):
+        '''
+            The GalaxyIndex over this catalog, built on first use if it was not compiled
+        '''
+        with self._index_lock:
+            if self._index is None:
+                print('INFO: Building galaxy pixel index for {}'.format(self.path))
+                self._index = GalaxyIndex.build(self)
+            return self._index
+
+
+class GalaxyIndex(object):
+    '''
+        Catalog rows sorted by nested HEALPix pixel at a fine order, so the galaxies
+        inside any coarser (or equal) map pixel are one contiguous slice.
+
+        keys are uint64 (pixel << 32 | distance), where distance is the float32 bit
+        pattern of DistMpc (monotonic for positive floats) when distance_sorted,
+        and 0 otherwise. rows maps each key back to its catalog row.
+    '''
+    def __init__(self, keys, rows, order, distance_sorted, catalog):
+        self.keys = keys
+        self.rows = rows
+        self.order = order
+        self.distance_sorted = distance_sorted
+        self.catalog = catalog
+
+    @classmethod
+    def build(cls, catalog, order=INDEX_ORDER, distance_sorted=True):
+        if order > 14:
+            raise ValueError('Galaxy index order {} does not fit in 32 bits, use <= 14'.format(order))
+
+        ipix = hp.ang2pix(hp.order2nside(order), catalog['theta'], catalog['phi'], nest=True)
+        keys = ipix.astype(np.uint64) << np.uint64(32)
+        if distance_sorted:
+            keys |= np.asarray(catalog['DistMpc'], dtype=np.float32).view(np.uint32).astype(np.uint64)
+        rows = np.argsort(keys, kind='stable')
+        return cls(keys[rows], rows, order, distance_sorted, catalog)
+
+    def query(self, order, ipix, dmin=None, dmax=None):
+        '''
+            Returns the catalog rows inside the nested pixels ipix of the given order,
+            and for each row the position in ipix of the pixel containing it.
+
+            dmin/dmax (per pixel) narrow each lookup to a distance range when the index
+            is distance sorted and order matches the index order. The bounds are
+            conservative, callers still apply their exact distance cut.
+        '''
+        ipix = np.asarray(ipix, dtype=np.uint64)
+        if order > self.order:
+            return self._query_fine(order, ipix)
+
+        shift = np.uint64(2*(self.order - order))
+        lo = (ipix << shift) << np.uint64(32)
+        hi = ((ipix + np.uint64(1)) << shift) << np.uint64(32)
+        if self.distance_sorted and order == self.order and dmin is not None and dmax is not None:
+            lo = lo | _float32_bits(dmin, round_down=True)
+            hi = (hi - np.uint64(1 << 32)) | _float32_bits(dmax, round_down=False)
+            hi = hi + np.uint64(1)
+
+        starts = np.searchsorted(self.keys, lo, side='left')
+        ends = np.searchsorted(self.keys, hi, side='left')
+        counts = ends - starts
+        which = np.repeat(np.arange(len(ipix)), counts)
+        offsets = np.arange(len(which)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.rows[starts[which] + offsets], which
+
+    def _query_fine(self, order, ipix):
+        #map pixels finer than the index: look up the parent index pixels, then keep exact matches
+        parents = ipix >> np.uint64(2*(order - self.order))
+        rows, which = self.query(self.order, parents)
+        exact = hp.ang2pix(hp.order2nside(order), self.catalog['theta'][rows], self.catalog['phi'][rows], nest=True)
+        keep = exact == ipix[which]
+        return rows[keep], which[keep]
+
+
+def _float32_bits(values, round_down):
+    #float32 bit patterns bounding values, clipped to [0, inf] and widened past float32 rounding
+    values = np.clip(np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0 if round_down else np.inf), 0, np.inf)
+    f32 = values.astype(np.float32)
+    f32 = np.nextafter(f32, np.float32(0) if round_down else np.float32(np.inf))
+    return f32.view(np.uint32).astype(np.uint64)
+
+
+def _filter_catalog(galaxies):
+    ### If using luminosity, remove galaxies with no Lum_X, like so:
+    #galaxies = galaxies[~np.isnan(galaxies['Lum_W1'])]
+    ### If using mass, make cuts on DistMpc and Mstar
+    galaxies = galaxies[~np.isnan(galaxies['Mstar'])]
+    galaxies = galaxies[np.where(galaxies['DistMpc']>0)] # Remove galaxies with distance < 0
+    return galaxies
+
+
+def _catalog_columns(galaxies):
+    columns = {}
+    for c in CATALOG_COLUMNS:
+        col = np.asarray(galaxies[c])
+        if col.dtype.kind == 'S':
+            col = np.char.decode(col, 'utf-8')
+        elif col.dtype.kind == 'f':
+            #native byte order, but the FITS precision: the derived columns are computed in it
+            col = col.astype(col.dtype.newbyteorder('='))
+        columns[c] = col
+
+    columns['theta'] = 0.5 * np.pi - np.pi*(columns['dec'])/180
+    columns['phi'] = np.deg2rad(columns['ra'])
+    columns['log10dist'] = np.log10(columns['DistMpc'] * (10 ** 5))
+    return columns
+
+
+def compile_catalog(catalog_path: str, output_path: str, index_order=INDEX_ORDER, distance_sorted=True, verbose=False):
+    '''
+        Reads the galaxy catalog FITS file once, applies the ranking cuts and
+        writes every column, and the GalaxyIndex, as .npy files into output_path
+        so it can be memory-mapped by load_catalog instead of re-reading the FITS per alert
+    '''
+    if verbose:
+        print('INFO: Compiling galaxy catalog {} to {}'.format(catalog_path, output_path))
+
+    galaxies = _filter_catalog(Table.read(catalog_path))
+    columns = _catalog_columns(galaxies)
+    index = GalaxyIndex.build(GalaxyCatalog(columns), order=index_order, distance_sorted=distance_sorted)
+
+    os.makedirs(output_path, exist_ok=True)
+    for name, col in columns.items():
+        np.save(os.path.join(output_path, '{}.npy'.format(name)), col)
+    np.save(os.path.join(output_path, 'index_keys.npy'), index.keys)
+    np.save(os.path.join(output_path, 'index_rows.npy'), index.rows)
+
+    manifest = {
+        'version'  : COMPILED_CATALOG_VERSION,
+        'source'   : os.path.abspath(catalog_path),
+        'ngalaxies': len(galaxies),
+        'columns'  : list(columns.keys()),
+        'index'    : {
+            'order'           : index_order,
+            'distance_sorted' : distance_sorted
+        }
+    }
+    with open(os.path.join(output_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return output_path
+
+
+def _read_compiled_catalog(catalog_path):
+    with open(os.path.join(catalog_path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['version'] != COMPILED_CATALOG_VERSION:
+        raise ValueError('Compiled catalog {} has version {}, expected {}. Recompile it'.format(
+            catalog_path, manifest['version'], COMPILED_CATALOG_VERSION
+        ))
+
+    columns = {}
+    for name in manifest['columns']:
+        columns[name] = np.load(os.path.join(catalog_path, '{}.npy'.format(name)), mmap_mode='r')
+    catalog = GalaxyCatalog(columns, path=catalog_path, memmapped=True)
+
+    catalog._index = GalaxyIndex(
+        keys=np.load(os.path.join(catalog_path, 'index_keys.npy'), mmap_mode='r'),
+        rows=np.load(os.path.join(catalog_path, 'index_rows.npy'), mmap_mode='r'),
+        order=manifest['index']['order'],
+        distance_sorted=manifest['index']['distance_sorted'],
+        catalog=catalog
+    )
+    return catalog
+
+
+def load_catalog(catalog_path: str):
+    '''
+        Returns the GalaxyCatalog for catalog_path, loading it once per process.
+        catalog_path is either a directory written by compile_catalog, which is
+        memory-mapped, or the original FITS catalog, which is read and filtered
+    '''
+    catalog_path = os.path.abspath(catalog_path)
+    with _catalog_lock:
+        if catalog_path not in _catalog_cache:
+            print('INFO: Loading Galaxy Catalog {}'.format(catalog_path))
+            if os.path.isdir(catalog_path):
+                catalog = _read_compiled_catalog(catalog_path)
+            else:
+                galaxies = _filter_catalog(Table.read(catalog_path))
+                catalog = GalaxyCatalog(_catalog_columns(galaxies), path=catalog_path)
+            _catalog_cache[catalog_path] = catalog
+        return _catalog_cache[catalog_path]
+
+
+def get_catalog_path(galaxy_config: ConfigParser):
+    '''
+        Prefers the compiled catalog when it has been built, falls back to CATALOG_PATH
+    '''
+    compiled_path = galaxy_config.get('GALAXIES', 'COMPILED_CATALOG_PATH', fallback=None)
+    if compiled_path and os.path.exists(os.path.join(compiled_path, 'manifest.json')):
+        return compiled_path
+    return galaxy_config.get('GALAXIES', 'CATALOG_PATH')
+
+
+
+def _credzone_galaxies(index: GalaxyIndex, order, mappix, key, distmu, distsigma, probcutoff, nsigmas_in_d):
+    '''
+        Catalog rows (in catalog order) of the galaxies in map pixels with key >= probcutoff
+        that are within nsigmas_in_d of the pixel distance, and the map pixel of each row.
+        order is the nested order of each pixel (a single value for flattened maps)
+        and mappix its nested pixel number
+    '''
+    credpix = np.flatnonzero(key >= probcutoff)
+    rows, pixels = [], []
+    for o in np.unique(order[credpix]):
+        orderpix = credpix[order[credpix] == o]
+        orderrows, which = index.query(
+            int(o), mappix[orderpix],
+            dmin=distmu[orderpix] - nsigmas_in_d*distsigma[orderpix],
+            dmax=distmu[orderpix] + nsigmas_in_d*distsigma[orderpix]
+        )
+        rows.append(orderrows)
+        pixels.append(orderpix[which])
+    rows = np.concatenate(rows) if len(rows) else np.zeros(0, dtype=np.int64)
+    ipix = np.concatenate(pixels) if len(pixels) else np.zeros(0, dtype=np.int64)
+
+    d = index.catalog['DistMpc'][rows]
+    indistance = np.abs(d-distmu[ipix])<nsigmas_in_d*distsigma[ipix]
+    rows, ipix = rows[indistance], ipix[indistance]
+
+    catalog_order = np.argsort(rows, kind='stable')
+    return rows[catalog_order], ipix[catalog_order]
+
+
+def _moc_distances(skymap, distance):
+    #per-pixel distance columns of a multi-order skymap, or fixed nearby distances for bursts
+    if distance:
+        distmu = np.asarray(skymap['DISTMU'], dtype=np.float64)
+        distsigma = np.asarray(skymap['DISTSIGMA'], dtype=np.float64)
+        distnorm = np.asarray(skymap['DISTNORM'], dtype=np.float64)
+    else:
+        ### Fix distance vectors:
+        distmu = np.ones(len(skymap)) * 10.0 # Fix to 10 Mpc
+        distsigma = np.ones(len(skymap)) * 10.0 # Fix to 10 Mpc
+        distnorm = np.ones(len(skymap)) # Flat prior?
+    return distmu, distsigma, distnorm
+
+
+def _norm_pdf(x, mu, sigma):
+    #normal pdf, same arithmetic as scipy.stats.norm(mu, sigma).pdf(x) without building a frozen distribution
+    z = (x - mu) / sigma
+    return np.exp(-z**2/2.0) / np.sqrt(2*np.pi) / sigma
+
+
+def _top_k_descending(values, k):
+    '''
+        Indices of the k largest values, largest first, in the same order as the first k of
+        np.argsort(values, kind="mergesort")[::-1] (ties: later index first), without a full sort
+    '''
+    n = len(values)
+    if k <= 0 or k >= n:
+        return np.argsort(values, kind="mergesort")[::-1]
+
+    kth = np.partition(values, n-k)[n-k]
+    above = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)[::-1][:k-len(above)]
+    top = np.concatenate([above, ties])
+    return top[np.lexsort((-top, -values[top]))]
+
+
+def _rank_galaxies(p, mass, log10dist, sensitivity, minL, maxL, mindistFactor, completeness, ngalaxies):
+    '''
+        Ranks galaxies by p * normalized mass * distance factor
+
+        p: localization (angle and distance) probability of each galaxy
+        log10dist: log10 of the galaxy distances in units of 10pc
+        ngalaxies: number of top galaxies to return, 0 for all
+
+        returns the ranked indices, the score of every galaxy and the number of
+        top ranked galaxies making up completeness of the probability
+    '''
+    ### Normalize by mass:
+    ### NOTE: Can also do this in using luminosity
+    massNorm = mass / np.sum(mass)
+    normalization = np.sum(p * massNorm)
+
+    absolute_sensitivity = sensitivity - 5 * log10dist
+    absolute_sensitivity = absolute_sensitivity.astype(np.float64)
+
+    #absolute_sensitivity_lum = mag.f_nu_from_magAB(absolute_sensitivity)
+    absolute_sensitivity_lum = 4e33 * 10**(0.4*(4.74-absolute_sensitivity)) # Check this?
+    distanceFactor = (maxL - absolute_sensitivity_lum) / (maxL - minL)
+    distanceFactor[mindistFactor>distanceFactor] = mindistFactor
+    distanceFactor[absolute_sensitivity_lum<minL] = 1
+    distanceFactor[absolute_sensitivity>maxL] = mindistFactor
+
+    # Sorting glaxies by probability, only the top ngalaxies
+    ii = _top_k_descending(p*massNorm*distanceFactor, ngalaxies)
+    score = (p * massNorm / normalization)
+
+    ####counting galaxies that constitute completeness of the probability(~0.5*0.98)
+    ncompleteness = min(int(np.searchsorted(np.cumsum(score[ii]), completeness, side='left')) + 1, len(ii))
+
+    return ii, score, ncompleteness
+
+
+class GalaxyCandidates(object):
+    '''
+        The galaxies of a localization that get ranked: those in the credible zone pixels and
+        within the distance cut, their catalog columns (objname, ra, dec, DistMpc, Mstar,
+        log10dist), their localization probability p and the [dec, ra] of the map peak
+    '''
+    def __init__(self, galaxies: dict, p, maxprobcoord):
+        self.galaxies = galaxies
+        self.p = p
+        self.maxprobcoord = maxprobcoord
+
+    def __len__(self):
+        return len(self.p)
+
+
+def read_galaxy_config(galaxy_config_path: str):
+    galaxy_config = ConfigParser(inline_comment_prefixes=';')
+    galaxy_config.read(galaxy_config_path)
+    return galaxy_config
+
+
+def _find_candidates(eventlocalization: EventLocalization, galaxy_config: ConfigParser, catalog_path, credzone, skymap_filepath=None, skymap=None, skymap_stats=None):
     nsigmas_in_d = float(galaxy_config.get('GALAXIES', 'NSIGMAS_IN_D')) # Sigmas to consider in distnace (e.g. 3)
-    if not completeness:
-        completeness = float(galaxy_config.get('GALAXIES', 'COMPLETENESSP')) # Mass fraction completeness (e.g. 0.5)
-    #minGalaxies = int(galaxy_config.get('GALAXIES', 'MINGALAXIES')) # Minimum number of galaxies to output (e.g. 100)
-    
-    minL = float(galaxy_config.get('GALAXIES', 'MINL')) # Estimated brightest KN luminosity
-    maxL = float(galaxy_config.get('GALAXIES', 'MAXL')) # Estimated faintest KN luminosity
-    sensitivity = float(galaxy_config.get('GALAXIES', 'SENSITIVITY')) # Estimatest faintest app mag we can see
-    #ngalaxtoshow = int(galaxy_config.get('GALAXIES', 'NGALAXIES')) # Number of galaxies to show
-    
-    mindistFactor = float(galaxy_config.get('GALAXIES', 'MINDISTFACTOR')) #reflecting a small chance that the theory is comletely wrong and we can still see something
-    
-    ## Schecter Function parameters:
-    #alpha = float(galaxy_config.get('GALAXIES', 'ALPHA'))
-    #MB_star = float(galaxy_config.get('GALAXIES', 'MB_STAR'))
-    
+    minGalaxies = int(galaxy_config.get('GALAXIES', 'MINGALAXIES', fallback='1')) # Minimum number of galaxies to output (e.g. 100)
+    skymap_source = galaxy_config.get('GALAXIES', 'SKYMAP_SOURCE', fallback='moc') # moc: rank from the in-memory multi-order map, flat: read the flattened map
+
+    moc = skymap is not None and skymap_source == 'moc'
     try:
-        if not eventlocalization.distance_mean:
+        if moc:
+            ### Rank from the multi-order skymap already decoded from the alert
+            distmu, distsigma, distnorm = _moc_distances(skymap, eventlocalization.distance_mean)
+        elif not eventlocalization.distance_mean:
             ### This is a burst alert, so just read the probabilities from the map
             ### and fix the distance to only look at nearby galaxies
             if skymap_filepath is not None:
-                prob = hp.read_map(skymap_filepath, field=0)
+                prob = hp.read_map(skymap_filepath, field=0, nest=True)
             else:
-                prob = hp.read_map(eventlocalization.skymap_url.replace('.multiorder.fits','.fits.gz'), field=0)
+                prob = hp.read_map(eventlocalization.skymap_url.replace('.multiorder.fits','.fits.gz'), field=0, nest=True)
             ### Fix distance vectors:
             distmu = np.ones(len(prob)) * 10.0 # Fix to 10 Mpc
             distsigma = np.ones(len(prob)) * 10.0 # Fix to 10 Mpc
             distnorm = np.ones(len(prob)) # Flat prior?
         else:
             if skymap_filepath is not None:
-                prob, distmu, distsigma, distnorm = hp.read_map(skymap_filepath, field=[0,1,2,3])
+                prob, distmu, distsigma, distnorm = hp.read_map(skymap_filepath, field=[0,1,2,3], nest=True)
             else:
-                prob, distmu, distsigma, distnorm = hp.read_map(eventlocalization.skymap_url.replace('.multiorder.fits','.fits.gz'), field=[0,1,2,3])
+                prob, distmu, distsigma, distnorm = hp.read_map(eventlocalization.skymap_url.replace('.multiorder.fits','.fits.gz'), field=[0,1,2,3], nest=True)
 
     except Exception as e:
         print('WARNING: Failed to read sky map for {}'.format(eventlocalization))
         print('WARNING:',e)
-        return
-
-    # Get the map parameters:
-    npix = len(prob)
-    nside = hp.npix2nside(npix)
+        return None
 
-    # Load the galaxy catalog.
-    print('INFO: Loading Galaxy Catalog')
-    galaxies = Table.read(catalog_path)
+    # Sort and accumulate the map probabilities once (maps are in NESTED ordering to match the galaxy index)
+    if moc:
+        if skymap_stats is None:
+            skymap_stats = gw_skymap.SkymapStats.from_moc(skymap)
+        # probability a finest-order pixel would have at each pixel's density, ranks like the flattened map
+        prob = skymap_stats.key * hp.nside2pixarea(hp.order2nside(int(skymap_stats.level.max())))
+        order = skymap_stats.level
+    else:
+        skymap_stats = gw_skymap.SkymapStats.from_flat(prob)
+        order = np.broadcast_to(skymap_stats.level, len(prob))
+    mappix = skymap_stats.ipix
 
-    ### If using luminosity, remove galaxies with no Lum_X, like so:q
-    #galaxies = galaxies[~np.isnan(galaxies['Lum_W1'])]
-    ### If using mass, make cuts on DistMpc and Mstar
-    galaxies = galaxies[~np.isnan(galaxies['Mstar'])]
-    galaxies = galaxies[np.where(galaxies['DistMpc']>0)] # Remove galaxies with distance < 0
+    # Load the galaxy catalog, cuts and derived columns are applied once per process.
+    catalog = load_catalog(catalog_path)
+    index = catalog.index
 
-    theta = 0.5 * np.pi - np.pi*(galaxies['dec'])/180
-    phi = np.deg2rad(galaxies['ra'])
-    d = np.array(galaxies['DistMpc'])
-    # Convert galaxy coordinates to map pixels:
-    print('INFO: Converting Galaxy Coordinates to Map Pixels')
-    ipix = hp.ang2pix(nside, theta, phi)
-
-    maxprobcoord_tup = hp.pix2ang(nside, np.argmax(prob))
-    maxprobcoord = [0, 0]
-    maxprobcoord[0] = np.rad2deg(0.5*np.pi-maxprobcoord_tup[0])
-    maxprobcoord[1] = np.rad2deg(maxprobcoord_tup[1])
+    maxprob_ra, maxprob_dec = skymap_stats.max_prob_position()
+    maxprobcoord = [maxprob_dec.deg, maxprob_ra.deg]
     
     #Find the zone with probability <= credzone:
     print('INFO: Finding zone with credible probability')
-    probcutoff = 1
-    probsum = 0
+    probcutoff = skymap_stats.prob_cutoff(credzone)
+
+    # Look up the galaxies inside the credible zone pixels from the catalog index,
+    # cuttoffs: credzone of probability by angles and nsigmas by distance:
+    print('INFO: Looking up galaxies in credible zone pixels')
+    indgalaxies, ipix = _credzone_galaxies(index, order, mappix, skymap_stats.key, distmu, distsigma, probcutoff, nsigmas_in_d)
 
-    sortedprob = np.sort(prob,kind="mergesort")
-    while probsum < credzone:
-        probsum = probsum + sortedprob[-1]
-        probcutoff = sortedprob[-1]
-        sortedprob = sortedprob[:-1]
+    # Increase credzone to 99.995% if fewer than minGalaxies found:
+    # If too few galaxies found in the credzone and within the right distance range
+    if len(indgalaxies) < minGalaxies:
+        probcutoff = skymap_stats.prob_cutoff(max(credzone, 0.99995))
+        indgalaxies, ipix = _credzone_galaxies(index, order, mappix, skymap_stats.key, distmu, distsigma, probcutoff, 5)
 
     # Calculate the probability for galaxies according to the localization map:
     print('INFO: Calculating galaxy probabilities')
+    galaxies = {c: catalog[c][indgalaxies] for c in ['objname', 'ra', 'dec', 'DistMpc', 'Mstar', 'log10dist']}
     p = prob[ipix]
-    distp = (norm(distmu[ipix], distsigma[ipix]).pdf(d) * distnorm[ipix])
-
-    # Cuttoffs: credzone of probability by angles and nsigmas by distance:
-    inddistance = np.where(np.abs(d-distmu[ipix])<nsigmas_in_d*distsigma[ipix])
-    indcredzone = np.where(p>=probcutoff)
-
-    # Increase credzone to 99.995% if no galaxies found:
-    # If no galaxies found in the credzone and within the right distance range
-    if len(galaxies[np.intersect1d(indcredzone,inddistance)]) == 0:
-        while probsum < 0.99995:
-            if sortedprob.size == 0:
-                break
-            probsum = probsum + sortedprob[-1]
-            probcutoff = sortedprob[-1]
-            sortedprob = sortedprob[:-1]
-        inddistance = np.where(np.abs(d - distmu[ipix]) < 5 * distsigma[ipix])
-        indcredzone = np.where(p >= probcutoff)
-
-    ipix = ipix[np.intersect1d(indcredzone, inddistance)]
-    p = p[np.intersect1d(indcredzone, inddistance)]
-    p = (p * (distp[np.intersect1d(indcredzone, inddistance)]))  ##d**2?
-
-    galaxies = galaxies[np.intersect1d(indcredzone, inddistance)]
-    if len(galaxies) == 0:
-        print("WARNING: No galaxies found")
-        print("WARNING: Peak is at [RA,DEC](deg) = {}".format(maxprobcoord))
-        return
+    distp = (_norm_pdf(galaxies['DistMpc'], distmu[ipix], distsigma[ipix]) * distnorm[ipix])
+    p = (p * distp)  ##d**2?
 
-    ### Normalize by mass:
-    ### NOTE: Can also do this in using luminosity
+    return GalaxyCandidates(galaxies, p, maxprobcoord)
 
-    mass = galaxies['Mstar']
-    massNorm = mass / np.sum(mass)
-    normalization = np.sum(p * massNorm)
 
-    absolute_sensitivity = sensitivity - 5 * np.log10(galaxies['DistMpc'] * (10 ** 5))
-    absolute_sensitivity = absolute_sensitivity.astype(np.float64)
+def galaxy_candidates(eventlocalization: EventLocalization, galaxy_config: ConfigParser, credzone=None, skymap_filepath=None, skymap=None, skymap_stats=None):
+    '''
+        GalaxyCandidates of a localization, None when its sky map can not be read. For a
+        gw_skymap.ParsedSkymap they are kept in gw_warmup.candidates by map and configuration,
+        so follow-up alerts repeating the map (or a speculative run for it) select them once
+    '''
+    catalog_path = get_catalog_path(galaxy_config) # Path to the compiled catalog directory or the FITS catalog
+    if not credzone:
+        credzone = float(galaxy_config.get('GALAXIES', 'CREDZONE')) # Localization probability to consider credible (e.g. 0.99)
 
-    #absolute_sensitivity_lum = mag.f_nu_from_magAB(absolute_sensitivity)
-    absolute_sensitivity_lum = 4e33 * 10**(0.4*(4.74-absolute_sensitivity)) # Check this?
-    distanceFactor = np.zeros(len(galaxies))
-    distanceFactor[:] = ((maxL - absolute_sensitivity_lum) / (maxL - minL))
-    distanceFactor[mindistFactor>(maxL - absolute_sensitivity_lum) / (maxL - minL)] = mindistFactor
-    distanceFactor[absolute_sensitivity_lum<minL] = 1
-    distanceFactor[absolute_sensitivity>maxL] = mindistFactor
+    if not isinstance(skymap, gw_skymap.ParsedSkymap):
+        return _find_candidates(eventlocalization, galaxy_config, catalog_path, credzone, skymap_filepath, skymap, skymap_stats)
+
+    #the URL only matters when the flattened map is read from it
+    moc = galaxy_config.get('GALAXIES', 'SKYMAP_SOURCE', fallback='moc') == 'moc'
+    key = (
+        skymap.digest, catalog_path, credzone, bool(eventlocalization.distance_mean), None if moc else eventlocalization.skymap_url,
+        skymap_filepath, tuple(galaxy_config.items('GALAXIES'))
+    )
+    return gw_warmup.candidates.get(
+        key, lambda: _find_candidates(eventlocalization, galaxy_config, catalog_path, credzone, skymap_filepath, skymap.table, skymap.stats)
+    )
+
+
+def generate_galaxy_list(eventlocalization: EventLocalization, galaxy_config_path: str, completeness=None, credzone=None, skymap_filepath=None, skymap=None, skymap_stats=None):
+    """
+    An adaptation of the galaxy ranking algorithm described in
+    Arcavi et al. 2017 (doi:10.3847/2041-8213/aa910f)
+    
+    eventlocalization: an EventLocalization object (is still true, no longer tom toolkit model)
+    skymap: the gw_skymap.ParsedSkymap, or multi-order skymap Table (UNIQ, PROBDENSITY, DISTMU, DISTSIGMA, DISTNORM),
+            from the alert, ranked directly when SKYMAP_SOURCE is moc, instead of reading the flattened .fits.gz map
+    skymap_stats: the gw_skymap.SkymapStats already computed for a skymap Table, if any
+    """
+    # Parameters:
+    try:
+        galaxy_config = read_galaxy_config(galaxy_config_path)
+    except Exception as e:
+        print(e)
+    # Matching parameters:
+    if not completeness:
+        completeness = float(galaxy_config.get('GALAXIES', 'COMPLETENESSP')) # Mass fraction completeness (e.g. 0.5)
+    
+    minL = float(galaxy_config.get('GALAXIES', 'MINL')) # Estimated brightest KN luminosity
+    maxL = float(galaxy_config.get('GALAXIES', 'MAXL')) # Estimated faintest KN luminosity
+    sensitivity = float(galaxy_config.get('GALAXIES', 'SENSITIVITY')) # Estimatest faintest app mag we can see
+    ngalaxtoshow = int(galaxy_config.get('GALAXIES', 'NGALAXIES', fallback='0')) # Number of galaxies to show, 0 for all
+    
+    mindistFactor = float(galaxy_config.get('GALAXIES', 'MINDISTFACTOR')) #reflecting a small chance that the theory is comletely wrong and we can still see something
+    
+    ## Schecter Function parameters:
+    #alpha = float(galaxy_config.get('GALAXIES', 'ALPHA'))
+    #MB_star = float(galaxy_config.get('GALAXIES', 'MB_STAR'))
+
+    candidates = galaxy_candidates(
+        eventlocalization, galaxy_config, credzone=credzone, skymap_filepath=skymap_filepath, skymap=skymap, skymap_stats=skymap_stats
+    )
+    if candidates is None:
+        return
+
+    if len(candidates) == 0:
+        print("WARNING: No galaxies found")
+        print("WARNING: Peak is at [RA,DEC](deg) = {}".format(candidates.maxprobcoord))
+        return
+
+    galaxies, p = candidates.galaxies, candidates.p
+    ii, score, ncompleteness = _rank_galaxies(
+        p, galaxies['Mstar'], galaxies['log10dist'], sensitivity, minL, maxL, mindistFactor, completeness, ngalaxtoshow
+    )
+    print('INFO: {} of {} galaxies ranked, {} make up {} of the probability'.format(len(ii), len(candidates), ncompleteness, completeness))
 
-    # Sorting glaxies by probability
-    ii = np.argsort(p*massNorm*distanceFactor,kind="mergesort")[::-1]
-
-    ####counting galaxies that constitute 50% of the probability(~0.5*0.98)
-    summ = 0
-    galaxies50per = 0
-    sum_seen = 0
-    while summ<0.5:
-        if galaxies50per>= len(ii):
-            break
-        summ = summ + (p[ii[galaxies50per]]*massNorm[ii[galaxies50per]])/float(normalization)
-        sum_seen = sum_seen + (p[ii[galaxies50per]]*massNorm[ii[galaxies50per]]*distanceFactor[ii[galaxies50per]])/float(normalization)
-        galaxies50per = galaxies50per+1
-
-    #if want to limit by number of galaxies in .ini file
-
-    # if len(ii) > ngalaxtoshow:
-    #     n = ngalaxtoshow
-    # else:
-    #     n = len(ii)
-
-    score=(p * massNorm / normalization)
-    ra=galaxies['ra']
-    dec=galaxies['dec']
-    name = galaxies['objname']
-    Mstar = galaxies['Mstar']
-    dist = galaxies['DistMpc'].tolist()
+    ra = galaxies['ra'][ii].tolist()
+    dec = galaxies['dec'][ii].tolist()
+    name = galaxies['objname'][ii].tolist()
+    Mstar = galaxies['Mstar'][ii].tolist()
+    dist = galaxies['DistMpc'][ii].tolist()
+    score = score[ii].tolist()
     
     print('INFO: Finished creating ranked galaxy list for EventLocalization {}'.format(eventlocalization))
 
-    iter = ii.tolist()
-    galaxy_list = []
-    for i in range(len(iter)):
-        ind = iter[i]
-        galaxy_list.append({
-            "ra":ra[ind],
-            "dec":dec[ind],
-            "score":score[ind],
+    galaxy_list = [
+        {
+            "ra":ra[i],
+            "dec":dec[i],
+            "score":score[i],
             "rank":i,
-            "name":name[ind],
+            "name":name[i],
             "info":{
-                'Mstar':Mstar[ind],
-                'Distance [Mpc]':dist[ind]
+                'Mstar':Mstar[i],
+                'Distance [Mpc]':dist[i]
             }
-        })  
+        }
+        for i in range(len(ii))
+    ]
     
     post_galaxies_json = {
         "graceid":eventlocalization.graceid,
@@ -217,4 +563,13 @@ def generate_galaxy_list(eventlocalization: EventLocalization, galaxy_config_pat
         "galaxies":galaxy_list
     }
 
-    return post_galaxies_json
\ No newline at end of file
+    return post_galaxies_json
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) not in [3, 4]:
+        print('usage: python find_galaxies.py <catalog.fits> <compiled_catalog_dir> [index_order]')
+        sys.exit(1)
+    index_order = int(sys.argv[3]) if len(sys.argv) == 4 else INDEX_ORDER
+    compile_catalog(sys.argv[1], sys.argv[2], index_order=index_order, verbose=True)
@@ -0,0 +1,221 @@
+import gzip
+import json
+import time
+import threading
+import requests # type: ignore
+
+try:
+    import orjson # type: ignore
+except ImportError:
+    orjson = None
+
+from requests.adapters import HTTPAdapter # type: ignore
+from urllib3.exceptions import NewConnectionError # type: ignore
+
+'''
+    client for the GWTM API
+'''
+
+#seconds, per endpoint
+ENDPOINT_TIMEOUTS = {
+    "query_alerts"          : 10.0,
+    "post_alert"            : 30.0,
+    "event_galaxies"        : 60.0,
+    "remove_event_galaxies" : 30.0,
+    "post_icecube_notice"   : 30.0,
+    "del_test_alerts"       : 30.0,
+}
+DEFAULT_TIMEOUT = 30.0
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class APIError(Exception):
+    pass
+
+
+def encode_json(payload):
+    '''
+        json bytes of payload, with orjson when it is installed
+    '''
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload).encode()
+
+
+def _never_sent(e):
+    '''
+        Whether a requests ConnectionError happened before any of the request went out
+    '''
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if len(e.args) else None
+    return isinstance(reason, NewConnectionError)
+
+
+class GWTMClient(object):
+    '''
+        GWTM API client on one keep-alive requests.Session (pooled connections to API_BASE),
+        shared by all threads. Every endpoint has its own timeout (ENDPOINT_TIMEOUTS).
+
+        Idempotent calls (the queries, deleting a galaxy list or the test alerts) are retried
+        on connection errors, timeouts and RETRY_STATUS responses, up to max_retries times
+        with exponential backoff. Calls that create something (post_alert, posting galaxies
+        and IceCube notices) are only retried when the connection could not be made at all,
+        so they are never sent twice
+
+        Request bodies of compress_min_bytes or more are sent gzip compressed
+        (Content-Encoding: gzip), 0 turns compression off
+
+        stats() returns per endpoint counts, errors, retries and latency
+    '''
+    def __init__(self, api_base, api_token, max_retries=3, backoff=0.5, pool_size=8, compress_min_bytes=0):
+        self.api_base = api_base
+        self.api_token = api_token
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.compress_min_bytes = compress_min_bytes
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._stats_lock = threading.Lock()
+        self._stats: dict = {}
+
+
+    def _record(self, endpoint, elapsed, ok, retries):
+        with self._stats_lock:
+            endpoint_stats = self._stats.setdefault(endpoint, {'count': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            endpoint_stats['count'] += 1
+            endpoint_stats['errors'] += 0 if ok else 1
+            endpoint_stats['retries'] += retries
+            endpoint_stats['seconds'] += elapsed
+            endpoint_stats['max_seconds'] = max(endpoint_stats['max_seconds'], elapsed)
+
+
+    def stats(self):
+        with self._stats_lock:
+            return {endpoint: dict(endpoint_stats) for endpoint, endpoint_stats in self._stats.items()}
+
+
+    def request(self, method, endpoint, params, idempotent=False):
+        '''
+            Sends params (plus the api_token) as json to API_BASE/endpoint, returns the response
+            once it is a 200, raises APIError otherwise
+        '''
+        params = dict(params)
+        params['api_token'] = self.api_token
+        timeout = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+
+        body = encode_json(params)
+        headers = {'Content-Type': 'application/json'}
+        if self.compress_min_bytes and len(body) >= self.compress_min_bytes:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            retryable = False
+            try:
+                r = self.session.request(method, f"{self.api_base}{endpoint}", data=body, headers=headers, timeout=timeout)
+                if r.status_code == 200:
+                    self._record(endpoint, time.perf_counter() - start, True, attempt)
+                    return r
+                error = f"Bad api request: f{r.text}"
+                retryable = idempotent and r.status_code in RETRY_STATUS
+            except requests.exceptions.ConnectionError as e:
+                error = f"Bad api request: {endpoint} {e}"
+                retryable = idempotent or _never_sent(e)
+            except requests.exceptions.Timeout as e:
+                error = f"Bad api request: {endpoint} {e}"
+                retryable = idempotent
+
+            if not retryable or attempt >= self.max_retries:
+                self._record(endpoint, time.perf_counter() - start, False, attempt)
+                raise APIError(error)
+
+            delay = self.backoff * 2**attempt
+            attempt += 1
+            print(f"WARNING: {error}, retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+    def connect(self, timeout=10.0):
+        '''
+            Opens a pooled connection to api_base (DNS, TCP and TLS) ahead of the first call,
+            whatever the server answers
+        '''
+        self.session.head(self.api_base, timeout=timeout)
+        return self
+
+
+    def query_alerts(self, graceid, alert_type):
+        r = self.request('GET', "query_alerts", {"graceid": graceid, "alert_type": alert_type}, idempotent=True)
+        return json.loads(r.text)
+
+
+    def post_alert(self, gwa):
+        r = self.request('POST', "post_alert", gwa)
+        return json.loads(r.text)
+
+
+    def get_galaxy_lists(self, groupname, graceid):
+        r = self.request('GET', "event_galaxies", {'groupname': groupname, 'graceid': graceid}, idempotent=True)
+        return json.loads(r.text)
+
+
+    def post_galaxy_list(self, galaxies):
+        self.request('POST', "event_galaxies", galaxies)
+        print("INFO: Successfully posted galaxy list")
+
+
+    def remove_galaxy_list(self, listid):
+        self.request('POST', "remove_event_galaxies", {'listid': listid}, idempotent=True)
+        print("INFO: Successfully deleted galaxy list")
+
+
+    def delete_galaxy_list(self, galaxies):
+        gal_list = self.get_galaxy_lists(galaxies['groupname'], galaxies['graceid'])
+        if gal_list == []:
+            return
+        self.remove_galaxy_list(gal_list[0]['listid'])
+
+
+    def publish_galaxy_list(self, galaxies):
+        '''
+            Posts a ranked galaxy list (find_galaxies.generate_galaxy_list output) in place of
+            the group's current list for the event: the old one is looked up and removed first
+        '''
+        self.delete_galaxy_list(galaxies)
+        self.post_galaxy_list(galaxies)
+
+
+    def post_icecube_notice(self, notice, events):
+        r = self.request('POST', "post_icecube_notice", {"icecube_notice": notice, "icecube_notice_coinc_events": events})
+        return json.loads(r.text)
+
+
+    def del_test_alerts(self):
+        return self.request('POST', "del_test_alerts", {}, idempotent=True)
+
+
+_clients: dict = {}
+_clients_lock = threading.Lock()
+
+
+def get_api_client(config):
+    '''
+        The process wide GWTMClient for config.API_BASE and config.API_TOKEN
+    '''
+    key = (config.API_BASE, config.API_TOKEN)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = GWTMClient(
+                config.API_BASE, config.API_TOKEN,
+                max_retries=config.API_MAX_RETRIES, compress_min_bytes=config.API_COMPRESS_MIN_BYTES
+            )
+            _clients[key] = client
+        return client
@@ -0,0 +1,370 @@
+import os
+import re
+import json
+import time
+import datetime
+import threading
+import numpy as np
+
+from urllib.request import urlopen
+
+try:
+    from . import gw_config
+except ImportError:
+    import gw_config # type: ignore
+
+'''
+    on disk caches for the external data the Fermi artifacts need
+'''
+
+FERMI_TLE_URL = "https://celestrak.com/satcat/tle.php?CATNR=33053"
+FERMI_FT2_URL = "https://fermi.gsfc.nasa.gov/ssc/observations/timeline/ft2/files/"
+FERMI_FT2_WEEK_START = datetime.datetime(2008,8,7)
+FERMI_FT2_BASE_WEEK = 10
+
+
+def _atomic_write(path, content: bytes):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def parse_tle(text):
+    '''
+        (name, line1, line2) of the first TLE in text, which may be plain text
+        or wrapped in html
+    '''
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', errors='replace')
+    lines = [line.strip() for line in re.sub(r'<[^>]*>', '\n', text).splitlines()]
+    lines = [line for line in lines if len(line)]
+
+    for i in range(1, len(lines) - 1):
+        if lines[i].startswith('1 ') and lines[i + 1].startswith('2 '):
+            return lines[i - 1], lines[i], lines[i + 1]
+    raise ValueError("No TLE found")
+
+
+class TLECache(object):
+    '''
+        Fermi TLE kept on disk (cache_dir/fermi_tle.txt, its mtime is when it was fetched)
+
+        get() returns the cached TLE, and only goes to the network when there is none yet.
+        Once it is older than max_age seconds it is still returned while a background thread
+        fetches a new one, if that fetch fails the last good TLE keeps being used.
+        seed() fills the cache from a file, so tests and replays never touch the network
+    '''
+    def __init__(self, cache_dir, max_age=12*3600, url=FERMI_TLE_URL, timeout=10.0):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, 'fermi_tle.txt')
+        self.max_age = max_age
+        self.url = url
+        self.timeout = timeout
+
+        self._tle = None
+        self._fetched = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def seed(self, seed_path):
+        with open(seed_path, 'rb') as f:
+            tle = parse_tle(f.read())
+        self._store(tle)
+        return tle
+
+
+    def age(self):
+        self._load()
+        return time.time() - self._fetched if self._tle is not None else None
+
+
+    def get(self):
+        self._load()
+        if self._tle is None:
+            return self.refresh()
+
+        if time.time() - self._fetched > self.max_age:
+            self._refresh_in_background()
+        return self._tle
+
+
+    def refresh(self):
+        '''
+            Fetches the TLE now, falling back to the last good one if that fails
+        '''
+        try:
+            data = urlopen(self.url, timeout=self.timeout).read()
+            tle = parse_tle(data)
+        except Exception as e:
+            self._load()
+            if self._tle is None:
+                raise
+            print(f"WARNING: TLE refresh failed ({e}), using the one from {time.ctime(self._fetched)}")
+            return self._tle
+
+        self._store(tle)
+        return tle
+
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self.refresh()
+            except Exception:
+                pass
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, name='gwtm-tle-refresh', daemon=True).start()
+
+
+    def _store(self, tle):
+        _atomic_write(self.path, ('\n'.join(tle) + '\n').encode())
+        with self._lock:
+            self._tle, self._fetched = tle, time.time()
+
+
+    def _load(self):
+        '''
+            Picks up the on disk TLE if it is newer than the one in memory (another process
+            or a seed may have written it)
+        '''
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if self._tle is not None and mtime <= self._fetched:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                tle = parse_tle(f.read())
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self._tle, self._fetched = tle, mtime
+
+
+_tle_caches: dict = {}
+_tle_caches_lock = threading.Lock()
+
+
+def get_tle_cache(config):
+    '''
+        The process wide TLECache for config.CACHE_DIR, seeded from config.TLE_SEED_FILE when
+        there is no cached TLE yet
+    '''
+    with _tle_caches_lock:
+        cache = _tle_caches.get(config.CACHE_DIR)
+        if cache is None:
+            cache = TLECache(config.CACHE_DIR, max_age=config.TLE_MAX_AGE)
+            if config.TLE_SEED_FILE and cache.age() is None:
+                cache.seed(config.TLE_SEED_FILE)
+            _tle_caches[config.CACHE_DIR] = cache
+        return cache
+
+
+def ft2_week(timestamp):
+    '''
+        Mission week of the weekly FT2 pointing file that covers timestamp
+    '''
+    return (timestamp - FERMI_FT2_WEEK_START).days//7 + FERMI_FT2_BASE_WEEK
+
+
+def parse_ft2_index(html):
+    '''
+        week -> FERMI_POINTING_FINAL file name from the FSSC directory listing,
+        the last listed file wins when a week has several versions
+    '''
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', errors='replace')
+    index = {}
+    for filename in re.findall(r'href="?(FERMI_POINTING_FINAL_(\d+)_[^"\s>]*\.fits)', html):
+        index[int(filename[1])] = filename[0]
+    return index
+
+
+class FT2Pointing(object):
+    '''
+        Memory-mapped START/STOP/RA_SCZ/DEC_SCZ columns of one FT2 file
+    '''
+    def __init__(self, path):
+        import astropy.io.fits as fits # type:ignore
+
+        self.path = path
+        self.hdulist = fits.open(path, memmap=True)
+        data = self.hdulist[1].data
+        self.start = data.field('START')
+        self.stop = data.field('STOP')
+        self.ra = data.field('RA_SCZ')
+        self.dec = data.field('DEC_SCZ')
+
+
+    def closest(self, met):
+        '''
+            Row whose interval midpoint is closest to met, the earliest one on a tie. The rows
+            are time ordered, so only the neighbours of the START insertion point are compared
+        '''
+        i = int(np.searchsorted(self.start, met))
+        rows = np.arange(max(i - 2, 0), min(i + 2, len(self.start)))
+        mid = self.start[rows] + (self.stop[rows] - self.start[rows])/2.0
+        return int(rows[np.abs(mid - met).argmin()])
+
+
+class FT2Cache(object):
+    '''
+        Weekly Fermi FT2 pointing files kept in cache_dir/ft2, least recently used ones are
+        removed once they add up to more than max_bytes. The FSSC directory listing is kept in
+        cache_dir/ft2/index.json and only fetched again when it lacks the wanted week and is
+        older than index_max_age seconds. Opened files stay memory-mapped in the process
+    '''
+    def __init__(self, cache_dir, max_bytes=200*1024**2, index_max_age=600, url=FERMI_FT2_URL, timeout=30.0):
+        self.cache_dir = os.path.join(cache_dir, 'ft2')
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.index_max_age = index_max_age
+        self.url = url
+        self.timeout = timeout
+
+        self._index = None
+        self._index_fetched = 0.0
+        self._index_fetching = None
+        self._pointings: dict = {}
+        self._downloading: dict = {}
+        self._lock = threading.RLock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def _read_index(self, fetch):
+        '''
+            The week -> file name index, fetched again when fetch(index) and it is older than
+            index_max_age. Like the files the fetch runs outside the lock, threads needing it
+            meanwhile wait for it and lookups the index already answers go on
+        '''
+        while True:
+            with self._lock:
+                if self._index is None and os.path.exists(self.index_path):
+                    with open(self.index_path) as f:
+                        self._index = {int(k): v for k, v in json.load(f).items()}
+                    self._index_fetched = os.path.getmtime(self.index_path)
+
+                if not fetch(self._index) or time.time() - self._index_fetched <= self.index_max_age:
+                    return self._index or {}
+                fetching = self._index_fetching
+                if fetching is None:
+                    fetching = self._index_fetching = threading.Event()
+                    break
+            fetching.wait()
+
+        try:
+            index = parse_ft2_index(urlopen(self.url, timeout=self.timeout).read())
+            _atomic_write(self.index_path, json.dumps(index).encode())
+            with self._lock:
+                self._index, self._index_fetched = index, time.time()
+        finally:
+            with self._lock:
+                self._index_fetching = None
+            fetching.set()
+        return index
+
+
+    def filename(self, week):
+        index = self._read_index(lambda index: index is None or week not in index)
+        if week not in index:
+            raise ValueError('No Fermi FINAL pointing file found.')
+        return index[week]
+
+
+    def latest_week(self):
+        '''
+            The newest week with a FINAL file, a week's file is only published once it is over
+        '''
+        index = self._read_index(lambda index: True)
+        if not index:
+            raise ValueError('No Fermi FINAL pointing file found.')
+        return max(index)
+
+
+    def path(self, week):
+        '''
+            Local path of the FT2 file for week, downloaded on first use. The download runs
+            outside the lock, other threads wanting the same file wait for it, the rest go on
+        '''
+        filename = self.filename(week)
+        path = os.path.join(self.cache_dir, filename)
+        while True:
+            with self._lock:
+                if os.path.exists(path):
+                    os.utime(path)
+                    return path
+                downloading = self._downloading.get(path)
+                if downloading is None:
+                    downloading = self._downloading[path] = threading.Event()
+                    break
+            #someone else is downloading it, try again once they are done (or failed)
+            downloading.wait()
+
+        try:
+            _atomic_write(path, urlopen(self.url + filename, timeout=self.timeout).read())
+        finally:
+            with self._lock:
+                del self._downloading[path]
+            downloading.set()
+
+        with self._lock:
+            self._evict(keep=path)
+        return path
+
+
+    def pointing(self, week):
+        path = self.path(week)
+        with self._lock:
+            if path not in self._pointings:
+                self._pointings[path] = FT2Pointing(path)
+            return self._pointings[path]
+
+
+    def _evict(self, keep):
+        files = [
+            os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+            if f.endswith('.fits')
+        ]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if total <= self.max_bytes:
+                break
+            if f == keep:
+                continue
+            total -= os.path.getsize(f)
+            os.remove(f)
+            #threads may still be reading its memory-mapped columns, the file closes once they are done with it
+            self._pointings.pop(f, None)
+
+
+_ft2_caches: dict = {}
+
+
+def get_ft2_cache(config=None):
+    '''
+        The process wide FT2Cache for config.CACHE_DIR, without a config for the CACHE_DIR the
+        environment configures (gw_config.Config), so the files are kept across restarts
+    '''
+    if config is None:
+        config = gw_config.Config()
+    cache_dir, max_bytes = config.CACHE_DIR, config.FT2_CACHE_MAX_BYTES
+    with _tle_caches_lock:
+        cache = _ft2_caches.get(cache_dir)
+        if cache is None:
+            cache = FT2Cache(cache_dir, max_bytes=max_bytes)
+            _ft2_caches[cache_dir] = cache
+        return cache
@@ -0,0 +1,175 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+'''
+    per message record of the finished processing stages, so a restarted listener
+    picks an alert up where it stopped instead of redoing uploads and API posts
+'''
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS messages (
+        message_id TEXT PRIMARY KEY,
+        attempts   INTEGER NOT NULL DEFAULT 0,
+        started    REAL,
+        finished   REAL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS stages (
+        message_id TEXT NOT NULL,
+        stage      TEXT NOT NULL,
+        result     TEXT,
+        finished   REAL,
+        PRIMARY KEY (message_id, stage)
+    )''',
+]
+
+
+def message_id(message=None, alert=None):
+    '''
+        topic/partition/offset of a kafka message, or the sha1 of a bare alert
+    '''
+    if message is not None and message.topic() is not None:
+        return f"{message.topic()}/{message.partition()}/{message.offset()}"
+    if isinstance(alert, str):
+        alert = alert.encode('utf-8')
+    return hashlib.sha1(alert).hexdigest()
+
+
+class CheckpointStore(object):
+    '''
+        SQLite file (WAL mode) with the stages each message has finished and their results.
+        One connection shared by all threads, behind a lock. Messages finished more than
+        retention seconds ago are removed when the store is opened
+    '''
+    def __init__(self, path, retention=7*24*3600):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        self.prune(retention)
+
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+
+    def begin(self, message_id):
+        '''
+            Starts (or resumes) a message, returns its AlertCheckpoint
+        '''
+        self._execute(
+            'INSERT INTO messages (message_id, attempts, started) VALUES (?, 1, ?) '
+            'ON CONFLICT(message_id) DO UPDATE SET attempts = attempts + 1',
+            (message_id, time.time())
+        )
+        return AlertCheckpoint(self, message_id)
+
+
+    def attempts(self, message_id):
+        rows = self._execute('SELECT attempts FROM messages WHERE message_id = ?', (message_id,))
+        return rows[0][0] if len(rows) else 0
+
+
+    def is_finished(self, message_id):
+        rows = self._execute('SELECT finished FROM messages WHERE message_id = ?', (message_id,))
+        return len(rows) > 0 and rows[0][0] is not None
+
+
+    def stages(self, message_id):
+        '''
+            stage -> result of the finished stages of a message
+        '''
+        rows = self._execute('SELECT stage, result FROM stages WHERE message_id = ?', (message_id,))
+        return {stage: json.loads(result) for stage, result in rows}
+
+
+    def record(self, message_id, stage, result=None):
+        self._execute(
+            'INSERT OR REPLACE INTO stages (message_id, stage, result, finished) VALUES (?, ?, ?, ?)',
+            (message_id, stage, json.dumps(result), time.time())
+        )
+
+
+    def finish(self, message_id):
+        self._execute('UPDATE messages SET finished = ? WHERE message_id = ?', (time.time(), message_id))
+
+
+    def prune(self, retention):
+        cutoff = time.time() - retention
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM stages WHERE message_id IN (SELECT message_id FROM messages WHERE finished < ?)', (cutoff,)
+            )
+            self._conn.execute('DELETE FROM messages WHERE finished < ?', (cutoff,))
+
+
+class AlertCheckpoint(object):
+    '''
+        The finished stages of one message. run(stage, func) only calls func when the stage
+        has not finished in an earlier attempt, and otherwise returns the result it recorded
+        then (results are stored as json)
+    '''
+    def __init__(self, store: CheckpointStore, message_id):
+        self.store = store
+        self.message_id = message_id
+        self.finished = store.stages(message_id)
+        self.resumed = len(self.finished) > 0
+
+
+    def done(self, stage):
+        return stage in self.finished
+
+
+    def mark(self, stage, result=None):
+        self.store.record(self.message_id, stage, result)
+        self.finished[stage] = result
+
+
+    def run(self, stage, func):
+        if stage in self.finished:
+            return self.finished[stage]
+        result = func()
+        self.mark(stage, result)
+        return result
+
+
+    def finish(self):
+        self.store.finish(self.message_id)
+
+
+class NoCheckpoint(object):
+    '''
+        AlertCheckpoint stand-in that runs every stage, for one-off runs
+    '''
+    resumed = False
+
+    def done(self, stage):
+        return False
+
+    def mark(self, stage, result=None):
+        pass
+
+    def run(self, stage, func):
+        return func()
+
+    def finish(self):
+        pass
+
+
+_stores: dict = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path):
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = CheckpointStore(path)
+            _stores[path] = store
+        return store
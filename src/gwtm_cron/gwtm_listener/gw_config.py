@@ -1,6 +1,12 @@
 import os
 import json
 
+
+def _to_bool(value):
+    #JSON true/false or the strings "true", "1", "yes" (any case) from a JSON file or the environment
+    return str(value).lower() in ["true", "1", "yes"]
+
+
 class Config(object):
 
     def __init__(self, path_to_config=None):
@@ -23,7 +29,31 @@ class Config(object):
             self.OBSERVING_RUN = data["OBSERVING_RUN"] if "OBSERVING_RUN" in data.keys() else "O4"
             self.KAFKA_CLIENT_ID = data["KAFKA_CLIENT_ID"] if "KAFKA_CLIENT_ID" in data.keys() else ""
             self.KAFKA_CLIENT_SECRET = data["KAFKA_CLIENT_SECRET"] if "KAFKA_CLIENT_SECRET" in data.keys() else ""
+            self.KAFKA_GROUP_ID = data["KAFKA_GROUP_ID"] if "KAFKA_GROUP_ID" in data.keys() else ""
             self.PATH_TO_GALAXY_CATALOG_CONFIG = data["PATH_TO_GALAXY_CATALOG_CONFIG"] if "PATH_TO_GALAXY_CATALOG_CONFIG" in data.keys() else "home/azureuser/cron/gal_catalog_config.ini"
+            self.GRACEDB_TIMEOUT = float(data["GRACEDB_TIMEOUT"]) if "GRACEDB_TIMEOUT" in data.keys() else 10.0
+            self.SKYMAP_URL_DEADLINE = float(data["SKYMAP_URL_DEADLINE"]) if "SKYMAP_URL_DEADLINE" in data.keys() else 15.0
+            self.WRITER_WORKERS = int(data["WRITER_WORKERS"]) if "WRITER_WORKERS" in data.keys() else 4
+            self.CACHE_DIR = data["CACHE_DIR"] if "CACHE_DIR" in data.keys() else os.path.join(os.path.expanduser("~"), ".gwtm_cache")
+            self.TLE_MAX_AGE = float(data["TLE_MAX_AGE"]) if "TLE_MAX_AGE" in data.keys() else 43200.0
+            self.TLE_SEED_FILE = data["TLE_SEED_FILE"] if "TLE_SEED_FILE" in data.keys() else ""
+            self.FT2_CACHE_MAX_BYTES = int(data["FT2_CACHE_MAX_BYTES"]) if "FT2_CACHE_MAX_BYTES" in data.keys() else 200*1024**2
+            self.STORAGE_MANIFEST_PATH = data["STORAGE_MANIFEST_PATH"] if "STORAGE_MANIFEST_PATH" in data.keys() else ""
+            self.UPLOAD_QUEUE_DIR = data["UPLOAD_QUEUE_DIR"] if "UPLOAD_QUEUE_DIR" in data.keys() else ""
+            self.UPLOAD_WORKERS = int(data["UPLOAD_WORKERS"]) if "UPLOAD_WORKERS" in data.keys() else 4
+            self.UPLOAD_MAX_RETRIES = int(data["UPLOAD_MAX_RETRIES"]) if "UPLOAD_MAX_RETRIES" in data.keys() else 8
+            self.UPLOAD_RETRY_INTERVAL = float(data["UPLOAD_RETRY_INTERVAL"]) if "UPLOAD_RETRY_INTERVAL" in data.keys() else 900.0
+            self.API_MAX_RETRIES = int(data["API_MAX_RETRIES"]) if "API_MAX_RETRIES" in data.keys() else 3
+            self.API_COMPRESS_MIN_BYTES = int(data["API_COMPRESS_MIN_BYTES"]) if "API_COMPRESS_MIN_BYTES" in data.keys() else 0
+            self.PIPELINE_WORKERS = int(data["PIPELINE_WORKERS"]) if "PIPELINE_WORKERS" in data.keys() else 4
+            self.PIPELINE_QUEUE_SIZE = int(data["PIPELINE_QUEUE_SIZE"]) if "PIPELINE_QUEUE_SIZE" in data.keys() else 4
+            self.CHECKPOINT_DB = data["CHECKPOINT_DB"] if "CHECKPOINT_DB" in data.keys() else ""
+            self.MAX_ALERT_ATTEMPTS = int(data["MAX_ALERT_ATTEMPTS"]) if "MAX_ALERT_ATTEMPTS" in data.keys() else 3
+            self.ALERT_LEDGER = _to_bool(data["ALERT_LEDGER"]) if "ALERT_LEDGER" in data.keys() else True
+            self.ALERT_LEDGER_DB = data["ALERT_LEDGER_DB"] if "ALERT_LEDGER_DB" in data.keys() else ""
+            self.STAGED_INGEST = _to_bool(data["STAGED_INGEST"]) if "STAGED_INGEST" in data.keys() else True
+            self.ALERT_PROFILES = data["ALERT_PROFILES"] if "ALERT_PROFILES" in data.keys() else {}
+            self.SPECULATIVE_WARMUP = _to_bool(data["SPECULATIVE_WARMUP"]) if "SPECULATIVE_WARMUP" in data.keys() else True
         else:
             self.AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', '')
             self.AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
@@ -38,5 +68,29 @@ class Config(object):
             self.OBSERVING_RUN = os.environ.get('OBSERVING_RUN', 'O4')
             self.KAFKA_CLIENT_ID = os.environ.get('KAFKA_CLIENT_ID', '')
             self.KAFKA_CLIENT_SECRET = os.environ.get('KAFKA_CLIENT_SECRET', '')
+            self.KAFKA_GROUP_ID = os.environ.get('KAFKA_GROUP_ID', '')
             self.PATH_TO_GALAXY_CATALOG_CONFIG = os.environ.get("PATH_TO_GALAXY_CATALOG_CONFIG", "home/azureuser/cron/gal_catalog_config.ini")
+            self.GRACEDB_TIMEOUT = float(os.environ.get("GRACEDB_TIMEOUT", 10.0))
+            self.SKYMAP_URL_DEADLINE = float(os.environ.get("SKYMAP_URL_DEADLINE", 15.0))
+            self.WRITER_WORKERS = int(os.environ.get("WRITER_WORKERS", 4))
+            self.CACHE_DIR = os.environ.get("CACHE_DIR", os.path.join(os.path.expanduser("~"), ".gwtm_cache"))
+            self.TLE_MAX_AGE = float(os.environ.get("TLE_MAX_AGE", 43200.0))
+            self.TLE_SEED_FILE = os.environ.get("TLE_SEED_FILE", "")
+            self.FT2_CACHE_MAX_BYTES = int(os.environ.get("FT2_CACHE_MAX_BYTES", 200*1024**2))
+            self.STORAGE_MANIFEST_PATH = os.environ.get("STORAGE_MANIFEST_PATH", "")
+            self.UPLOAD_QUEUE_DIR = os.environ.get("UPLOAD_QUEUE_DIR", "")
+            self.UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 4))
+            self.UPLOAD_MAX_RETRIES = int(os.environ.get("UPLOAD_MAX_RETRIES", 8))
+            self.UPLOAD_RETRY_INTERVAL = float(os.environ.get("UPLOAD_RETRY_INTERVAL", 900.0))
+            self.API_MAX_RETRIES = int(os.environ.get("API_MAX_RETRIES", 3))
+            self.API_COMPRESS_MIN_BYTES = int(os.environ.get("API_COMPRESS_MIN_BYTES", 0))
+            self.PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 4))
+            self.PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 4))
+            self.CHECKPOINT_DB = os.environ.get("CHECKPOINT_DB", "")
+            self.MAX_ALERT_ATTEMPTS = int(os.environ.get("MAX_ALERT_ATTEMPTS", 3))
+            self.ALERT_LEDGER = _to_bool(os.environ.get("ALERT_LEDGER", "True"))
+            self.ALERT_LEDGER_DB = os.environ.get("ALERT_LEDGER_DB", "")
+            self.STAGED_INGEST = _to_bool(os.environ.get("STAGED_INGEST", "True"))
+            self.ALERT_PROFILES = json.loads(os.environ.get("ALERT_PROFILES", "{}"))
+            self.SPECULATIVE_WARMUP = _to_bool(os.environ.get("SPECULATIVE_WARMUP", "True"))
 
@@ -1,139 +1,71 @@
 import datetime
-import os
-import urllib
-import ephem # type:ignore
 import math
-import tempfile
 import requests # type:ignore
 import json
+import threading
+import time
 
 import numpy as np
-import astropy.io.fits as fits # type:ignore
-import astropy_healpix as ah # type:ignore
 
-from bs4 import BeautifulSoup
-from shapely.geometry import Polygon # type:ignore
-from shapely.geometry import Point
 from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 try:
     from . import gw_config as config 
+    from . import gw_cache
+    from . import gw_api
 except ImportError:
     import gw_config as config # type:ignore
+    import gw_cache # type:ignore
+    import gw_api # type:ignore
 '''
     listener functions
+
+    ephem, shapely and gw_skymap (astropy) are imported by the functions that use them,
+    warmup() loads them up front
 '''
 
+
+def _gw_skymap():
+    try:
+        from . import gw_skymap
+    except ImportError:
+        import gw_skymap # type:ignore
+    return gw_skymap
+
+
+def warmup():
+    import ephem # type:ignore # noqa: F401
+    import shapely.geometry # type:ignore # noqa: F401
+    _gw_skymap()
+
     
 def query_gwtm_alerts(graceid, alert_type, config: config.Config):
-    base = config.API_BASE
-    target = "query_alerts"
-    params = {
-        "graceid" : graceid,
-        "alert_type" : alert_type,
-        "api_token" : config.API_TOKEN
-    }
-    r = requests.get(f"{base}{target}", json=params)
-    if r.status_code == 200:
-        return json.loads(r.text)
-    else:
-        raise Exception(f"Bad api request: f{r.text}")
+    return gw_api.get_api_client(config).query_alerts(graceid, alert_type)
 
 
 def post_gwtm_alert(gwa, config: config.Config):
-    base = config.API_BASE
-    target = "post_alert"
-    params = gwa
-    params.update({
-        'api_token' : config.API_TOKEN
-    })
-    
-    r = requests.post(f"{base}{target}", json=params)
-    if r.status_code == 200:
-        return json.loads(r.text)
-    else:
-        raise Exception(f"Bad api request: f{r.text}")
+    return gw_api.get_api_client(config).post_alert(gwa)
 
 #post the galaxy list
 def post_galaxy_list(galaxies,config: config.Config):
-    base = config.API_BASE
-    target = "event_galaxies"
-    params = galaxies
-    params.update({
-        'api_token' : config.API_TOKEN
-    })
-    
-    r = requests.post(f"{base}{target}", json=params)
-    print("INFO: Successfully posted galaxy list")
-    if r.status_code == 200:
-        return
-    else:
-        raise Exception(f"Bad api request: f{r.text}")
+    return gw_api.get_api_client(config).post_galaxy_list(galaxies)
 
 
 def delete_galaxy_list(galaxies,config: config.Config):
-    base = config.API_BASE
-    target = "event_galaxies"
-
-    params = {
-        'groupname' : galaxies['groupname'],
-        'graceid' : galaxies['graceid'],
-    }
-    params.update({
-        'api_token' : config.API_TOKEN
-    })
-    r_get = requests.get(f"{base}{target}", json=params)
-
-    if r_get.status_code == 200:
-        gal_list = json.loads(r_get.text)
-        if gal_list == []:
-            return
-        else:
-            target_remove = 'remove_event_galaxies'
-            del_params = {
-                'listid':gal_list[0]['listid'],
-                'api_token':config.API_TOKEN
-            }
-
-            r_post = requests.post(f"{base}{target_remove}", json=del_params) 
-            print("INFO: Successfully deleted galaxy list")
-
-            if r_post.status_code == 200:
-                return
-            else:
-                raise Exception(f"Bad api request: f{r_post.text}")
-    else:
-        raise Exception(f"Bad api request: f{r_get.text}")
-    
+    return gw_api.get_api_client(config).delete_galaxy_list(galaxies)
+
+
+def publish_galaxy_list(galaxies, config: config.Config):
+    return gw_api.get_api_client(config).publish_galaxy_list(galaxies)
 
 
 def post_icecube_notice(notice, events, config: config.Config):
-    base = config.API_BASE
-    target = "post_icecube_notice"
-    params = {
-        "api_token"                   : config.API_TOKEN,
-        "icecube_notice"              : notice,
-        "icecube_notice_coinc_events" : events
-    }
-
-    r = requests.post(f"{base}{target}", json=params)
-    if r.status_code == 200:
-        return json.loads(r.text)
-    else:
-        raise Exception(f"Bad api request: f{r.text}")
+    return gw_api.get_api_client(config).post_icecube_notice(notice, events)
 
  
 def del_test_alerts(config: config.Config):
-    base = config.API_BASE
-    target = "del_test_alerts"
-    params = {
-        'api_token':config.API_TOKEN
-    }
-    r = requests.post(f"{base}{target}", json=params)
-    if r.status_code == 200:
-        return r
-    else:
-        raise Exception(f"Bad api request: f{r.text}")
+    return gw_api.get_api_client(config).del_test_alerts()
 
 
 def get_packet_type(alert_type):
@@ -153,24 +85,88 @@ def get_packet_type(alert_type):
     return "Error", 0
 
 
-def get_skymap_avg_pos(skymap):
-    level, ipix = ah.uniq_to_level_ipix(
-        skymap[np.argmax(skymap['PROBDENSITY'])]['UNIQ']
-    )
-    ra, dec = ah.healpix_to_lonlat(ipix, ah.level_to_nside(level), order='nested')
-    return ra, dec
+GRACEDB_SUPEREVENT_FILES = "https://gracedb.ligo.org/api/superevents/{graceid}/files/{filename}"
+#in order of preference
+GRACEDB_SKYMAP_FILES = ["cWB.fits.gz", "bilby.fits.gz", "bayestar.fits.gz"]
+INVALID_SKYMAP_URL = "Invalid.Sky.Map.URL"
+
+_skymap_url_cache: dict = {}
+_skymap_url_lock = threading.Lock()
+_skymap_url_executor = None
+
 
-def get_skymap_90_50_area(skymap):
-    skymap.sort('PROBDENSITY', reverse=True)
-    level, ipix = ah.uniq_to_level_ipix(skymap['UNIQ'])
-    pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(level))
-    prob = pixel_area * skymap['PROBDENSITY']
-    cumprob = np.cumsum(prob)
-
-    i_90 = cumprob.searchsorted(0.9)
-    i_50 = cumprob.searchsorted(0.5)
-    area_90 = pixel_area[:i_90].sum()
-    area_50 = pixel_area[:i_50].sum()
+def _probe_url(url, timeout):
+    try:
+        return requests.head(url, timeout=timeout).status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def resolve_skymap_url(graceid, timeout=10.0, deadline=15.0):
+    '''
+        Finds the preferred flattened skymap file on GraceDB for a superevent.
+        The HEAD probes run concurrently and the whole lookup gives up after deadline seconds,
+        probes still running by then count as missing.
+
+        Found URLs are remembered per superevent, later alerts only re-probe the files that
+        are preferred over the one already found (none at all once cWB is found)
+    '''
+    with _skymap_url_lock:
+        known = _skymap_url_cache.get(graceid)
+
+    candidates = GRACEDB_SKYMAP_FILES
+    if known is not None:
+        candidates = GRACEDB_SKYMAP_FILES[:GRACEDB_SKYMAP_FILES.index(known)]
+        if len(candidates) == 0:
+            return GRACEDB_SUPEREVENT_FILES.format(graceid=graceid, filename=known)
+
+    end = time.monotonic() + deadline
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    try:
+        probes = [
+            (mf, executor.submit(_probe_url, GRACEDB_SUPEREVENT_FILES.format(graceid=graceid, filename=mf), timeout))
+            for mf in candidates
+        ]
+        found = known
+        for mf, probe in probes:
+            try:
+                if probe.result(timeout=max(end - time.monotonic(), 0)):
+                    found = mf
+                    break
+            except FutureTimeoutError:
+                print(f"WARNING: GraceDB probe for {graceid} {mf} timed out")
+    finally:
+        executor.shutdown(wait=False)
+
+    if found is None:
+        return INVALID_SKYMAP_URL
+
+    with _skymap_url_lock:
+        _skymap_url_cache[graceid] = found
+    return GRACEDB_SUPEREVENT_FILES.format(graceid=graceid, filename=found)
+
+
+def resolve_skymap_url_later(graceid, timeout=10.0, deadline=15.0):
+    '''
+        resolve_skymap_url on a background thread, returns its future
+    '''
+    global _skymap_url_executor
+    with _skymap_url_lock:
+        if _skymap_url_executor is None:
+            _skymap_url_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='gwtm-skymap-url')
+    return _skymap_url_executor.submit(resolve_skymap_url, graceid, timeout=timeout, deadline=deadline)
+
+
+def get_skymap_avg_pos(skymap, skymap_stats=None):
+    if skymap_stats is None:
+        skymap_stats = _gw_skymap().SkymapStats.from_moc(skymap)
+    return skymap_stats.max_prob_position()
+
+def get_skymap_90_50_area(skymap, skymap_stats=None):
+    if skymap_stats is None:
+        skymap_stats = _gw_skymap().SkymapStats.from_moc(skymap)
+    area_90 = skymap_stats.area(0.9)
+    area_50 = skymap_stats.area(0.5)
     
     return area_90, area_50
 
@@ -187,22 +183,21 @@ def ra_dec_to_uvec(ra, dec):
 
 def uvec_to_ra_dec(x, y, z):
     r = np.sqrt(x**2 + y ** 2 + z ** 2)
-    x /= r
-    y /= r
-    z /= r
+    x = x / r
+    y = y / r
+    z = z / r
     theta = np.arctan2(y, x)
     phi = np.arccos(z)
     dec = 90 - np.rad2deg(phi)
-    if theta < 0:
-        ra = 360 + np.rad2deg(theta)
-    else:
-        ra = np.rad2deg(theta)
+    ra = np.where(theta < 0, 360 + np.rad2deg(theta), np.rad2deg(theta))
+    if np.ndim(ra) == 0:
+        ra = ra[()]
     return ra, dec
 
 
 def x_rot(theta_deg):
     theta = np.deg2rad(theta_deg)
-    return np.matrix([
+    return np.array([
         [1, 0, 0],
         [0, np.cos(theta), -np.sin(theta)],
         [0, np.sin(theta), np.cos(theta)]
@@ -211,7 +206,7 @@ def x_rot(theta_deg):
 
 def y_rot(theta_deg):
     theta = np.deg2rad(theta_deg)
-    return np.matrix([
+    return np.array([
         [np.cos(theta), 0, np.sin(theta)],
         [0, 1, 0],
         [-np.sin(theta), 0, np.cos(theta)]
@@ -220,38 +215,77 @@ def y_rot(theta_deg):
 
 def z_rot(theta_deg):
     theta = np.deg2rad(theta_deg)
-    return np.matrix([
+    return np.array([
         [np.cos(theta), -np.sin(theta), 0],
         [np.sin(theta), np.cos(theta), 0],
         [0, 0, 1]
     ])
 
 
+def rotation_matrices(ra, dec, pos_angle):
+    '''
+        (M,3,3) rotations x_rot(-pos_angle) @ y_rot(dec) @ z_rot(-ra) that take a footprint
+        centered on ra=dec=0 to each of the M pointings, for row vectors (vec @ R)
+    '''
+    ra, dec, pos_angle = np.broadcast_arrays(*[np.atleast_1d(np.asarray(a, dtype=float)) for a in (ra, dec, pos_angle)])
+    a, b, c = np.deg2rad(-pos_angle), np.deg2rad(dec), np.deg2rad(-ra)
+    zero, one = np.zeros_like(a), np.ones_like(a)
+
+    x = np.stack([
+        np.stack([one, zero, zero], axis=-1),
+        np.stack([zero, np.cos(a), -np.sin(a)], axis=-1),
+        np.stack([zero, np.sin(a), np.cos(a)], axis=-1)
+    ], axis=-2)
+    y = np.stack([
+        np.stack([np.cos(b), zero, np.sin(b)], axis=-1),
+        np.stack([zero, one, zero], axis=-1),
+        np.stack([-np.sin(b), zero, np.cos(b)], axis=-1)
+    ], axis=-2)
+    z = np.stack([
+        np.stack([np.cos(c), -np.sin(c), zero], axis=-1),
+        np.stack([np.sin(c), np.cos(c), zero], axis=-1),
+        np.stack([zero, zero, one], axis=-1)
+    ], axis=-2)
+    return x @ y @ z
+
+
+def project_footprints(footprints, ra, dec, pos_angle=0.0):
+    '''
+        Projects footprints (ra, dec vertices centered on ra=dec=0) onto M pointings at once
+
+        footprints: (N,2) shared by every pointing, or (M,N,2) one per pointing
+        ra, dec, pos_angle: scalars or length M arrays, degrees
+        returns an (M,N,2) array of projected ra, dec
+    '''
+    footprints = np.asarray(footprints, dtype=float)
+    rot = rotation_matrices(ra, dec, 0.0 if pos_angle is None else pos_angle)
+
+    x, y, z = ra_dec_to_uvec(footprints[..., 0], footprints[..., 1])
+    uvec = np.stack([x, y, z], axis=-1)
+    if uvec.ndim == 2:
+        uvec = uvec[np.newaxis]
+    new_x, new_y, new_z = np.moveaxis(uvec @ rot, -1, 0)
+
+    pt_ra, pt_dec = uvec_to_ra_dec(new_x, new_y, new_z)
+    return np.stack([pt_ra, pt_dec], axis=-1)
+
+
 def project_footprint(footprint, ra, dec, pos_angle):
     if pos_angle is None:
         pos_angle = 0.0
 
-    footprint_zero_center_ra = np.asarray([pt[0] for pt in footprint])
-    footprint_zero_center_dec = np.asarray([pt[1] for pt in footprint])
-    footprint_zero_center_uvec = ra_dec_to_uvec(footprint_zero_center_ra, footprint_zero_center_dec)
-    footprint_zero_center_x, footprint_zero_center_y, footprint_zero_center_z = footprint_zero_center_uvec
-    proj_footprint = []
-    for idx in range(footprint_zero_center_x.shape[0]):
-        vec = np.asarray([footprint_zero_center_x[idx], footprint_zero_center_y[idx], footprint_zero_center_z[idx]])
-        new_vec = vec @ x_rot(-pos_angle) @ y_rot(dec) @ z_rot(-ra)
-        new_x, new_y, new_z = new_vec.flat
-        pt_ra, pt_dec = uvec_to_ra_dec(new_x, new_y, new_z)
-        proj_footprint.append([pt_ra, pt_dec])
-    return proj_footprint
-
-
-def getDataFromTLE(datetime, tleLatOffset=0, tleLonOffset=0.21):
-    # Get TLE and parse
-    url = "https://celestrak.com/satcat/tle.php?CATNR=33053"
-    data = urlopen(url)
-    tle_raw=data.read()
-    clean_tle = ''.join(BeautifulSoup(tle_raw, "html.parser").stripped_strings)
-    tle_obj = clean_tle.split('\r\n')
+    return project_footprints(footprint, ra, dec, pos_angle)[0].tolist()
+
+
+def getDataFromTLE(datetime, tleLatOffset=0, tleLonOffset=0.21, tle_cache=None):
+    import ephem # type:ignore
+    from shapely.geometry import Polygon, Point # type:ignore
+
+    # Get TLE and parse, from the gw_cache.TLECache if there is one
+    if tle_cache is not None:
+        tle_obj = tle_cache.get()
+    else:
+        tle_obj = gw_cache.parse_tle(urlopen(gw_cache.FERMI_TLE_URL).read())
 
     # Print age of TLE
     # year = "20"+tle_obj[1][18:20]
@@ -313,6 +347,8 @@ def deg2dm(deg):
 
 
 def getGeoCenter(datetime, lon, lat):
+    import ephem # type:ignore
+
     # Define the observer to be at the location of the spacecraft
     observer = ephem.Observer()
 
@@ -345,12 +381,12 @@ def getGeoCenter(datetime, lon, lat):
     return ra_geocenter, dec_geocenter
     
 
-def getearthsatpos(datetime):
+def getearthsatpos(datetime, tle_cache=None):
     tleLonOffset=0.21
     tleLatOffset = 0
 
     try:
-        lon, lat, elevation= getDataFromTLE(datetime, tleLatOffset=tleLatOffset, tleLonOffset=tleLonOffset)
+        lon, lat, elevation= getDataFromTLE(datetime, tleLatOffset=tleLatOffset, tleLonOffset=tleLonOffset, tle_cache=tle_cache)
     except Exception:
         return False, False, False
 
@@ -386,40 +422,12 @@ def makeLATFoV(ra,dec,radius=65):
     return LATfov
 
 
-def getFermiFT2file(timestamp):
-    
-    weekly_file_start = datetime.datetime(2008,8,7)
-    base_week = 10
-    day_diff = (timestamp - weekly_file_start).days
-    week_diff = day_diff//7
-    week = week_diff + base_week
-
-    resp = urlopen("https://fermi.gsfc.nasa.gov/ssc/observations/timeline/ft2/files/")
-    soup = BeautifulSoup(resp, from_encoding=resp.info().get_param('charset'), features="lxml")
-    for link in soup.find_all('a', href=True):
-        if 'FERMI' not in link['href'] or 'PRELIM' in link['href']:
-            continue
-        if int(link['href'].strip('FERMI_POINTING_FINAL').strip('_00.fits').split('_')[0]) == week:
-            filename = (link['href'])
-            
-    url_base = 'https://fermi.gsfc.nasa.gov/ssc/observations/timeline/ft2/files/'
-    pointing_file_url = url_base + filename
-    
-    try:
-        resp = urlopen(pointing_file_url)
-        exists = True
-    except urllib.error.HTTPError:
-        exists = False
-        
-    if not exists:
-        raise ValueError('No Fermi FINAL pointing file found.')
-    
-    temp_dir = tempfile.mkdtemp()
-    destination = os.path.join(temp_dir, filename)
-    urllib.request.urlretrieve(pointing_file_url, destination)
+def getFermiFT2file(timestamp, ft2_cache=None, config=None):
+    if ft2_cache is None:
+        ft2_cache = gw_cache.get_ft2_cache(config)
 
-    # return the location of the downloaded file
-    return destination
+    # return the location of the cached weekly file
+    return ft2_cache.path(gw_cache.ft2_week(timestamp))
 
 
 def datetime2MET(timestamp):
@@ -427,30 +435,27 @@ def datetime2MET(timestamp):
     return mettime
 
 
-def getFermiPointing(timestamp, theta_max=65, verbose=False):
-    ft2file= getFermiFT2file(timestamp)
+def getFermiPointing(timestamp, theta_max=65, verbose=False, ft2_cache=None, config=None):
+    if ft2_cache is None:
+        ft2_cache = gw_cache.get_ft2_cache(config)
 
-    # Open the FT2 file
-    hdulist = fits.open(ft2file)
-    data = hdulist[1].data
-    # Extract the spacecraft time
-    tstart = data.field('start')
-    tstop = data.field('stop')
-    time = tstart + (tstop - tstart)/2.0
+    # The memory-mapped FT2 file
+    pointing = ft2_cache.pointing(gw_cache.ft2_week(timestamp))
 
     trigger_met = datetime2MET(timestamp)
 
     if trigger_met is None:
-        trigger_met = time[0]
+        trigger_met = pointing.start[0] + (pointing.stop[0] - pointing.start[0])/2.0
 
     # Determine the index for the time closest to the triggertime
-    index_closest = (np.abs(time - trigger_met)).argmin()   
+    index_closest = pointing.closest(trigger_met)
 
     # Get the LAT pointing at the trigger time
-    ra_lat_pointing = data.field('RA_SCZ')[index_closest]
-    dec_lat_pointing = data.field('DEC_SCZ')[index_closest]
+    ra_lat_pointing = pointing.ra[index_closest]
+    dec_lat_pointing = pointing.dec[index_closest]
 
     if verbose is True:
-        print("\nLAT Pointing @ %s (dt = %s seconds):\nRA = %s, Dec = %s\n" % (time[index_closest], time[index_closest]-trigger_met, ra_lat_pointing, dec_lat_pointing))
+        time_closest = pointing.start[index_closest] + (pointing.stop[index_closest] - pointing.start[index_closest])/2.0
+        print("\nLAT Pointing @ %s (dt = %s seconds):\nRA = %s, Dec = %s\n" % (time_closest, time_closest-trigger_met, ra_lat_pointing, dec_lat_pointing))
 
     return ra_lat_pointing, dec_lat_pointing
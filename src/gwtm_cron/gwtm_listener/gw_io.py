@@ -1,27 +1,168 @@
 import datetime
 import os
 import json
-import ligo.skymap  # type: ignore
-import ligo.skymap.io  # type: ignore
-import ligo.skymap.postprocess  # type: ignore
-import tempfile
+import shutil
+import threading
+import time
 import requests  # type: ignore
 
-from ligo.skymap.healpix_tree import interpolate_nested  # type: ignore
-from astropy.coordinates import SkyCoord  # type: ignore
-from mocpy import MOC  # type: ignore
-
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait as wait_futures
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
 
 try:
     from . import gw_function as function
     from . import gw_config as config
+    from . import gw_skymap
     from . import gwstorage
+    from . import gw_cache
+    from . import gw_warmup
 except ImportError:
     # If running as a script, import from the parent directory
     import gw_function as function  # type: ignore
     import gw_config as config  # type: ignore
+    import gw_skymap  # type: ignore
     import gwstorage  # type: ignore
+    import gw_cache  # type: ignore
+    import gw_warmup  # type: ignore
+
+SKYMAP_CHUNK_SIZE = 1 << 20
+
+#ligo.skymap.postprocess, astropy.coordinates and mocpy take seconds to import, so the
+#stages that use them import them when they run (or warmup() does it up front)
+
+
+def warmup():
+    '''
+        Imports the modules the Writer stages need
+    '''
+    import ligo.skymap.postprocess  # type: ignore
+    from astropy.coordinates import SkyCoord  # type: ignore
+    from mocpy import MOC  # type: ignore
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(max_workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gwtm-writer')
+        return _executor
+
+
+class WriterContext(NamedTuple):
+    '''
+        Read-only snapshot of the alert a set of Writer stages works on, so the
+        Writer itself can move on to the next alert while they run
+    '''
+    path_info: str
+    gwalert_dict: Mapping
+    skymap: gw_skymap.ParsedSkymap
+
+
+class WriterJobs(object):
+    '''
+        The artifact stages of one alert, each running as its own job on the bounded
+        Writer executor (WRITER_WORKERS threads, shared by all alerts)
+
+        timings   : stage -> seconds it ran for
+        errors    : stage -> exception it raised, filled in by wait()
+        cancelled : stages cancel() stopped before they started
+        overdue   : stages still running when wait() ran out of time
+
+        With a checkpoint (gw_checkpoint.AlertCheckpoint) the stages are recorded as
+        "{path_info}:{stage}" once they succeed (did not raise or return False), and skipped
+        when an earlier attempt did
+    '''
+    def __init__(self, ctx: WriterContext, stages: dict, config: config.Config, verbose=False, checkpoint=None):
+        self.ctx = ctx
+        self.verbose = verbose
+        self.checkpoint = checkpoint
+        self.timings: dict = {}
+        self.errors: dict = {}
+        self.cancelled: list = []
+        self.overdue: list = []
+
+        executor = _get_executor(config.WRITER_WORKERS)
+        self.futures = {
+            stage: executor.submit(self._timed, stage, func, ctx, config, verbose)
+            for stage, func in stages.items()
+        }
+
+
+    def _timed(self, stage, func, ctx, config, verbose):
+        checkpoint_stage = f"{ctx.path_info}:{stage}"
+        if self.checkpoint is not None and self.checkpoint.done(checkpoint_stage):
+            if verbose:
+                print(f"INFO: {checkpoint_stage} was written by an earlier attempt")
+            self.timings[stage] = 0.0
+            return
+
+        start = time.perf_counter()
+        try:
+            result = func(ctx, config=config, verbose=verbose)
+        finally:
+            self.timings[stage] = time.perf_counter() - start
+        #stages that report their own failure return False, they are tried again on the next attempt
+        if self.checkpoint is not None and result is not False:
+            self.checkpoint.mark(checkpoint_stage)
+        return result
+
+
+    def cancel(self):
+        '''
+            Drops the stages that have not started yet, running ones still finish
+        '''
+        for stage, future in self.futures.items():
+            if future.cancel():
+                self.cancelled.append(stage)
+        return self
+
+
+    def wait(self, raise_errors=True, timeout=None):
+        '''
+            Blocks until every stage has finished, reports each failure, and re-raises
+            the first one unless raise_errors is False
+
+            With a timeout (seconds) the stages that have not started by then are cancelled,
+            and the running ones are left to finish in the background
+        '''
+        if timeout is not None:
+            wait_futures(self.futures.values(), timeout=timeout)
+            for stage, future in self.futures.items():
+                if future.done():
+                    continue
+                if future.cancel():
+                    self.cancelled.append(stage)
+                else:
+                    self.overdue.append(stage)
+            if len(self.cancelled) or len(self.overdue):
+                print(f"WARNING: {self.ctx.path_info} artifacts ran out of their {timeout:.0f}s, cancelled: {self.cancelled}, left running: {self.overdue}")
+
+        for stage, future in self.futures.items():
+            if stage in self.overdue:
+                continue
+            try:
+                future.result()
+            except CancelledError:
+                pass
+            except Exception as e:
+                self.errors[stage] = e
+                print(f"WARNING: {stage} stage for {self.ctx.path_info} failed after {self.timings.get(stage, 0.0):.2f}s: {e!r}")
+
+        if self.verbose:
+            stage_times = ', '.join(
+                f"{stage} cancelled" if stage in self.cancelled else f"{stage} {self.timings.get(stage, 0.0):.2f}s"
+                for stage in self.futures
+            )
+            print(f"INFO: {self.ctx.path_info} artifacts: {stage_times}")
+
+        if raise_errors and len(self.errors):
+            raise next(iter(self.errors.values()))
+        return self
+
 
 class Writer():
     
@@ -39,7 +180,10 @@ class Writer():
             alert = alert.decode('utf-8')
         self.alert = alert
 
-        self.skymap = None
+        self.skymap: gw_skymap.ParsedSkymap = None  # type: ignore
+        #GraceDB skymap url -> where it was written
+        self.fetched_skymaps: dict = {}
+        self._fetch_lock = threading.Lock()
         self.path_info = None
         self.gwalert_dict: dict = {}
 
@@ -56,6 +200,8 @@ class Writer():
 
 
     def set_skymap(self, skymap):
+        if isinstance(skymap, bytes):
+            skymap = gw_skymap.ParsedSkymap(skymap)
         self.skymap = skymap
 
 
@@ -67,73 +213,123 @@ class Writer():
         self.gwalert_dict = gwalert_dict
 
 
+    def snapshot(self):
+        return WriterContext(
+            path_info=self.path_info,
+            gwalert_dict=MappingProxyType(dict(self.gwalert_dict)),
+            skymap=self.skymap
+        )
+
+
+    def submit(self, config: config.Config, verbose=False, checkpoint=None, only=None):
+        '''
+            Starts the artifact stages (all, or the ones named in only) for the current
+            path_info/gwalert_dict/skymap on the shared executor and returns their WriterJobs,
+            the Writer can be set up for the next alert (e.g. the ExtCoinc one) straight away
+        '''
+        stages = {
+            'skymap'   : self._write_skymap,
+            'moc'      : self._write_skymap_moc,
+            'contours' : self._write_contours,
+            'fermi'    : self._write_fermi,
+            'LAT'      : self._write_LAT,
+        }
+        if only is not None:
+            stages = {stage: func for stage, func in stages.items() if stage in only}
+        return WriterJobs(self.snapshot(), stages, config=config, verbose=verbose, checkpoint=checkpoint)
+
+
+    def submit_external_coinc(self, config: config.Config, verbose=False, checkpoint=None, only=None):
+        stages = {
+            'skymap'   : self._write_skymap,
+            'moc'      : self._write_skymap_moc,
+            'contours' : self._write_contours,
+        }
+        if only is not None:
+            stages = {stage: func for stage, func in stages.items() if stage in only}
+        return WriterJobs(self.snapshot(), stages, config=config, verbose=verbose, checkpoint=checkpoint)
+
+
     def process(self, config: config.Config, verbose=False):
-        self._write_skymap(config=config, verbose=verbose)
-        self._write_skymap_moc(config=config, verbose=verbose)
-        self._write_contours(config=config, verbose=verbose)
-        self._write_fermi(config=config, verbose=verbose)
-        self._write_LAT(config=config, verbose=verbose)
+        self.submit(config=config, verbose=verbose).wait()
 
 
     def process_external_coinc(self, config: config.Config, verbose=False):
-        self._write_skymap(config=config, verbose=verbose)
-        self._write_skymap_moc(config=config, verbose=verbose)
-        self._write_contours(config=config, verbose=verbose)
+        self.submit_external_coinc(config=config, verbose=verbose).wait()
+
+
+    def _write_skymap(self, ctx: WriterContext, config: config.Config, verbose=False):
+        skymap_url = ctx.gwalert_dict['skymap_fits_url']
+        if self.write_to_s3:
+            writepath = '{}/{}.fits.gz'.format(self.s3path, ctx.path_info)
+        else:
+            writepath = os.path.join(os.getcwd(), 'skymaps', f"{ctx.path_info}.fits.gz")
+
+        with self._fetch_lock:
+            return self._fetch_skymap(skymap_url, writepath, config=config, verbose=verbose)
 
 
-    def _write_skymap(self, config: config.Config, verbose=False):
+    def _fetch_skymap(self, skymap_url, writepath, config: config.Config, verbose=False):
+        #the same GraceDB file (e.g. for the ExtCoinc alert) is copied rather than downloaded again
+        if skymap_url in self.fetched_skymaps:
+            if verbose:
+                print('Copying already downloaded skymap.fits.gz')
+            if self.write_to_s3:
+                gwstorage.get_uploader(config).copy(self.fetched_skymaps[skymap_url], writepath)
+            else:
+                shutil.copyfile(self.fetched_skymaps[skymap_url], writepath)
+            return
+
         if verbose:
             print('Downloading skymap_fits_url')
 
         try:
-            r = requests.get(self.gwalert_dict['skymap_fits_url'])
+            r = requests.get(skymap_url, stream=True, timeout=config.GRACEDB_TIMEOUT)
         except Exception:
-            print(f"Bad skymap URL! {self.gwalert_dict['skymap_fits_url']} Gracedb might be bogged")
-            return
-        
-        if self.write_to_s3:
-            if verbose:
-                print('Writing skymap.fits.gz to s3')
-            downloadpath = '{}/{}.fits.gz'.format(self.s3path, self.path_info)
-            gwstorage.upload_gwtm_file(r.content, downloadpath, source=config.STORAGE_BUCKET_SOURCE, config=config)
-        else:
+            print(f"Bad skymap URL! {skymap_url} Gracedb might be bogged")
+            return False
+
+        with r:
+            if r.status_code != 200:
+                print(f"Bad skymap URL! {skymap_url} returned {r.status_code}")
+                return False
+
             if verbose:
-                print('Writing skymap.fits.gz to local')
-            local_write_path = os.path.join(os.getcwd(), 'skymaps', f"{self.path_info}.fits.gz")
-            with open(local_write_path, 'wb') as f:
-                f.write(r.content)
+                print(f"Streaming skymap.fits.gz to {'s3' if self.write_to_s3 else 'local'}")
+            chunks = r.iter_content(chunk_size=SKYMAP_CHUNK_SIZE)
+            if self.write_to_s3:
+                gwstorage.get_uploader(config).upload_stream(chunks, writepath)
+            else:
+                with open(writepath, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
 
+        self.fetched_skymaps[skymap_url] = writepath
 
-    def _write_skymap_moc(self, config: config.Config, verbose=False):
+
+    def _write_skymap_moc(self, ctx: WriterContext, config: config.Config, verbose=False):
 
         if self.write_to_s3:
             if verbose:
                 print('Writing skymap_moc.fits.gz to s3')
-            downloadpath = '{}/{}_moc.fits.gz'.format(self.s3path, self.path_info)
-            gwstorage.upload_gwtm_file(self.skymap, downloadpath, source=config.STORAGE_BUCKET_SOURCE, config=config)
+            downloadpath = '{}/{}_moc.fits.gz'.format(self.s3path, ctx.path_info)
+            gwstorage.get_uploader(config).upload(ctx.skymap.bytes, downloadpath)
         else:
             if verbose:
                 print('Writing skymap_moc.fits.gz to local')
-            local_write_path = os.path.join(os.getcwd(), 'skymaps', f"{self.path_info}_moc.fits.gz")
+            local_write_path = os.path.join(os.getcwd(), 'skymaps', f"{ctx.path_info}_moc.fits.gz")
             with open(local_write_path, 'wb') as f:
-                f.write(self.skymap) #type: ignore
+                f.write(ctx.skymap.bytes)
 
 
-    def _write_contours(self, config: config.Config, verbose=False):
+    def _write_contours(self, ctx: WriterContext, config: config.Config, verbose=False):
 
         if verbose:
             print('Calculating 90/50 contours')
 
-        tmp = tempfile.NamedTemporaryFile()
-        with open(tmp.name, 'wb') as f:
-            f.write(self.skymap)  #type: ignore
+        import ligo.skymap.postprocess  # type: ignore
 
-        prob, _ = ligo.skymap.io.fits.read_sky_map(tmp.name, nest=None)
-        prob = interpolate_nested(prob, nest=True)
-        i = np.flipud(np.argsort(prob))
-        cumsum = np.cumsum(prob[i])
-        cls = np.empty_like(prob)
-        cls[i] = cumsum * 100
+        cls = ctx.skymap.stats.credible_level_map()
         paths = list(ligo.skymap.postprocess.contour(cls, [50, 90], nest=True, degrees=True, simplify=True))
 
         contours_json = json.dumps({
@@ -157,24 +353,27 @@ class Writer():
             if verbose:
                 print('Writing contours to s3')
 
-            contour_download_path = '{}/{}-contours-smooth.json'.format(self.s3path, self.path_info)
-            gwstorage.upload_gwtm_file(contours_json.encode(), contour_download_path, config.STORAGE_BUCKET_SOURCE, config)
+            contour_download_path = '{}/{}-contours-smooth.json'.format(self.s3path, ctx.path_info)
+            gwstorage.get_uploader(config).upload(contours_json.encode(), contour_download_path)
         else:
             if verbose:
                 print('Writing contours to local')
 
-            local_write_path = os.path.join(os.getcwd(), 'contours', f"{self.path_info}-contours-smooth.json")
+            local_write_path = os.path.join(os.getcwd(), 'contours', f"{ctx.path_info}-contours-smooth.json")
             with open(local_write_path, 'wb') as f:
                 f.write(contours_json.encode())
 
 
-    def _write_fermi(self, config: config.Config, verbose=False):
+    def _write_fermi(self, ctx: WriterContext, config: config.Config, verbose=False):
         if verbose:
             print('Calculating Fermi contour map')
 
         try:
-            tos = datetime.datetime.strptime(self.gwalert_dict["time_of_signal"], "%Y-%m-%dT%H:%M:%S.%f")
-            earth_ra,earth_dec,earth_rad=function.getearthsatpos(tos)
+            from astropy.coordinates import SkyCoord  # type: ignore
+            from mocpy import MOC  # type: ignore
+
+            tos = datetime.datetime.strptime(ctx.gwalert_dict["time_of_signal"], "%Y-%m-%dT%H:%M:%S.%f")
+            earth_ra,earth_dec,earth_rad=function.getearthsatpos(tos, tle_cache=gw_cache.get_tle_cache(config))
             contour = function.makeEarthContour(earth_ra,earth_dec,earth_rad)
             skycoord = SkyCoord(contour, unit="deg", frame="icrs")
 
@@ -184,18 +383,18 @@ class Writer():
             moc_string = json.dumps(mocfootprint)
         except Exception:
             print("Error in Fermi MOC creation")
-            return
+            return False
 
         if self.write_to_s3:
             if verbose:
                 print('Writing Fermi contour to s3')
-            fermi_moc_upload_path = '{}/{}-Fermi.json'.format(self.s3path, self.gwalert_dict["graceid"])
-            dir_contents = gwstorage.list_gwtm_bucket(self.s3path, config.STORAGE_BUCKET_SOURCE, config)
-            if fermi_moc_upload_path not in dir_contents:
-                gwstorage.upload_gwtm_file(moc_string.encode(), fermi_moc_upload_path, config.STORAGE_BUCKET_SOURCE, config)
+            fermi_moc_upload_path = '{}/{}-Fermi.json'.format(self.s3path, ctx.gwalert_dict["graceid"])
+            uploader = gwstorage.get_uploader(config)
+            if not uploader.exists(fermi_moc_upload_path):
+                uploader.upload(moc_string.encode(), fermi_moc_upload_path)
 
         else:
-            local_write_file = os.path.join(os.getcwd(), "contours", f"{self.gwalert_dict['graceid']}-Fermi.json")
+            local_write_file = os.path.join(os.getcwd(), "contours", f"{ctx.gwalert_dict['graceid']}-Fermi.json")
             if os.path.exists(local_write_file):
                 if verbose:
                     print('Fermi File already exists')
@@ -208,14 +407,18 @@ class Writer():
                 f.write(moc_string.encode())
 
 
-    def _write_LAT(self, config: config.Config, verbose=False):
+    def _write_LAT(self, ctx: WriterContext, config: config.Config, verbose=False):
         
         if verbose:
             print('Calculating LAT contours')
 
-        tos = datetime.datetime.strptime(self.gwalert_dict["time_of_signal"], "%Y-%m-%dT%H:%M:%S.%f")
+        tos = datetime.datetime.strptime(ctx.gwalert_dict["time_of_signal"], "%Y-%m-%dT%H:%M:%S.%f")
         try:
-            ra, dec = function.getFermiPointing(tos)
+            from astropy.coordinates import SkyCoord  # type: ignore
+            from mocpy import MOC  # type: ignore
+
+            #started by gw_warmup.speculate when the skymap was parsed
+            ra, dec = gw_warmup.fermi_pointing(tos, config)
             pointing_footprint= function.makeLATFoV(ra,dec)
             skycoord = SkyCoord(pointing_footprint, unit="deg", frame="icrs")
             moc = MOC.from_polygon_skycoord(skycoord, max_depth=9)
@@ -223,19 +426,19 @@ class Writer():
             moc_string = json.dumps(mocfootprint)
         except Exception:
             print("Error in LAT creation")
-            return
+            return False
 
         if self.write_to_s3:
             if verbose:
                 print('Writing LAT contour to s3')
 
-            lat_moc_upload_path = '{}/{}-LAT.json'.format(self.s3path, self.gwalert_dict["graceid"])
-            dir_contents = gwstorage.list_gwtm_bucket(self.s3path, config.STORAGE_BUCKET_SOURCE, config)
-            if lat_moc_upload_path not in dir_contents:
-                gwstorage.upload_gwtm_file(moc_string.encode(), lat_moc_upload_path, config.STORAGE_BUCKET_SOURCE, config)
+            lat_moc_upload_path = '{}/{}-LAT.json'.format(self.s3path, ctx.gwalert_dict["graceid"])
+            uploader = gwstorage.get_uploader(config)
+            if not uploader.exists(lat_moc_upload_path):
+                uploader.upload(moc_string.encode(), lat_moc_upload_path)
         
         else:
-            local_write_file = os.path.join(os.getcwd(), "contours", f"{self.gwalert_dict['graceid']}-LAT.json")
+            local_write_file = os.path.join(os.getcwd(), "contours", f"{ctx.gwalert_dict['graceid']}-LAT.json")
             if os.path.exists(local_write_file):
                 if verbose:
                     print('LAT File already exists')
@@ -259,9 +462,9 @@ class Writer():
                 print("Writing alert json to s3")
 
             alert_upload_path = os.path.join(self.s3path, f"{self.path_info}_alert.json")
-            dir_contents = gwstorage.list_gwtm_bucket(self.s3path, config.STORAGE_BUCKET_SOURCE, config)
-            if alert_upload_path not in dir_contents:
-                gwstorage.upload_gwtm_file(self.alert.encode(), alert_upload_path, config.STORAGE_BUCKET_SOURCE, config)
+            uploader = gwstorage.get_uploader(config)
+            if not uploader.exists(alert_upload_path):
+                uploader.upload(self.alert.encode(), alert_upload_path)
         else:
             if verbose:
                 print("Writing alert json to local")
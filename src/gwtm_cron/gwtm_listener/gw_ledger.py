@@ -0,0 +1,184 @@
+import re
+import time
+import sqlite3
+import hashlib
+import datetime
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+    local record of the alerts posted to GWTM
+'''
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS alerts (
+        graceid      TEXT NOT NULL,
+        alert_type   TEXT NOT NULL,
+        payload_hash TEXT NOT NULL,
+        path_info    TEXT,
+        recorded     REAL,
+        PRIMARY KEY (graceid, alert_type, payload_hash)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS counts (
+        graceid    TEXT NOT NULL,
+        alert_type TEXT NOT NULL,
+        count      INTEGER NOT NULL,
+        checked    REAL,
+        PRIMARY KEY (graceid, alert_type)
+    )''',
+]
+
+SUPEREVENT_DATE = re.compile(r'^M?S(\d{6})')
+
+
+def payload_hash(alert):
+    if isinstance(alert, str):
+        alert = alert.encode('utf-8')
+    return hashlib.sha1(alert).hexdigest()
+
+
+def superevent_date(graceid):
+    '''
+        UTC day a superevent id (S240422ed, MS181101ab) was created, or None
+    '''
+    match = SUPEREVENT_DATE.match(graceid)
+    if match is None:
+        return None
+    try:
+        return datetime.datetime.strptime(match.group(1), '%y%m%d').replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+
+class AlertLedger(object):
+    '''
+        SQLite file with the alerts the listener posted, keyed by graceid, alert type and the
+        sha1 of the alert payload, and the number of posted alerts per graceid and alert type.
+
+        prior_alerts() answers how many alerts of a type a superevent already has without the
+        API, when the ledger knows: it has counted that graceid and type before, or the
+        superevent is younger than the ledger (so every alert it had went through it).
+        Otherwise it returns None and the caller asks the API, then seed()s the answer.
+        reconcile() checks a count against the API in the background and takes the API's
+        number when they differ
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+        self._conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', ('since', str(time.time())))
+        self.since = float(self._execute('SELECT value FROM meta WHERE key = ?', ('since',))[0][0])
+
+        self._reconciler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gwtm-ledger')
+
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+
+    def seen(self, graceid, alert_type, payload_hash):
+        '''
+            path_info an identical alert was posted under, or None
+        '''
+        rows = self._execute(
+            'SELECT path_info FROM alerts WHERE graceid = ? AND alert_type = ? AND payload_hash = ?',
+            (graceid, alert_type, payload_hash)
+        )
+        return rows[0][0] if len(rows) else None
+
+
+    def prior_alerts(self, graceid, alert_type):
+        rows = self._execute('SELECT count FROM counts WHERE graceid = ? AND alert_type = ?', (graceid, alert_type))
+        if len(rows):
+            return rows[0][0]
+
+        #the superevent id only has its day, so the ledger has to predate that whole day
+        created = superevent_date(graceid)
+        if created is not None and created.timestamp() >= self.since + 24*3600:
+            return 0
+        return None
+
+
+    def seed(self, graceid, alert_type, count):
+        self._execute(
+            'INSERT OR IGNORE INTO counts (graceid, alert_type, count, checked) VALUES (?, ?, ?, ?)',
+            (graceid, alert_type, count, time.time())
+        )
+
+
+    def record(self, graceid, alert_type, payload_hash, path_info, prior):
+        '''
+            A posted alert, prior being the count its path_info was built with. Recording the
+            same payload again (a resumed alert) does not count it twice
+        '''
+        with self._lock:
+            inserted = self._conn.execute(
+                'INSERT OR IGNORE INTO alerts (graceid, alert_type, payload_hash, path_info, recorded) VALUES (?, ?, ?, ?, ?)',
+                (graceid, alert_type, payload_hash, path_info, time.time())
+            ).rowcount
+            if not inserted:
+                return
+            self._conn.execute(
+                'INSERT INTO counts (graceid, alert_type, count) VALUES (?, ?, ?) '
+                'ON CONFLICT(graceid, alert_type) DO UPDATE SET count = count + 1',
+                (graceid, alert_type, prior + 1)
+            )
+
+
+    def reconcile(self, graceid, alert_type, query):
+        '''
+            Compares the count with len(query()) (the API's alerts) in the background. The
+            API's number is only taken if no alert was recorded for the graceid and type since
+        '''
+        expected = self.prior_alerts(graceid, alert_type)
+        return self._reconciler.submit(self._reconcile, graceid, alert_type, query, expected)
+
+
+    def _reconcile(self, graceid, alert_type, query, expected):
+        try:
+            count = len(query())
+        except Exception as e:
+            print(f"WARNING: could not reconcile {graceid} {alert_type} with the API: {e}")
+            return
+        if count == expected:
+            self._execute(
+                'UPDATE counts SET checked = ? WHERE graceid = ? AND alert_type = ?',
+                (time.time(), graceid, alert_type)
+            )
+            return
+
+        print(f"WARNING: ledger had {expected} {alert_type} alerts for {graceid}, the API has {count}")
+        with self._lock:
+            if expected is None:
+                self._conn.execute(
+                    'INSERT OR IGNORE INTO counts (graceid, alert_type, count, checked) VALUES (?, ?, ?, ?)',
+                    (graceid, alert_type, count, time.time())
+                )
+            else:
+                self._conn.execute(
+                    'UPDATE counts SET count = ?, checked = ? WHERE graceid = ? AND alert_type = ? AND count = ?',
+                    (count, time.time(), graceid, alert_type, expected)
+                )
+
+
+_ledgers: dict = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(path):
+    with _ledgers_lock:
+        ledger = _ledgers.get(path)
+        if ledger is None:
+            ledger = AlertLedger(path)
+            _ledgers[path] = ledger
+        return ledger
@@ -0,0 +1,43 @@
+'''
+    what ligo_alert.listen does for each alert type
+'''
+
+#every optional stage of an alert:
+#   prior_alerts : count the earlier alerts of the type, for the numbered path names (else the ledger's count or 0)
+#   alert_json   : archive the alert json
+#   skymap, moc, contours, fermi, LAT : the Writer artifacts
+#   galaxies     : rank and post the galaxy list
+#   ext_coinc    : the ExtCoinc artifacts (its alert is always posted)
+#   test_cleanup : del_test_alerts after test (MS) alerts
+STAGES = ['prior_alerts', 'alert_json', 'skymap', 'moc', 'contours', 'fermi', 'LAT', 'galaxies', 'ext_coinc', 'test_cleanup']
+
+#stages   : the optional stages that run
+#budget   : seconds to wait for the artifacts, after that the ones still pending are cancelled and running ones are left behind
+#priority : lower is more urgent, queued alerts of other superevents with a lower number go first
+DEFAULT_PROFILE = {
+    'stages'   : STAGES,
+    'budget'   : 600.0,
+    'priority' : 2,
+}
+
+ALERT_PROFILES = {
+    #only useful if it is out immediately
+    'Retraction'   : {'stages': ['alert_json'], 'budget': 1.0, 'priority': 0},
+    'EarlyWarning' : {'stages': ['prior_alerts', 'alert_json', 'moc', 'contours', 'test_cleanup'], 'budget': 30.0, 'priority': 1},
+    'Preliminary'  : {},
+    'Initial'      : {},
+    'Update'       : {},
+}
+
+
+def get_profile(alert_type, config=None):
+    '''
+        Profile for an alert type (as get_packet_type names it), the defaults above updated with
+        config.ALERT_PROFILES[alert_type]
+    '''
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(ALERT_PROFILES.get(alert_type, {}))
+    overrides = getattr(config, 'ALERT_PROFILES', None) or {}
+    profile.update(overrides.get(alert_type, {}))
+    profile['stages'] = frozenset(profile['stages'])
+    return profile
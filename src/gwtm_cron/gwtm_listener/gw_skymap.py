@@ -0,0 +1,164 @@
+import hashlib
+import threading
+import numpy as np
+import astropy_healpix as ah # type: ignore
+
+from base64 import b64decode
+from io import BytesIO
+from astropy import units as u # type: ignore
+from astropy.table import Table # type: ignore
+
+
+class ParsedSkymap(object):
+    '''
+        A multi-order skymap from an alert payload, decoded and parsed once and then
+        passed to every stage (alert fields, Writer artifacts, galaxy ranking)
+
+        bytes  : the raw FITS file, uploaded as the _moc.fits.gz artifact
+        table  : the astropy Table (UNIQ, PROBDENSITY, DISTMU, DISTSIGMA, DISTNORM)
+        header : the FITS header cards (table.meta)
+        stats  : the SkymapStats of the table, computed on first use
+        digest : sha1 of the bytes, identifies the map across alerts
+    '''
+    def __init__(self, skymap_bytes: bytes):
+        self.bytes = skymap_bytes
+        self.table = Table.read(BytesIO(skymap_bytes))
+        self.header = self.table.meta
+        self._stats = None
+        self._stats_lock = threading.Lock()
+        self._digest = None
+
+    @classmethod
+    def from_base64(cls, skymap_str):
+        return cls(b64decode(skymap_str))
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = SkymapStats.from_moc(self.table)
+            return self._stats
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.bytes).hexdigest()
+        return self._digest
+
+    def header_value(self, key, default):
+        return self.header[key] if key in self.header.keys() else default
+
+
+class SkymapStats(object):
+    '''
+        Probability summary of a skymap, sorted (most probable pixel first) and
+        accumulated once, then shared by the area, contour and galaxy ranking stages.
+        The input skymap is never modified.
+
+        prob       : probability contained in each pixel
+        key        : the value pixels are ranked by, PROBDENSITY for multi-order maps and
+                     prob for flattened maps, prob_cutoff values are on this scale
+        level/ipix : nested HEALPix order and pixel number of each pixel
+        pixel_area : steradians, per pixel for multi-order maps or a single value
+    '''
+    def __init__(self, prob, key, level, ipix, pixel_area, uniq=None):
+        self.prob = prob
+        self.key = key
+        self.level = level
+        self.ipix = ipix
+        self.pixel_area = pixel_area
+        self.uniq = uniq
+
+        self.sorted_index = np.argsort(key, kind='stable')[::-1]
+        self.cumprob = np.cumsum(prob[self.sorted_index])
+        self._credible_level_map = None
+
+    @classmethod
+    def from_moc(cls, skymap):
+        '''
+            From a multi-order (UNIQ, PROBDENSITY) skymap table
+        '''
+        uniq = np.asarray(skymap['UNIQ'], dtype=np.int64)
+        probdensity = np.asarray(skymap['PROBDENSITY'], dtype=np.float64)
+        level, ipix = ah.uniq_to_level_ipix(uniq)
+        pixel_area = ah.nside_to_pixel_area(ah.level_to_nside(level)).to_value(u.sr)
+        return cls(pixel_area * probdensity, probdensity, level, ipix, pixel_area, uniq=uniq)
+
+    @classmethod
+    def from_flat(cls, prob, nest=True):
+        '''
+            From a flattened all-sky probability map (NESTED ordering unless nest is False)
+        '''
+        nside = ah.npix_to_nside(len(prob))
+        level = int(np.log2(nside))
+        ipix = np.arange(len(prob))
+        if not nest:
+            ipix = ah.ring_to_nested(ipix, nside)
+        pixel_area = ah.nside_to_pixel_area(nside).to_value(u.sr)
+        return cls(prob, prob, level, ipix, pixel_area)
+
+    def __len__(self):
+        return len(self.prob)
+
+    def _level_at(self, i):
+        return self.level if np.isscalar(self.level) else self.level[i]
+
+    def max_prob_position(self):
+        '''
+            (ra, dec) of the pixel with the highest probability density
+        '''
+        i = np.argmax(self.key)
+        return ah.healpix_to_lonlat(self.ipix[i], ah.level_to_nside(self._level_at(i)), order='nested')
+
+    def n_credible(self, credible_level):
+        '''
+            Number of most probable pixels needed to enclose credible_level of the probability
+        '''
+        return int(self.cumprob.searchsorted(credible_level))
+
+    def area(self, credible_level):
+        '''
+            Sky area (astropy Quantity, sr) of the credible_level region
+        '''
+        n = self.n_credible(credible_level)
+        if np.isscalar(self.pixel_area):
+            return n * self.pixel_area * u.sr
+        return self.pixel_area[self.sorted_index[:n]].sum() * u.sr
+
+    def prob_cutoff(self, credible_level):
+        '''
+            key value of the last (least probable) pixel needed to enclose credible_level,
+            pixels with key >= prob_cutoff make up the credible region
+        '''
+        n = min(self.n_credible(credible_level), len(self) - 1)
+        return self.key[self.sorted_index[n]]
+
+    def credible_levels(self):
+        '''
+            Credible level (0-1) of every pixel, in the order of the input map
+        '''
+        cls = np.empty_like(self.cumprob)
+        cls[self.sorted_index] = self.cumprob
+        return cls
+
+    def credible_level_map(self):
+        '''
+            Credible level (percent) of each pixel of the flattened, smoothed NESTED map used
+            for the 50/90 contours. Built on first use and cached
+        '''
+        if self._credible_level_map is None:
+            from ligo.skymap.bayestar import rasterize # type: ignore
+            from ligo.skymap.healpix_tree import interpolate_nested # type: ignore
+
+            if self.uniq is not None:
+                prob = np.asarray(rasterize(Table({'UNIQ': self.uniq, 'PROBDENSITY': self.key}))['PROB'])
+            else:
+                prob = np.empty_like(self.prob)
+                prob[self.ipix] = self.prob
+            prob = interpolate_nested(prob, nest=True)
+            i = np.flipud(np.argsort(prob))
+            cumsum = np.cumsum(prob[i])
+            cls = np.empty_like(prob)
+            cls[i] = cumsum * 100
+            self._credible_level_map = cls
+        return self._credible_level_map
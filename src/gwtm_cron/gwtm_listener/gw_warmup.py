@@ -0,0 +1,179 @@
+import time
+import datetime
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from . import gw_cache
+    from . import gw_api
+    from . import gwstorage
+    from . import gw_function as function
+except ImportError:
+    import gw_cache # type: ignore
+    import gw_api # type: ignore
+    import gwstorage # type: ignore
+    import gw_function as function # type: ignore
+
+'''
+    getting ready for alerts before they need it: preload() loads what every alert shares when
+    the listener starts, speculate() starts the galaxy candidates and Fermi pointing of an alert
+    in the background as soon as its skymap is parsed, for its galaxy and LAT stages (and later
+    alerts repeating the map or time of signal) to pick up
+'''
+
+
+class SpeculativeCache(object):
+    '''
+        Results by key, each computed once: get(key, func) runs func for a new key, callers
+        asking for the key while it runs wait for that run, later ones get its result.
+        Failed runs and None results are not kept, and only the size most recently used keys are
+    '''
+    def __init__(self, size):
+        self.size = size
+        self._results: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._results
+
+
+    def get(self, key, func):
+        with self._lock:
+            future = self._results.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._results[key] = future
+                while len(self._results) > self.size:
+                    self._results.popitem(last=False)
+            else:
+                self._results.move_to_end(key)
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            self._discard(key, future)
+            future.set_exception(e)
+            raise
+        if result is None:
+            self._discard(key, future)
+        future.set_result(result)
+        return result
+
+
+    def _discard(self, key, future):
+        with self._lock:
+            if self._results.get(key) is future:
+                del self._results[key]
+
+
+#find_galaxies.GalaxyCandidates by sky map, and (ra, dec) of the LAT pointing by time of signal
+candidates = SpeculativeCache(8)
+fermi_pointings = SpeculativeCache(64)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='gwtm-warmup')
+        return _executor
+
+
+def _find_galaxies():
+    try:
+        from . import find_galaxies as fg
+    except ImportError:
+        import find_galaxies as fg # type: ignore
+    return fg
+
+
+def _run(what, func):
+    start = time.time()
+    try:
+        func()
+    except Exception as e:
+        print(f"WARNING: could not prepare the {what}: {e}")
+        return False
+    print(f"INFO: prepared the {what} in {time.time() - start:.2f}s")
+    return True
+
+
+def fermi_pointing(timestamp, config):
+    '''
+        function.getFermiPointing at timestamp from config's FT2 cache, looked up once per time
+    '''
+    return fermi_pointings.get(
+        (config.CACHE_DIR, timestamp),
+        lambda: function.getFermiPointing(timestamp, ft2_cache=gw_cache.get_ft2_cache(config))
+    )
+
+
+def _load_catalog(config):
+    fg = _find_galaxies()
+    catalog = fg.load_catalog(fg.get_catalog_path(fg.read_galaxy_config(config.PATH_TO_GALAXY_CATALOG_CONFIG)))
+    return catalog.index
+
+
+def _load_ft2(config):
+    ft2_cache = gw_cache.get_ft2_cache(config)
+    return ft2_cache.pointing(ft2_cache.latest_week())
+
+
+def preload(config, galaxies=True, fermi=True):
+    '''
+        Loads the resources every alert shares, so the first one does not pay for them: the
+        galaxy catalog and its pixel index, the Fermi TLE and the latest FT2 pointing file,
+        and the API and storage clients, with a connection to the API opened. Steps that fail
+        are reported and left for the alerts to retry
+    '''
+    steps = []
+    if galaxies:
+        steps.append(('galaxy catalog', lambda: _load_catalog(config)))
+    if fermi:
+        steps.append(('Fermi TLE', lambda: gw_cache.get_tle_cache(config).get()))
+        steps.append(('Fermi FT2 pointing', lambda: _load_ft2(config)))
+    steps.append(('API connection', lambda: gw_api.get_api_client(config).connect()))
+    steps.append(('storage client', lambda: gwstorage.get_uploader(config)))
+
+    return {what: _run(what, func) for what, func in steps}
+
+
+def speculate(gwa, skymap, config, stages):
+    '''
+        Starts, in the background, the galaxy candidates of skymap and the Fermi pointing at the
+        alert's time_of_signal, into candidates and fermi_pointings, when the alert's stages
+        (gw_profiles) include galaxies and LAT. They run alongside the alert's posts and
+        artifacts, its galaxy and LAT stages then wait for them instead of starting them, and
+        alerts repeating the map or time get them from the cache. Returns the futures
+    '''
+    gwa = dict(gwa)
+    executor = _get_executor()
+    jobs = []
+
+    def _galaxies():
+        fg = _find_galaxies()
+        galaxy_config = fg.read_galaxy_config(config.PATH_TO_GALAXY_CATALOG_CONFIG)
+        fg.galaxy_candidates(fg.EventLocalization(gwa), galaxy_config, skymap=skymap)
+
+    if 'galaxies' in stages:
+        jobs.append(executor.submit(_run, f"galaxy candidates of {gwa['graceid']}", _galaxies))
+
+    try:
+        tos = datetime.datetime.strptime(gwa["time_of_signal"], "%Y-%m-%dT%H:%M:%S.%f")
+    except (KeyError, ValueError):
+        tos = None
+    if 'LAT' in stages and tos is not None:
+        jobs.append(executor.submit(_run, f"Fermi pointing of {gwa['graceid']}", lambda: fermi_pointing(tos, config)))
+
+    return jobs
@@ -1,3 +1,10 @@
+import os
+import json
+import time
+import uuid
+import queue
+import shutil
+import threading
 import fsspec  # type: ignore
 
 def _get_fs(source, config):
@@ -10,66 +17,473 @@ def _get_fs(source, config):
         raise Exception(f"Error in creating {source} filesystem")
 
 
-def download_gwtm_file(filename, source='s3', config=None, decode=True):
+def _bucket_path(filename, source, config):
+    if source=="s3" and f"{config.AWS_BUCKET}/" not in filename:
+        return f"{config.AWS_BUCKET}/{filename}"
+    return filename
 
-    try:
-        if source == 's3':
-            s3file = fsspec.open(f"s3://{config.AWS_BUCKET}/{filename}")
 
-        if source == 'abfs':
-            s3file = fsspec.open(f"abfs://{filename}", "rb", account_name=config.AZURE_ACCOUNT_NAME, account_key=config.AZURE_ACCOUNT_KEY)
+class KeyManifest(object):
+    '''
+        Locally persisted set of keys known to exist in the bucket, so existence checks for
+        them don't need the network. The file is append only, one "+source://key" or
+        "-source://key" line per upload or delete
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._keys = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._keys is None:
+            self._keys = set()
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    for line in f:
+                        line = line.rstrip('\n')
+                        if line.startswith('+'):
+                            self._keys.add(line[1:])
+                        elif line.startswith('-'):
+                            self._keys.discard(line[1:])
+        return self._keys
+
+    def _record(self, op, key):
+        with open(self.path, 'a') as f:
+            f.write(f"{op}{key}\n")
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._load()
+
+    def add(self, key):
+        with self._lock:
+            keys = self._load()
+            if key not in keys:
+                keys.add(key)
+                self._record('+', key)
+
+    def discard(self, key):
+        with self._lock:
+            keys = self._load()
+            if key in keys:
+                keys.discard(key)
+                self._record('-', key)
+
+
+_manifests: dict = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(config):
+    '''
+        The KeyManifest at config.STORAGE_MANIFEST_PATH, None when it is not configured
+    '''
+    path = getattr(config, 'STORAGE_MANIFEST_PATH', '')
+    if not path:
+        return None
+    with _manifests_lock:
+        if path not in _manifests:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            _manifests[path] = KeyManifest(path)
+        return _manifests[path]
+
+
+class StorageClient(object):
+    '''
+        One bucket backend (s3 or abfs) for one set of credentials. The fsspec filesystem, and
+        with it the connection pool, is created once and shared by every operation and thread.
+        get_client() hands out one client per backend and credentials per process
+
+        stats() returns per operation counts, errors and latency, and stats_hook (if set) is
+        called as stats_hook(source, op, seconds, ok) after every operation
+    '''
+    stats_hook = None
+
+    def __init__(self, source, config):
+        self.source = source
+        self.config = config
+        self.fs = _get_fs(source=source, config=config)
+
+        self._stats_lock = threading.Lock()
+        self._stats: dict = {}
+
+
+    def _timed(self, op, func, *args):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = func(*args)
+            ok = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                op_stats = self._stats.setdefault(op, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                op_stats['count'] += 1
+                op_stats['errors'] += 0 if ok else 1
+                op_stats['seconds'] += elapsed
+                op_stats['max_seconds'] = max(op_stats['max_seconds'], elapsed)
+            if StorageClient.stats_hook is not None:
+                StorageClient.stats_hook(self.source, op, elapsed, ok)
+
+
+    def stats(self):
+        '''
+            {op: {count, errors, seconds, max_seconds}}
+        '''
+        with self._stats_lock:
+            ret = {op: dict(op_stats) for op, op_stats in self._stats.items()}
+        return ret
+
+
+    def _manifest_add(self, filename):
+        manifest = get_manifest(self.config)
+        if manifest is not None:
+            manifest.add(f"{self.source}://{filename}")
+
+
+    def exists(self, filename):
+        '''
+            Whether filename is in the bucket, answered from the manifest when it already knows
+            the key, otherwise with a single metadata request (no listing)
+        '''
+        filename = _bucket_path(filename, self.source, self.config)
+        manifest = get_manifest(self.config)
+        if manifest is not None and f"{self.source}://{filename}" in manifest:
+            return True
 
-        with s3file as _file:
-            if decode:
-                return _file.read().decode('utf-8')
-            else:
+        exists = self._timed('exists', self.fs.exists, filename)
+        if exists:
+            self._manifest_add(filename)
+        return exists
+
+
+    def download(self, filename, decode=True):
+        def _read():
+            with self.fs.open(_bucket_path(filename, self.source, self.config), "rb") as _file:
                 return _file.read()
 
-    except Exception:
-        raise Exception(f"Error reading {source} file: {filename}")
-            
+        try:
+            content = self._timed('download', _read)
+        except Exception:
+            raise Exception(f"Error reading {self.source} file: {filename}")
+        return content.decode('utf-8') if decode else content
+
+
+    def upload(self, content, filename):
+        filename = _bucket_path(filename, self.source, self.config)
+
+        def _write():
+            with self.fs.open(filename, "wb") as of:
+                of.write(content)
+
+        self._timed('upload', _write)
+        self._manifest_add(filename)
+        return True
+
+
+    def upload_stream(self, chunks, filename):
+        filename = _bucket_path(filename, self.source, self.config)
+
+        def _write():
+            with self.fs.open(filename, "wb") as of:
+                for chunk in chunks:
+                    if chunk:
+                        of.write(chunk)
+
+        self._timed('upload_stream', _write)
+        self._manifest_add(filename)
+        return True
+
+
+    def copy(self, src, dst):
+        src = _bucket_path(src, self.source, self.config)
+        dst = _bucket_path(dst, self.source, self.config)
+
+        self._timed('copy', self.fs.copy, src, dst)
+        self._manifest_add(dst)
+        return True
+
+
+    def list(self, container):
+        if self.source == 's3':
+            bucket = self.config.AWS_BUCKET
+            bucket_content = self._timed('list', self.fs.ls, f"{bucket}/{container}", False)
+            ret = []
+            for b in bucket_content:
+                split_b = b.split(f"{bucket}/")[1]
+                if split_b != f"{container}/":
+                    ret.append(split_b)
+            return sorted(ret)
+
+        ret = self._timed('list', self.fs.ls, container, False)
+        return sorted(ret)
+
+
+    def delete(self, keys):
+        if isinstance(keys, list):
+            keys = [_bucket_path(k, self.source, self.config) for k in keys]
+        else:
+            keys = _bucket_path(keys, self.source, self.config)
+
+        self._timed('delete', self.fs.rm, keys)
+
+        manifest = get_manifest(self.config)
+        if manifest is not None:
+            for k in (keys if isinstance(keys, list) else [keys]):
+                manifest.discard(f"{self.source}://{k}")
+        return True
+
+
+_clients: dict = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(source="s3", config=None):
+    if source == 's3':
+        credentials = (config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY, config.AWS_BUCKET)
+    else:
+        credentials = (config.AZURE_ACCOUNT_NAME, config.AZURE_ACCOUNT_KEY)
+
+    with _clients_lock:
+        client = _clients.get((source, credentials))
+        if client is None:
+            client = StorageClient(source, config)
+            _clients[(source, credentials)] = client
+        return client
+
+
+class UploadQueue(object):
+    '''
+        Write-behind uploads. Each payload is written to spool_dir (a .data file plus a .json
+        job description) and upload()/upload_stream()/copy() return straight away, worker
+        threads then do the uploads through the StorageClient, at most `workers` at a time.
+
+        Failed uploads are retried with exponential backoff, after max_retries a job is
+        parked on disk and picked up again by retry_failed(), every retry_interval seconds,
+        or the next start, so nothing is lost while the bucket is unreachable. flush() waits
+        for everything queued so far
+    '''
+    def __init__(self, spool_dir, source, config, workers=4, max_retries=8, backoff=2.0, max_backoff=300.0, retry_interval=900.0):
+        self.spool_dir = spool_dir
+        self.source = source
+        self.config = config
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_interval = retry_interval
+        self.client = get_client(source, config)
+
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Condition()
+        self._pending: dict = {}
+        self._failed: dict = {}
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self._recover()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f'gwtm-upload-{i}', daemon=True).start()
+        threading.Thread(target=self._retry_parked, name='gwtm-upload-retry', daemon=True).start()
+
+
+    def _paths(self, job_id):
+        return os.path.join(self.spool_dir, f"{job_id}.data"), os.path.join(self.spool_dir, f"{job_id}.json")
+
+
+    def _write_job(self, job):
+        _, meta_path = self._paths(job['id'])
+        with open(f"{meta_path}.tmp", 'w') as f:
+            json.dump(job, f)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+
+    def _submit(self, job):
+        self._write_job(job)
+        with self._lock:
+            self._pending[job['id']] = job
+        self._queue.put(job['id'])
+        return job['id']
+
+
+    def _recover(self):
+        for f in sorted(os.listdir(self.spool_dir)):
+            if f.endswith('.json'):
+                with open(os.path.join(self.spool_dir, f)) as meta:
+                    job = json.load(meta)
+                job['attempts'] = 0
+                self._pending[job['id']] = job
+                self._queue.put(job['id'])
+
+
+    def upload(self, content, filename):
+        job_id = uuid.uuid4().hex
+        data_path, _ = self._paths(job_id)
+        with open(data_path, 'wb') as f:
+            f.write(content)
+        return self._submit({'id': job_id, 'kind': 'upload', 'filename': filename, 'attempts': 0})
+
+
+    def upload_stream(self, chunks, filename):
+        job_id = uuid.uuid4().hex
+        data_path, _ = self._paths(job_id)
+        with open(data_path, 'wb') as f:
+            for chunk in chunks:
+                if chunk:
+                    f.write(chunk)
+        return self._submit({'id': job_id, 'kind': 'upload', 'filename': filename, 'attempts': 0})
+
+
+    def copy(self, src, dst):
+        '''
+            Copies src to dst, from the spooled data when src is still waiting to be uploaded
+        '''
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            src_job = next((j for j in list(self._pending.values()) + list(self._failed.values())
+                            if j['kind'] == 'upload' and j['filename'] == src), None)
+            if src_job is not None:
+                shutil.copyfile(self._paths(src_job['id'])[0], self._paths(job_id)[0])
+        if src_job is not None:
+            return self._submit({'id': job_id, 'kind': 'upload', 'filename': dst, 'attempts': 0})
+        return self._submit({'id': job_id, 'kind': 'copy', 'src': src, 'filename': dst, 'attempts': 0})
+
+
+    def is_pending(self, filename):
+        with self._lock:
+            return any(j['filename'] == filename for j in list(self._pending.values()) + list(self._failed.values()))
+
+
+    def exists(self, filename):
+        return self.is_pending(filename) or self.client.exists(filename)
+
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._pending.get(job_id)
+            if job is None:
+                continue
+
+            data_path, meta_path = self._paths(job_id)
+            try:
+                if job['kind'] == 'copy':
+                    self.client.copy(job['src'], job['filename'])
+                else:
+                    with open(data_path, 'rb') as f:
+                        self.client.upload(f.read(), job['filename'])
+            except Exception as e:
+                job['attempts'] += 1
+                self._write_job(job)
+                if job['attempts'] >= self.max_retries:
+                    print(f"WARNING: giving up on uploading {job['filename']} for now after {job['attempts']} attempts: {e}")
+                    with self._lock:
+                        self._failed[job_id] = self._pending.pop(job_id)
+                        self._lock.notify_all()
+                else:
+                    delay = min(self.backoff * 2**(job['attempts'] - 1), self.max_backoff)
+                    print(f"WARNING: upload of {job['filename']} failed ({e}), retrying in {delay:.0f}s")
+                    timer = threading.Timer(delay, self._queue.put, args=(job_id,))
+                    timer.daemon = True
+                    timer.start()
+                continue
+
+            with self._lock:
+                for path in (data_path, meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._pending.pop(job_id, None)
+                self._lock.notify_all()
+
+
+    def _retry_parked(self):
+        while True:
+            time.sleep(self.retry_interval)
+            with self._lock:
+                parked = len(self._failed)
+            if parked:
+                print(f"INFO: retrying {parked} parked uploads")
+                self.retry_failed()
+
+
+    def retry_failed(self):
+        with self._lock:
+            failed, self._failed = self._failed, {}
+            for job_id, job in failed.items():
+                job['attempts'] = 0
+                self._pending[job_id] = job
+                self._queue.put(job_id)
+
+
+    def flush(self, timeout=None):
+        '''
+            Waits until every upload queued so far is done (or parked after max_retries),
+            returns False if timeout runs out first
+        '''
+        with self._lock:
+            return self._lock.wait_for(lambda: len(self._pending) == 0, timeout=timeout)
+
+
+_upload_queues: dict = {}
+
+
+def get_uploader(config):
+    '''
+        Where the Writer sends its artifacts, the UploadQueue for config.UPLOAD_QUEUE_DIR when
+        that is set, otherwise the StorageClient itself (uploads block until done). Both have
+        upload, upload_stream, copy and exists
+    '''
+    source = config.STORAGE_BUCKET_SOURCE
+    spool_dir = getattr(config, 'UPLOAD_QUEUE_DIR', '')
+    if not spool_dir:
+        return get_client(source, config)
+
+    with _clients_lock:
+        uploader = _upload_queues.get((spool_dir, source))
+        if uploader is None:
+            uploader = UploadQueue(
+                os.path.join(spool_dir, source), source, config,
+                workers=config.UPLOAD_WORKERS, max_retries=config.UPLOAD_MAX_RETRIES,
+                retry_interval=config.UPLOAD_RETRY_INTERVAL
+            )
+            _upload_queues[(spool_dir, source)] = uploader
+        return uploader
+
+
+def flush_uploads(timeout=None):
+    return all([uploader.flush(timeout=timeout) for uploader in list(_upload_queues.values())])
+
+
+def exists_gwtm_file(filename, source="s3", config=None):
+    return get_client(source, config).exists(filename)
+
+
+def download_gwtm_file(filename, source='s3', config=None, decode=True):
+    return get_client(source, config).download(filename, decode=decode)
 
 
 def upload_gwtm_file(content, filename, source="s3", config=None):
-    fs = _get_fs(source=source, config=config)
+    return get_client(source, config).upload(content, filename)
+
+
+def upload_gwtm_stream(chunks, filename, source="s3", config=None):
+    '''
+        Like upload_gwtm_file, for content that arrives in pieces (e.g. a streamed http response),
+        each chunk is written as it comes instead of holding the whole file in memory
+    '''
+    return get_client(source, config).upload_stream(chunks, filename)
 
-    if source=="s3" and f"{config.AWS_BUCKET}/" not in filename:
-        filename = f"{config.AWS_BUCKET}/{filename}"
 
-    open_file = fs.open(filename, "wb") 
-    with open_file as of:
-        of.write(content)
-    of.close()
-    return True
+def copy_gwtm_file(src, dst, source="s3", config=None):
+    return get_client(source, config).copy(src, dst)
 
 
 def list_gwtm_bucket(container, source="s3", config=None):
-    fs = _get_fs(source=source, config=config)
-    if source == 's3':
-        bucket_content = fs.ls(f"{config.AWS_BUCKET}/{container}")
-        ret = []
-        for b in bucket_content:
-            split_b = b.split(f"{config.AWS_BUCKET}/")[1]
-            if split_b != f"{container}/":
-                ret.append(split_b)
-        return sorted(ret)
-    
-    ret = fs.ls(container)
-    return sorted(ret)
+    return get_client(source, config).list(container)
 
 
 def delete_gwtm_files(keys, source="s3", config=None):
-    if source=="s3":
-        if isinstance(keys, list):
-            for i,k in enumerate(keys):
-                if f"{config.AWS_BUCKET}/" not in k:
-                    keys[i] = f"{config.AWS_BUCKET}/{k}"
-        if isinstance(keys, str) and f"{config.AWS_BUCKET}/" not in keys:
-            keys = f"{config.AWS_BUCKET}/{keys}"
-    
-    fs = _get_fs(source=source, config=config)
-    fs.rm(keys)
-    return True
+    return get_client(source, config).delete(keys)
 
 
 def get_fname(fullname):
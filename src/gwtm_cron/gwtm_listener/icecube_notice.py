@@ -4,14 +4,28 @@ try:
     from . import listener
     from . import gw_config as config
     from . import gw_function as function
+    from . import gw_checkpoint
+    from . import gw_warmup
 except ImportError:
     # If running as a script, import from the parent directory
     import listener # type: ignore
     import gw_config as config # type: ignore
     import gw_function as function # type: ignore
+    import gw_checkpoint # type: ignore
+    import gw_warmup # type: ignore
 
 
-def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_run=False, alertname=None):
+def warmup(config=None):
+    '''
+        Opens the API and storage clients, the notices need nothing else
+    '''
+    if config is not None:
+        gw_warmup.preload(config, galaxies=False, fermi=False)
+
+
+def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_run=False, alertname=None, checkpoint=None, superseded=None):
+    if checkpoint is None:
+        checkpoint = gw_checkpoint.NoCheckpoint()
 
     record = json.loads(alert)
     rkeys = record.keys()
@@ -96,7 +110,7 @@ def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_r
 
     if not dry_run and len(icecube_coincident_events):
         print(icecube_notice, icecube_coincident_events)
-        function.post_icecube_notice(icecube_notice, icecube_coincident_events, config)
+        checkpoint.run('post_notice', lambda: function.post_icecube_notice(icecube_notice, icecube_coincident_events, config))
     elif verbose:
         print("Not ingesting")
     
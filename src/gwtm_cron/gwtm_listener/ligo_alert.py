@@ -1,11 +1,12 @@
+import os
 import json
+import time
 import datetime
-import requests # type: ignore
+import threading
+
+from collections import deque
 
 
-from base64 import b64decode
-from io import BytesIO
-from astropy.table import Table # type: ignore
 from astropy import units as u # type: ignore
 
 try:
@@ -13,19 +14,155 @@ try:
     from . import gw_config as config
     from . import gw_function as function
     from . import gw_io as io
-    from . import find_galaxies as fg
+    from . import gw_skymap
+    from . import gw_checkpoint
+    from . import gw_ledger
+    from . import gw_profiles
+    from . import gw_warmup
 except ImportError:
     # If running as a script, import from the parent directory
     import listener # type: ignore
     import gw_config as config # type: ignore
     import gw_function as function # type: ignore
     import gw_io as io # type: ignore
-    import find_galaxies as fg # type: ignore
+    import gw_skymap # type: ignore
+    import gw_checkpoint # type: ignore
+    import gw_ledger # type: ignore
+    import gw_profiles # type: ignore
+    import gw_warmup # type: ignore
 
 # from find_galaxies import EventLocalization,generate_galaxy_list
 
 
-def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_run=False, alertname=None):
+def _find_galaxies():
+    #healpy and the catalog code, only needed by the galaxies stage
+    try:
+        from . import find_galaxies as fg
+    except ImportError:
+        import find_galaxies as fg # type: ignore
+    return fg
+
+
+def warmup(config=None):
+    '''
+        Imports what every stage of an alert needs, instead of on the first alert, and with a
+        config preloads the catalog, ephemeris caches and clients (gw_warmup.preload)
+    '''
+    io.warmup()
+    function.warmup()
+    _find_galaxies()
+    if config is not None:
+        gw_warmup.preload(config)
+
+
+#(seconds from receiving an alert to posting its record, seconds since LVK created it) of the latest alerts
+_first_posts: deque = deque(maxlen=1000)
+_first_posts_lock = threading.Lock()
+
+
+def _alert_age(record):
+    try:
+        created = datetime.datetime.fromisoformat(record['time_created'].replace('Z', '+00:00'))
+    except (KeyError, AttributeError, ValueError):
+        return None
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=datetime.timezone.utc)
+    return (datetime.datetime.now(datetime.timezone.utc) - created).total_seconds()
+
+
+def first_post_stats():
+    '''
+        Time to first post over the latest alerts: count, mean, max and last seconds from
+        listen() receiving an alert to its record being posted
+    '''
+    with _first_posts_lock:
+        seconds = [received for received, age in _first_posts]
+    if not len(seconds):
+        return {'count': 0}
+    return {'count': len(seconds), 'mean': sum(seconds)/len(seconds), 'max': max(seconds), 'last': seconds[-1]}
+
+
+def _post_alert(gwa, stage, config, checkpoint, received=None, record=None, ledger=None, posted=None):
+    '''
+        Posts gwa once per checkpoint, with received (the listen() start) the time to first
+        post is recorded. With a ledger, posted (payload hash, path_info, prior count) goes into
+        it as soon as the post succeeded, so the next alert numbers its paths after this one
+        even when a later stage of this alert fails
+    '''
+    resumed = checkpoint.done(stage)
+    response = checkpoint.run(stage, lambda: function.post_gwtm_alert(gwa, config=config))
+    if ledger is not None:
+        _record_post(ledger, gwa, posted, config)
+    if received is not None and not resumed:
+        seconds, age = time.perf_counter() - received, _alert_age(record)
+        with _first_posts_lock:
+            _first_posts.append((seconds, age))
+        created = f", {age:.1f}s after it was created" if age is not None else ""
+        print(f"INFO: {gwa['graceid']} {gwa['alert_type']} posted {seconds:.2f}s after it was received{created}")
+    return response
+
+
+def _record_post(ledger, gwa, posted, config):
+    graceid, alert_type = gwa['graceid'], gwa['alert_type']
+    alert_hash, path_info, prior = posted
+    ledger.record(graceid, alert_type, alert_hash, path_info, prior)
+    ledger.reconcile(graceid, alert_type, lambda: function.query_gwtm_alerts(graceid, alert_type, config=config))
+
+
+def _never_superseded():
+    return False
+
+
+def _get_ledger(config):
+    if not config.ALERT_LEDGER:
+        return None
+    path = config.ALERT_LEDGER_DB or os.path.join(config.CACHE_DIR, 'alerts.db')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    return gw_ledger.get_ledger(path)
+
+
+def _prior_alerts(graceid, alert_type, config, ledger, query=True):
+    '''
+        How many alert_type alerts graceid already has, from the ledger when it knows,
+        from the API otherwise (or 0 without query)
+    '''
+    prior = ledger.prior_alerts(graceid, alert_type) if ledger is not None else None
+    if prior is None and not query:
+        return 0
+    if prior is None:
+        prior = len(function.query_gwtm_alerts(graceid, alert_type, config=config))
+        if ledger is not None:
+            ledger.seed(graceid, alert_type, prior)
+    return prior
+
+
+def _path_info(graceid, alert_type, prior):
+    path_info = graceid + '-' + alert_type
+    if prior > 0:
+        path_info = path_info + str(prior)
+    return path_info
+
+
+def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_run=False, alertname=None, checkpoint=None, superseded=None):
+    '''
+        checkpoint: gw_checkpoint.AlertCheckpoint of the message, the stages it has recorded
+                    (path names, uploads, API posts) are not done again
+        superseded: returns True once a newer alert for the superevent has arrived, from then
+                    on the artifacts and galaxy list of this one are skipped (or cancelled),
+                    its alert json is still written and the alert still posted
+
+        With STAGED_INGEST the alert records (which only need the alert, the skymap header and
+        the skymap's GraceDB URL) are posted as soon as they are built, the galaxy list and artifacts follow. Otherwise
+        everything is posted once the artifacts are done
+
+        Which optional stages run, how long the artifacts may take and how urgent the alert is
+        depends on its type, see gw_profiles
+    '''
+    received = time.perf_counter()
+    if checkpoint is None:
+        checkpoint = gw_checkpoint.NoCheckpoint()
+    if superseded is None:
+        superseded = _never_superseded
         
     record = json.loads(alert)
 
@@ -44,6 +181,11 @@ def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_r
 
     gwa = {}
     ext_gwa = None
+    artifact_jobs = []
+    skymap = None
+    post_galaxies_json = None
+    staged = config.STAGED_INGEST and not dry_run
+    gwa_response, ext_gwa_response = None, None
 
     alert_keys = record.keys()
     gwa.update({
@@ -56,19 +198,28 @@ def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_r
     })
 
     gwa["alert_type"], gwa["packet_type"] = function.get_packet_type(gwa["alert_type"])
-
+    profile = gw_profiles.get_profile(gwa["alert_type"], config)
+    stages = profile['stages']
+
+    #test alerts are deleted from the API after each run, and alerts ingested under a given name bypass the ledger
+    ledger = _get_ledger(config) if alertname is None and not run_test else None
+    alert_hash = gw_ledger.payload_hash(alert)
+    if ledger is not None and not checkpoint.resumed:
+        duplicate = ledger.seen(gwa['graceid'], gwa['alert_type'], alert_hash)
+        if duplicate is not None:
+            print(f"INFO: identical alert already processed as {duplicate}, skipping")
+            return gwa, None
+
+    prior = 0
+    query = 'prior_alerts' in stages
     if alertname is None:
-        path_info = gwa["graceid"] + '-' + gwa["alert_type"]
-
-        alertinfo = function.query_gwtm_alerts(gwa['graceid'], gwa['alert_type'], config=config)
-
-        if len(alertinfo) > 0:
-            path_info = path_info + str(len(alertinfo))
+        #recorded, so a resumed alert keeps its names after it has been posted
+        prior = checkpoint.run('prior_alerts', lambda: _prior_alerts(gwa['graceid'], gwa['alert_type'], config, ledger, query=query))
+        path_info = _path_info(gwa['graceid'], gwa['alert_type'], prior)
     else:
         path_info = alertname
 
     writer.set_path_info(path_info=path_info)
-    writer.write_alert_json(config, verbose=verbose)
 
     if "event" in alert_keys and isinstance(record["event"], dict):
         event_keys = record["event"].keys()
@@ -112,53 +263,44 @@ def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_r
             })
 
         if "skymap" in event_keys:
-            skymap_str = record_event["skymap"]
-            skymap_bytes = b64decode(skymap_str)
-            skymap = Table.read(BytesIO(skymap_bytes))
-
-            ra, dec = function.get_skymap_avg_pos(skymap)
-            area_90, area_50 = function.get_skymap_90_50_area(skymap)
-
-            header = skymap.meta
-            header_keys = header.keys()
-
-            #This is dumb
-            skymap_url = None
-            map_files = ["cWB.fits.gz", "bilby.fits.gz", "bayestar.fits.gz"]
-            for mf in map_files:
-                mf_url = f"https://gracedb.ligo.org/api/superevents/{gwa['graceid']}/files/{mf}"
-                mf_r = requests.head(mf_url)
-                if mf_r.status_code == 200:
-                    skymap_url = mf_url
-                    break
-            if skymap_url is None:
-                skymap_url = "Invalid.Sky.Map.URL"
+            #the GraceDB probes run while the skymap is parsed, the alert records can not be
+            #changed once posted so they wait for the URL (at most SKYMAP_URL_DEADLINE)
+            skymap_url_job = function.resolve_skymap_url_later(gwa['graceid'], timeout=config.GRACEDB_TIMEOUT, deadline=config.SKYMAP_URL_DEADLINE)
+            skymap = gw_skymap.ParsedSkymap.from_base64(record_event["skymap"])
+
+            ra, dec = skymap.stats.max_prob_position()
+            area_90, area_50 = skymap.stats.area(0.9), skymap.stats.area(0.5)
 
             gwa.update({
-                "skymap_fits_url" : skymap_url,
+                "skymap_fits_url" : skymap_url_job.result(),
                 "avgra"           : ra.deg,
                 "avgdec"          : dec.deg,
                 "area_90"         : area_90.to_value(u.deg**2),
                 "area_50"         : area_50.to_value(u.deg**2),
-                "time_of_signal"  : header['DATE-OBS'] if 'DATE-OBS' in header_keys else '1991-12-23T19:15:00',
-                "distance"        : header['DISTMEAN'] if 'DISTMEAN' in header_keys else "-999.9",
-                "distance_error"  : header['DISTSTD'] if 'DISTSTD' in header_keys else "-999.9",
-                "timesent"        : header['DATE'] if 'DATE' in header_keys else '1991-12-23T19:15:00',
+                "time_of_signal"  : skymap.header_value('DATE-OBS', '1991-12-23T19:15:00'),
+                "distance"        : skymap.header_value('DISTMEAN', "-999.9"),
+                "distance_error"  : skymap.header_value('DISTSTD', "-999.9"),
+                "timesent"        : skymap.header_value('DATE', '1991-12-23T19:15:00'),
             })
-            
-            writer.set_gwalert_dict(gwa)
-            writer.set_skymap(skymap_bytes)
-            writer.process(config=config, verbose=verbose)
-
-            post_galaxies_json = None
-            try:
-                # create EventLocatlization object to be passed into the galaxies list
-                gwa_obj = fg.EventLocalization(gwa)
-                #makes galaxy list, posts to API
-                post_galaxies_json = fg.generate_galaxy_list(gwa_obj, galaxy_config_path=config.PATH_TO_GALAXY_CATALOG_CONFIG)
-                
-            except Exception as e:
-                print(e)
+
+    if staged:
+        gwa_response = _post_alert(
+            gwa, 'post_alert', config, checkpoint, received=received, record=record, ledger=ledger, posted=(alert_hash, path_info, prior)
+        )
+
+    if skymap is not None:
+        writer.set_gwalert_dict(gwa)
+        writer.set_skymap(skymap)
+        #the galaxy candidates and Fermi pointing start now, the galaxy and LAT stages below wait for them
+        if config.SPECULATIVE_WARMUP and not superseded():
+            gw_warmup.speculate(gwa, skymap, config, stages)
+        if superseded():
+            print(f"INFO: {path_info} is superseded by a newer alert, skipping its artifacts and galaxies")
+        else:
+            artifact_jobs.append(writer.submit(config=config, verbose=verbose, checkpoint=checkpoint, only=stages))
+
+    if 'alert_json' in stages:
+        checkpoint.run('alert_json', lambda: writer.write_alert_json(config, verbose=verbose))
         
     if "external_coinc" in alert_keys and record["external_coinc"] is not None:
         ext_coin = record["external_coinc"]
@@ -171,12 +313,8 @@ def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_r
 
         ext_gwa["alert_type"], ext_gwa["packet_type"] = function.get_packet_type(ext_gwa["alert_type"])
 
-        ext_path_info = ext_gwa["graceid"] + '-' + ext_gwa["alert_type"]
-
-        ext_alertinfo = function.query_gwtm_alerts(ext_gwa['graceid'], ext_gwa['alert_type'], config=config)
-
-        if len(ext_alertinfo) > 0:
-            ext_path_info = ext_path_info + str(len(ext_alertinfo))
+        ext_prior = checkpoint.run('ext_prior_alerts', lambda: _prior_alerts(ext_gwa['graceid'], ext_gwa['alert_type'], config, ledger, query=query))
+        ext_path_info = _path_info(ext_gwa['graceid'], ext_gwa['alert_type'], ext_prior)
 
         writer.set_path_info(path_info=ext_path_info)
 
@@ -192,42 +330,66 @@ def listen(config : config.Config, alert, write_to_s3=True, verbose=False, dry_r
 
         if "combined_skymap" in ext_coin_keys:
             
-            combined_skymap_str = ext_coin["combined_skymap"]
-            combined_skymap_bytes = b64decode(combined_skymap_str)
-            combined_skymap = Table.read(BytesIO(combined_skymap_bytes))
+            combined_skymap = gw_skymap.ParsedSkymap.from_base64(ext_coin["combined_skymap"])
 
-            ext_ra, ext_dec = function.get_skymap_avg_pos(combined_skymap)
-            ext_area_90, ext_area_50 = function.get_skymap_90_50_area(combined_skymap)
+            ext_ra, ext_dec = combined_skymap.stats.max_prob_position()
+            ext_area_90, ext_area_50 = combined_skymap.stats.area(0.9), combined_skymap.stats.area(0.5)
 
-            combined_header = combined_skymap.meta
-            comb_header_keys = combined_header.keys()
             ext_gwa.update({
                 "avgra"           : ext_ra.deg,
                 "avgdec"          : ext_dec.deg,
                 "area_90"         : ext_area_90.to_value(u.deg**2),
                 "area_50"         : ext_area_50.to_value(u.deg**2),
-                "time_of_signal"  : combined_header['DATE-OBS'] if 'DATE-OBS' in comb_header_keys else '1991-12-23T19:15:00',
-                "distance"        : combined_header['DISTMEAN'] if 'DISTMEAN' in comb_header_keys else "-999.9",
-                "distance_error"  : combined_header['DISTSTD'] if 'DISTSTD' in comb_header_keys else "-999.9",
-                "timesent"        : combined_header['DATE'] if 'DATE' in comb_header_keys else '1991-12-23T19:15:00',
+                "time_of_signal"  : combined_skymap.header_value('DATE-OBS', '1991-12-23T19:15:00'),
+                "distance"        : combined_skymap.header_value('DISTMEAN', "-999.9"),
+                "distance_error"  : combined_skymap.header_value('DISTSTD', "-999.9"),
+                "timesent"        : combined_skymap.header_value('DATE', '1991-12-23T19:15:00'),
             })
 
             writer.set_gwalert_dict(ext_gwa)
-            writer.set_skymap(combined_skymap_bytes)
-            writer.process_external_coinc(config=config, verbose=verbose)
+            writer.set_skymap(combined_skymap)
+            if not superseded() and 'ext_coinc' in stages:
+                artifact_jobs.append(writer.submit_external_coinc(config=config, verbose=verbose, checkpoint=checkpoint, only=stages))
+
+        if staged:
+            ext_gwa_response = _post_alert(ext_gwa, 'post_ext_alert', config, checkpoint, ledger=ledger, posted=(alert_hash, ext_path_info, ext_prior))
+
+    try:
+        if skymap is not None and 'galaxies' in stages and not checkpoint.done('galaxies') and not superseded():
+            fg = _find_galaxies()
+            # create EventLocatlization object to be passed into the galaxies list
+            gwa_obj = fg.EventLocalization(gwa)
+            #makes galaxy list, posts to API
+            post_galaxies_json = fg.generate_galaxy_list(gwa_obj, galaxy_config_path=config.PATH_TO_GALAXY_CATALOG_CONFIG, skymap=skymap)
+
+    except Exception as e:
+        print(e)
+
+    #the main and ExtCoinc artifacts are produced alongside the galaxy ranking, and are all done before the (unstaged) posts
+    if superseded():
+        post_galaxies_json = None
+        for jobs in artifact_jobs:
+            jobs.cancel()
+    budget_end = received + profile['budget']
+    for jobs in artifact_jobs:
+        jobs.wait(timeout=max(budget_end - time.perf_counter(), 0.0))
 
     if not dry_run:
-        gwa = function.post_gwtm_alert(gwa, config=config)
+        if not staged:
+            gwa_response = _post_alert(
+                gwa, 'post_alert', config, checkpoint, received=received, record=record, ledger=ledger, posted=(alert_hash, path_info, prior)
+            )
 
         if post_galaxies_json is not None:
-            #call delete before
-            function.delete_galaxy_list(post_galaxies_json, config=config)
-            function.post_galaxy_list(post_galaxies_json, config=config)
+            #replaces the previous list for the event
+            checkpoint.run('galaxies', lambda: function.publish_galaxy_list(post_galaxies_json, config=config))
         
-        if ext_gwa is not None:
-            ext_gwa = function.post_gwtm_alert(ext_gwa, config=config)
+        if ext_gwa is not None and not staged:
+            ext_gwa_response = _post_alert(ext_gwa, 'post_ext_alert', config, checkpoint, ledger=ledger, posted=(alert_hash, ext_path_info, ext_prior))
+
+        gwa, ext_gwa = gwa_response, ext_gwa_response
     
-    if run_test:
+    if run_test and 'test_cleanup' in stages:
         function.del_test_alerts(config=config)
 
     return gwa, ext_gwa
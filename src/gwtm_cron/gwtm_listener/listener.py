@@ -1,83 +1,507 @@
 
 
+import os
+import re
+import heapq
+import importlib
+import queue
+import threading
+import traceback
+from collections import deque
+
 from gcn_kafka import Consumer # type: ignore
+from confluent_kafka import TopicPartition # type: ignore
 
 try:
     from . import gw_config as config
-    from . import ligo_alert
-    from . import icecube_notice
+    from . import gwstorage
+    from . import gw_checkpoint
+    from . import gw_function as function
+    from . import gw_profiles
 except ImportError:
     # If running as a script, import from the parent directory
     import gw_config as config # type: ignore
-    import ligo_alert # type: ignore
-    import icecube_notice # type: ignore
+    import gwstorage # type: ignore
+    import gw_checkpoint # type: ignore
+    import gw_function as function # type: ignore
+    import gw_profiles # type: ignore
+
+class _Handler(object):
+    '''
+        listen() of a handler module, imported on the first call so a listener only loads
+        the modules (and their scientific stack) of the alerts it actually handles
+    '''
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self._module = None
+        self._lock = threading.Lock()
+
+
+    def module(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    name = f"{__package__}.{self.module_name}" if __package__ else self.module_name
+                    self._module = importlib.import_module(name)
+        return self._module
+
+
+    def __call__(self, *args, **kwargs):
+        return self.module().listen(*args, **kwargs)
+
 
 LISTENER_TYPES = {
     "LIGO_ALERT" : { 
-        "func" : ligo_alert.listen, 
+        "func" : _Handler("ligo_alert"), 
         "domain": "igwn.gwalert"
     },
     "ICECUBE_NOTICE" : {
-        "func" : icecube_notice.listen,
+        "func" : _Handler("icecube_notice"),
         "domain" : "gcn.notices.icecube.lvk_nu_track_search",
     }
 }
 
 
-class Listener():
+def warmup(listener_types=None, config=None):
+    '''
+        Imports the handler modules of listener_types (all of them by default) and runs
+        their warmup(config), so the first alert does not pay for the imports
+    '''
+    for listener_type in listener_types or LISTENER_TYPES.keys():
+        module = LISTENER_TYPES[listener_type]["func"].module()
+        if hasattr(module, 'warmup'):
+            module.warmup(config)
+
+
+#seconds before a failed alert is tried again, doubling with every attempt
+RETRY_BACKOFF = 5.0
+
+SUPEREVENT_ID = re.compile(rb'"superevent_id"\s*:\s*"([^"]*)"')
+ALERT_TYPE = re.compile(rb'"alert_type"\s*:\s*"([^"]*)"')
+
+
+def alert_key(message):
+    '''
+        What alerts are kept in order by: the superevent id (found without parsing the whole,
+        skymap sized, alert), else the kafka message key
+    '''
+    value = message.value()
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    match = SUPEREVENT_ID.search(value or b'')
+    if match is not None:
+        return match.group(1)
+    return message.key() or b''
+
+
+def alert_priority(message, config=None):
+    '''
+        gw_profiles priority of the alert's type
+    '''
+    value = message.value()
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    match = ALERT_TYPE.search(value or b'')
+    alert_type = function.get_packet_type(match.group(1).decode())[0] if match is not None else None
+    return gw_profiles.get_profile(alert_type, config)['priority']
+
+
+class KeyedPriorityQueue(queue.Queue):
+    '''
+        Bounded queue of (priority, key, item), handing out the most urgent item first (lowest
+        priority, then the oldest) without letting an item overtake an earlier one with the
+        same key: an item never goes before what is queued for its key, it inherits their
+        priority when that is less urgent than its own
+    '''
+    def _init(self, maxsize):
+        self.queue: list = []
+        self._seq = 0
+        #key -> [priority of its latest queued item, number of its queued items]
+        self._keys: dict = {}
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, entry):
+        priority, key, item = entry
+        latest = self._keys.get(key)
+        if latest is None:
+            self._keys[key] = [priority, 1]
+        else:
+            priority = max(priority, latest[0])
+            latest[0], latest[1] = priority, latest[1] + 1
+        self._seq += 1
+        heapq.heappush(self.queue, (priority, self._seq, key, item))
+
+    def _get(self):
+        priority, seq, key, item = heapq.heappop(self.queue)
+        latest = self._keys[key]
+        latest[1] -= 1
+        if latest[1] == 0:
+            del self._keys[key]
+        return item
+
 
-    def __init__(self, listener_type, config_path: str = "home/azureuser/cron/listener_config.json"):
+class OffsetTracker(object):
+    '''
+        Offsets handed out for processing, per (topic, partition). committable() returns the
+        offset to commit for each partition: the one after the last message that, like all
+        messages before it, is done
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict = {}
 
-        assert listener_type in LISTENER_TYPES.keys(), "Invalid Listener Type"
 
-        self.listener_type = listener_type
+    def add(self, message):
+        with self._lock:
+            self._pending.setdefault((message.topic(), message.partition()), {})[message.offset()] = False
+
+
+    def done(self, message):
+        with self._lock:
+            offsets = self._pending.get((message.topic(), message.partition()))
+            if offsets is not None and message.offset() in offsets:
+                offsets[message.offset()] = True
+
+
+    def committable(self):
+        commits = {}
+        with self._lock:
+            for tp, offsets in self._pending.items():
+                for offset in sorted(offsets):
+                    if not offsets[offset]:
+                        break
+                    del offsets[offset]
+                    commits[tp] = offset + 1
+        return commits
+
+
+class SupersedeTracker(object):
+    '''
+        The latest alert read per superevent. arrived() hands out a token, which is
+        superseded as soon as a later alert for the same superevent is read
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest: dict = {}
+        self._seq = 0
+
+
+    def arrived(self, key):
+        with self._lock:
+            self._seq += 1
+            if key:
+                self._latest[key] = self._seq
+            return self._seq
+
+
+    def superseded(self, key, token):
+        with self._lock:
+            return bool(key) and self._latest.get(key, token) > token
+
+
+    def done(self, key, token):
+        with self._lock:
+            if self._latest.get(key) == token:
+                del self._latest[key]
+
+
+class Listener():
+    '''
+        Kafka listener for one LISTENER_TYPES entry, a list of them, or "ALL" of them. With
+        several, every topic is subscribed to on one consumer and each message goes to the
+        handler of its topic
+    '''
+    def __init__(self, listener_type, config_path: str = "home/azureuser/cron/listener_config.json", consumer=None):
+
+        if listener_type == "ALL":
+            listener_type = list(LISTENER_TYPES.keys())
+        listener_types = [listener_type] if isinstance(listener_type, str) else list(listener_type)
+        assert len(listener_types) and all(t in LISTENER_TYPES.keys() for t in listener_types), "Invalid Listener Type"
+
+        self.listener_types = listener_types
+        self.listener_type = listener_types[0]
+        self.topic_types = {LISTENER_TYPES[t]["domain"]: t for t in listener_types}
 
         self.config = config.Config(path_to_config=config_path)
 
-        self.consumer = Consumer(
-            client_id=self.config.KAFKA_CLIENT_ID,
-            client_secret=self.config.KAFKA_CLIENT_SECRET
-        )
+        if consumer is None:
+            #offsets are committed once an alert is done (see _commit) and read back on restart by
+            #the same group, so the alerts that were in flight are delivered again
+            consumer = Consumer(
+                config={
+                    'group.id': self.group_id(),
+                    'auto.offset.reset': 'earliest',
+                    'enable.auto.commit': False,
+                },
+                client_id=self.config.KAFKA_CLIENT_ID,
+                client_secret=self.config.KAFKA_CLIENT_SECRET
+            )
+        self.consumer = consumer
         
-        self.consumer.subscribe([
-            LISTENER_TYPES[self.listener_type]["domain"]
-        ])
+        self.consumer.subscribe(list(self.topic_types.keys()))
+
+        self._stop = threading.Event()
+        self._checkpoint_store = None
+        self.retry_backoff = RETRY_BACKOFF
+
 
+    def group_id(self):
+        '''
+            Kafka consumer group, KAFKA_GROUP_ID or one named after the listener types
+        '''
+        return self.config.KAFKA_GROUP_ID or "gwtm-" + "-".join(t.lower() for t in self.listener_types)
 
-    def _listen(self, alert, write_to_s3, verbose, dry_run, alertname=None):
-        listener_function = LISTENER_TYPES[self.listener_type]["func"]
-        return listener_function(self.config, alert, write_to_s3, verbose, dry_run, alertname)
+
+    def message_type(self, message):
+        '''
+            LISTENER_TYPES entry handling a message, from its topic
+        '''
+        return self.topic_types.get(message.topic(), self.listener_type)
+
+
+    def _listen(self, alert, write_to_s3, verbose, dry_run, alertname=None, checkpoint=None, superseded=None, listener_type=None):
+        listener_function = LISTENER_TYPES[listener_type or self.listener_type]["func"]
+        return listener_function(self.config, alert, write_to_s3, verbose, dry_run, alertname, checkpoint=checkpoint, superseded=superseded)
+
+
+    def checkpoints(self):
+        '''
+            The gw_checkpoint.CheckpointStore at CHECKPOINT_DB (CACHE_DIR/checkpoints.db by default)
+        '''
+        if self._checkpoint_store is None:
+            path = self.config.CHECKPOINT_DB or os.path.join(self.config.CACHE_DIR, 'checkpoints.db')
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._checkpoint_store = gw_checkpoint.get_store(path)
+        return self._checkpoint_store
     
 
-    def run(self, write_to_s3=True, verbose=False, dry_run=False):
+    def _process(self, message, write_to_s3, verbose, dry_run, superseded=None):
+        '''
+            Processes a message under its checkpoint: a message an earlier run finished is skipped,
+            one it got part way through resumes at the first unfinished stage, and one that
+            has already failed MAX_ALERT_ATTEMPTS times is given up on
+        '''
+        store = self.checkpoints()
+        mid = gw_checkpoint.message_id(message, message.value())
+        if store.is_finished(mid):
+            if verbose:
+                print(f"INFO: {mid} was processed before, skipping")
+            return
+
+        checkpoint = store.begin(mid)
+        if store.attempts(mid) > self.config.MAX_ALERT_ATTEMPTS:
+            print(f"WARNING: giving up on {mid} after {self.config.MAX_ALERT_ATTEMPTS} attempts")
+            checkpoint.finish()
+            return
+        if checkpoint.resumed:
+            print(f"INFO: resuming {mid}, already done: {', '.join(checkpoint.finished)}")
+
+        alert, ext_alert = self._listen(
+            alert=message.value(), 
+            write_to_s3=write_to_s3,
+            verbose=verbose,
+            dry_run=dry_run,
+            checkpoint=checkpoint,
+            superseded=superseded,
+            listener_type=self.message_type(message)
+        )
+        checkpoint.finish()
         if verbose:
-            print(f'Listening for alerts from {LISTENER_TYPES[self.listener_type]["domain"]}')
+            print(alert)
+            if ext_alert:
+                print()
+                print(ext_alert)
 
-        while True:
+
+    def _commit(self, commits):
+        '''
+            Synchronously commits {(topic, partition): offset}
+        '''
+        if not len(commits):
+            return
+        try:
+            self.consumer.commit(
+                offsets=[TopicPartition(topic, partition, offset) for (topic, partition), offset in commits.items()],
+                asynchronous=False
+            )
+        except Exception as e:
+            print(f"WARNING: offset commit failed: {e}")
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def warmup(self, background=False):
+        '''
+            Preloads what the handlers of this listener need, see warmup(). With background it
+            runs on its own thread, returned, so the consumer starts meanwhile
+        '''
+        if not background:
+            return warmup(self.listener_types, self.config)
+
+        thread = threading.Thread(target=warmup, args=(self.listener_types, self.config), name='gwtm-warmup', daemon=True)
+        thread.start()
+        return thread
+
+
+    def run(self, write_to_s3=True, verbose=False, dry_run=False, pipeline=False):
+        '''
+            Consumes and processes alerts until stop() is called. With pipeline, alerts are
+            handed to worker threads (see _run_pipeline) instead of being processed inline
+        '''
+        if verbose:
+            print(f'Listening for alerts from {", ".join(self.topic_types.keys())}')
+
+        if pipeline:
+            return self._run_pipeline(write_to_s3=write_to_s3, verbose=verbose, dry_run=dry_run)
+
+        while not self._stop.is_set():
             for message in self.consumer.consume(timeout=1):
-                alert, ext_alert = self._listen(
-                    alert=message.value(), 
-                    write_to_s3=write_to_s3,
-                    verbose=verbose,
-                    dry_run=dry_run
-                )
-                if verbose:
-                    print(alert)
-                    if ext_alert:
-                        print()
-                        print(ext_alert)
-
-
-    def local_run(self, alert_json_path: str, write_to_s3=False, verbose=True, dry_run=True, alertname=None):
+                self._process(message, write_to_s3, verbose, dry_run)
+                self._commit({(message.topic(), message.partition()): message.offset() + 1})
+
+
+    def _work(self, work_queue, stopping, offsets, newest, write_to_s3, verbose, dry_run):
+        #what is still queued once stopping is set is not committed, and comes again after a restart
+        while not stopping.is_set():
+            try:
+                message, key, token = work_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            handled = self._process_with_retries(
+                message, write_to_s3, verbose, dry_run, superseded=lambda: newest.superseded(key, token)
+            )
+            newest.done(key, token)
+            #left pending when stopped before it succeeded, so it is not committed and comes again
+            if handled:
+                offsets.done(message)
+
+
+    def _process_with_retries(self, message, write_to_s3, verbose, dry_run, superseded=None):
+        '''
+            Processes a message, trying again (resuming from its checkpoint) after retry_backoff,
+            doubling, seconds when it fails. True once it succeeded or was given up on after
+            MAX_ALERT_ATTEMPTS, False when the listener is stopped first
+        '''
+        mid = gw_checkpoint.message_id(message, message.value())
+        delay = self.retry_backoff
+        while True:
+            try:
+                self._process(message, write_to_s3, verbose, dry_run, superseded=superseded)
+                return True
+            except Exception:
+                print(f"WARNING: failed to process {self.message_type(message)} alert {alert_key(message)!r}")
+                traceback.print_exc()
+
+            if self.checkpoints().attempts(mid) >= self.config.MAX_ALERT_ATTEMPTS:
+                print(f"WARNING: giving up on {mid} after {self.config.MAX_ALERT_ATTEMPTS} attempts")
+                self.checkpoints().finish(mid)
+                return True
+            if self._stop.wait(delay):
+                return False
+            delay *= 2
+
+
+    def _read(self, newest, timeout):
+        '''
+            (message, superevent key, supersede token) of the consumed messages
+        '''
+        items = []
+        for message in self.consumer.consume(timeout=timeout):
+            key = alert_key(message)
+            items.append((message, key, newest.arrived(key)))
+        return items
+
+
+    def _run_pipeline(self, write_to_s3, verbose, dry_run):
+        '''
+            The consumer loop only reads from kafka and hands each alert to one of
+            PIPELINE_WORKERS worker threads, picked by its superevent id, so the alerts of one
+            superevent are processed in order while different superevents run in parallel.
+
+            Each worker has a queue of PIPELINE_QUEUE_SIZE alerts, when the one an alert needs
+            is full the consumer pauses its partitions (it keeps polling, so it stays in the
+            group) until there is room again. Workers take the most urgent alert type first
+            (gw_profiles priority, e.g. Retractions), still in order within a superevent
+
+            Offsets are committed up to the first alert that is still queued or being processed,
+            a failed alert is tried again by its worker (see _process_with_retries) first.
+            An alert that is still queued or running when a newer one for its superevent is read
+            (a Retraction, or the next Preliminary/Initial/Update) is superseded, see ligo_alert.listen
+            On stop the workers finish the alert they are on, the queued ones are left uncommitted
+            for the next start
+
+            Every listener type has its own workers, queues and backlog, and only the partitions
+            of its topic are paused, so a slow or failing handler never holds up the others
+        '''
+        nworkers = max(self.config.PIPELINE_WORKERS, 1)
+        offsets = OffsetTracker()
+        newest = SupersedeTracker()
+        stopping = threading.Event()
+        work_queues = {
+            t: [KeyedPriorityQueue(maxsize=max(self.config.PIPELINE_QUEUE_SIZE, 1)) for _ in range(nworkers)]
+            for t in self.listener_types
+        }
+        workers = [
+            threading.Thread(target=self._work, args=(q, stopping, offsets, newest, write_to_s3, verbose, dry_run), name=f'gwtm-{t.lower()}-{i}', daemon=True)
+            for t, queues in work_queues.items() for i, q in enumerate(queues)
+        ]
+        for w in workers:
+            w.start()
+
+        backlogs = {t: deque() for t in self.listener_types}
+        paused: dict = {}
+        try:
+            while not self._stop.is_set():
+                #polls (keeping the group membership) even while paused, paused topics deliver nothing new
+                waiting = any(len(backlog) for backlog in backlogs.values())
+                for item in self._read(newest, timeout=0.5 if waiting else 1):
+                    backlogs[self.message_type(item[0])].append(item)
+
+                for t, backlog in backlogs.items():
+                    while len(backlog):
+                        message, key, token = backlog[0]
+                        work_queue = work_queues[t][hash(key) % nworkers]
+                        offsets.add(message)
+                        try:
+                            work_queue.put_nowait((alert_priority(message, self.config), key, backlog[0]))
+                        except queue.Full:
+                            break
+                        backlog.popleft()
+
+                    if len(backlog) and t not in paused:
+                        topic = LISTENER_TYPES[t]["domain"]
+                        paused[t] = [tp for tp in self.consumer.assignment() if tp.topic == topic]
+                        self.consumer.pause(paused[t])
+                        if verbose:
+                            print(f'INFO: {t} workers are busy, pausing {topic}')
+                    elif not len(backlog) and t in paused:
+                        self.consumer.resume(paused.pop(t))
+
+                self._commit(offsets.committable())
+        finally:
+            stopping.set()
+            for w in workers:
+                w.join()
+            self._commit(offsets.committable())
+
+
+    def local_run(self, alert_json_path: str, write_to_s3=False, verbose=True, dry_run=True, alertname=None, listener_type=None):
         with open(alert_json_path, 'r') as f:
             record = f.read()
-            alert, ext_alert = self._listen(alert=record, write_to_s3=write_to_s3, verbose=verbose, dry_run=dry_run, alertname=alertname)
+            alert, ext_alert = self._listen(alert=record, write_to_s3=write_to_s3, verbose=verbose, dry_run=dry_run, alertname=alertname, listener_type=listener_type)
             if verbose:
                 print(alert)
                 if ext_alert:
                     print()
                     print(ext_alert)
 
+        #one-off runs wait for the write-behind uploads before returning
+        gwstorage.flush_uploads()
+
 
 if __name__ == '__main__':
     atype = "LIGO_ALERT"
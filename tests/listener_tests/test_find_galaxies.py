@@ -0,0 +1,162 @@
+import sys
+import os
+import json
+import tempfile
+from base64 import b64decode
+from io import BytesIO
+from configparser import ConfigParser
+import numpy as np
+import healpy as hp # type: ignore
+from astropy.table import Table # type: ignore
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import find_galaxies as fg # type: ignore
+
+
+def _write_catalog(path, n=1000, dtype=np.float64):
+    rng = np.random.default_rng(42)
+    dist = rng.uniform(-10, 200, n)
+    mstar = 10**rng.uniform(7, 12, n)
+    mstar[::10] = np.nan
+    Table({
+        'objname' : np.array([f'GAL{i:05d}' for i in range(n)]),
+        'ra'      : rng.uniform(0, 360, n).astype(dtype),
+        'dec'     : np.rad2deg(np.arcsin(rng.uniform(-1, 1, n))).astype(dtype),
+        'DistMpc' : dist.astype(dtype),
+        'Mstar'   : mstar.astype(dtype)
+    }).write(path)
+
+
+def test_compiled_catalog_matches_fits():
+    for dtype in (np.float64, np.float32):
+        _check_compiled_catalog(dtype)
+
+
+def _check_compiled_catalog(dtype):
+    tmpdir = tempfile.mkdtemp()
+    fits_path = os.path.join(tmpdir, 'catalog.fits')
+    compiled_path = os.path.join(tmpdir, 'catalog_compiled')
+    _write_catalog(fits_path, dtype=dtype)
+
+    fg.compile_catalog(fits_path, compiled_path)
+    from_fits = fg.load_catalog(fits_path)
+    compiled = fg.load_catalog(compiled_path)
+
+    assert compiled.memmapped
+    assert fg.load_catalog(compiled_path) is compiled, "catalog not shared across calls"
+    assert len(compiled) == len(from_fits)
+    assert not np.any(np.isnan(compiled['Mstar']))
+    assert np.all(compiled['DistMpc'] > 0)
+    for c in fg.CATALOG_COLUMNS + fg.DERIVED_COLUMNS:
+        assert np.array_equal(compiled[c], from_fits[c]), f"column {c} differs"
+
+    #derived columns in the catalog's own precision, as the ranking computed them from the table
+    galaxies = Table.read(fits_path)
+    galaxies = galaxies[~np.isnan(galaxies['Mstar'])]
+    galaxies = galaxies[np.where(galaxies['DistMpc']>0)]
+    assert np.array_equal(compiled['theta'], np.asarray(0.5 * np.pi - np.pi*(galaxies['dec'])/180))
+    assert np.array_equal(compiled['log10dist'], np.asarray(np.log10(galaxies['DistMpc'] * (10 ** 5))))
+    assert compiled['theta'].dtype == compiled['log10dist'].dtype == dtype
+
+    assert compiled.index.order == fg.INDEX_ORDER
+    assert np.array_equal(compiled.index.rows, from_fits.index.rows)
+
+
+def test_index_query_matches_ang2pix():
+    tmpdir = tempfile.mkdtemp()
+    fits_path = os.path.join(tmpdir, 'catalog.fits')
+    _write_catalog(fits_path, n=5000)
+    catalog = fg.load_catalog(fits_path)
+    d = catalog['DistMpc']
+
+    for order in [3, fg.INDEX_ORDER, fg.INDEX_ORDER + 1]:
+        nside = hp.order2nside(order)
+        ipix = hp.ang2pix(nside, catalog['theta'], catalog['phi'], nest=True)
+        query_pix = np.unique(ipix)[::3]
+
+        rows, which = catalog.index.query(order, query_pix)
+        expected = np.flatnonzero(np.isin(ipix, query_pix))
+        assert np.array_equal(np.sort(rows), expected), f"wrong rows at order {order}"
+        assert np.array_equal(query_pix[which], ipix[rows])
+
+    #distance range lookup at the index order keeps every galaxy inside the range
+    ipix = hp.ang2pix(hp.order2nside(fg.INDEX_ORDER), catalog['theta'], catalog['phi'], nest=True)
+    query_pix = np.unique(ipix)
+    dmin, dmax = np.full(len(query_pix), 50.0), np.full(len(query_pix), 100.0)
+    rows, _ = catalog.index.query(fg.INDEX_ORDER, query_pix, dmin=dmin, dmax=dmax)
+    expected = np.flatnonzero((d >= 50) & (d <= 100))
+    assert set(expected) <= set(rows)
+    assert np.all((d[rows] > 50 - 1e-3) & (d[rows] < 100 + 1e-3))
+
+
+def test_moc_credzone_matches_pixel_lookup():
+    with open(os.path.join(os.getcwd(), 'alerts', 'MS181101ab-preliminary.json')) as f:
+        record = json.load(f)
+    skymap = Table.read(BytesIO(b64decode(record['event']['skymap'])))
+
+    tmpdir = tempfile.mkdtemp()
+    fits_path = os.path.join(tmpdir, 'catalog.fits')
+    _write_catalog(fits_path, n=20000)
+    catalog = fg.load_catalog(fits_path)
+
+    stats = fg.gw_skymap.SkymapStats.from_moc(skymap)
+    distmu, distsigma, _ = fg._moc_distances(skymap, distance=True)
+    order, prob = stats.level, stats.key
+    probcutoff = stats.prob_cutoff(0.9)
+    rows, ipix = fg._credzone_galaxies(catalog.index, order, stats.ipix, prob, distmu, distsigma, probcutoff, 3)
+
+    #brute force: find the UNIQ pixel of every galaxy at every order of the map
+    uniq = np.asarray(skymap['UNIQ'])
+    galaxy_pixel = np.full(len(catalog), -1)
+    for o in np.unique(order):
+        galaxy_uniq = 4 * 4**int(o) + hp.ang2pix(2**int(o), catalog['theta'], catalog['phi'], nest=True)
+        found = np.isin(galaxy_uniq, uniq)
+        galaxy_pixel[found] = np.searchsorted(uniq, galaxy_uniq[found], sorter=np.argsort(uniq))
+    galaxy_pixel = np.argsort(uniq)[galaxy_pixel]
+    d = catalog['DistMpc']
+    expected = np.flatnonzero((prob[galaxy_pixel] >= probcutoff) & (np.abs(d - distmu[galaxy_pixel]) < 3*distsigma[galaxy_pixel]))
+
+    assert len(expected) > 0
+    assert np.array_equal(rows, expected)
+    assert np.array_equal(ipix, galaxy_pixel[expected])
+
+
+def test_credzone_widens_below_min_galaxies():
+    with open(os.path.join(os.getcwd(), 'alerts', 'MS181101ab-preliminary.json')) as f:
+        record = json.load(f)
+    skymap = Table.read(BytesIO(b64decode(record['event']['skymap'])))
+
+    #sparse for this map: only a couple of galaxies in its 50% zone
+    tmpdir = tempfile.mkdtemp()
+    fits_path = os.path.join(tmpdir, 'catalog.fits')
+    _write_catalog(fits_path, n=20000)
+    gwa = {'distance': 1, 'skymap_fits_url': 'Invalid.Sky.Map.URL', 'graceid': 'MS181101ab', 'timesent': ''}
+
+    found = {}
+    for min_galaxies in ['1', '100']:
+        galaxy_config = ConfigParser()
+        galaxy_config.read_dict({'GALAXIES': {'NSIGMAS_IN_D': '3', 'MINGALAXIES': min_galaxies}})
+        found[min_galaxies] = len(fg._find_candidates(fg.EventLocalization(gwa), galaxy_config, fits_path, 0.5, skymap=skymap))
+
+    assert 0 < found['1'] < 100
+    #fewer than MINGALAXIES, so the zone is widened to 99.995% and 5 sigma
+    assert found['100'] > found['1']
+
+
+def test_top_k_matches_full_sort():
+    rng = np.random.default_rng(7)
+    values = np.round(rng.uniform(0, 1, 5000), 2) #lots of ties
+    full = np.argsort(values, kind="mergesort")[::-1]
+    for k in [1, 10, 333, 4999, 5000, 0]:
+        top = fg._top_k_descending(values, k)
+        expected = full if k == 0 else full[:k]
+        assert np.array_equal(top, expected), f"top {k} differs from the full sort"
+
+
+if __name__ == '__main__':
+    test_compiled_catalog_matches_fits()
+    test_index_query_matches_ang2pix()
+    test_moc_credzone_matches_pixel_lookup()
+    test_credzone_widens_below_min_galaxies()
+    test_top_k_matches_full_sort()
@@ -0,0 +1,100 @@
+import sys
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gw_api # type: ignore
+
+
+class _FlakyAPI(BaseHTTPRequestHandler):
+    #endpoint -> status codes to answer with before the 200
+    failures: dict = {}
+    requests: list = []
+    gzipped: list = []
+
+    def _answer(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        gzipped = self.headers.get('Content-Encoding') == 'gzip'
+        if gzipped:
+            body = gzip.decompress(body)
+        body = json.loads(body or b'{}')
+        endpoint = self.path.rsplit('/', 1)[-1]
+        _FlakyAPI.requests.append((self.command, endpoint, body))
+        _FlakyAPI.gzipped.append(gzipped)
+
+        pending = _FlakyAPI.failures.get(endpoint, [])
+        status = pending.pop(0) if len(pending) else 200
+        if endpoint == 'event_galaxies':
+            resp = json.dumps([{'listid': 7}] if self.command == 'GET' else {}).encode()
+        else:
+            resp = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FlakyAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/v0/"
+
+
+def test_idempotent_calls_retry_and_posts_do_not():
+    server, api_base = _serve()
+    try:
+        client = gw_api.GWTMClient(api_base, 'token', max_retries=2, backoff=0.01)
+
+        _FlakyAPI.failures = {'query_alerts': [503, 502]}
+        assert client.query_alerts('S1', 'Preliminary') == {'graceid': 'S1', 'alert_type': 'Preliminary', 'api_token': 'token'}
+        assert client.stats()['query_alerts']['retries'] == 2
+
+        _FlakyAPI.failures = {'post_alert': [503]}
+        _FlakyAPI.requests = []
+        gwa = {'graceid': 'S1'}
+        try:
+            client.post_alert(gwa)
+            assert False, "post_alert must not be retried"
+        except gw_api.APIError:
+            pass
+        assert len(_FlakyAPI.requests) == 1 and gwa == {'graceid': 'S1'}
+
+        _FlakyAPI.requests = []
+        client.delete_galaxy_list({'groupname': 'LLAMA', 'graceid': 'S1'})
+        assert [(method, endpoint) for method, endpoint, _ in _FlakyAPI.requests] == [('GET', 'event_galaxies'), ('POST', 'remove_event_galaxies')]
+        assert _FlakyAPI.requests[1][2]['listid'] == 7
+    finally:
+        server.shutdown()
+
+
+def test_compressed_galaxy_list():
+    server, api_base = _serve()
+    try:
+        client = gw_api.GWTMClient(api_base, 'token', backoff=0.01, compress_min_bytes=1024)
+        galaxies = {
+            'graceid': 'S1', 'groupname': 'LCOGT', 'request_doi': True,
+            'galaxies': [{'name': f'GAL{i}', 'score': i/1000, 'info': {'Mstar': 1e10}} for i in range(2500)]
+        }
+
+        #the old list is looked up and removed first, then the new one goes out in one compressed post
+        _FlakyAPI.failures, _FlakyAPI.requests, _FlakyAPI.gzipped = {}, [], []
+        client.publish_galaxy_list(galaxies)
+        assert [endpoint for _, endpoint, _ in _FlakyAPI.requests] == ['event_galaxies', 'remove_event_galaxies', 'event_galaxies']
+        assert _FlakyAPI.gzipped[-1]
+        assert len(_FlakyAPI.requests[-1][2]['galaxies']) == 2500
+        assert _FlakyAPI.requests[-1][2]['request_doi']
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    test_idempotent_calls_retry_and_posts_do_not()
+    test_compressed_galaxy_list()
@@ -0,0 +1,221 @@
+import sys
+import os
+import time
+import datetime
+import json
+import tempfile
+import threading
+import numpy as np
+import astropy.io.fits as fits # type:ignore
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gw_cache # type: ignore
+from gwtm_cron.gwtm_listener import gw_function as function # type: ignore
+
+
+FERMI_TLE = (
+    "FERMI\r\n"
+    "1 33053U 08029A   24290.51505787  .00011085  00000-0  44919-3 0  9993\r\n"
+    "2 33053  25.5827 120.1553 0012154 218.2210 141.7408 15.17785167897121\r\n"
+)
+
+
+def _seeded_cache(max_age=3600):
+    tmpdir = tempfile.mkdtemp()
+    seed_path = os.path.join(tmpdir, 'seed.txt')
+    with open(seed_path, 'w') as f:
+        f.write(FERMI_TLE)
+
+    #unreachable url, nothing in these tests may touch the network
+    cache = gw_cache.TLECache(os.path.join(tmpdir, 'cache'), max_age=max_age, url='http://127.0.0.1:9/tle', timeout=1)
+    cache.seed(seed_path)
+    return cache
+
+
+def test_parse_tle():
+    name, line1, line2 = gw_cache.parse_tle(FERMI_TLE.encode())
+    assert name == 'FERMI'
+    assert line1.startswith('1 33053U') and line2.startswith('2 33053')
+
+    html = "<html><body><pre>" + FERMI_TLE + "</pre></body></html>"
+    assert gw_cache.parse_tle(html) == (name, line1, line2)
+
+
+def test_seeded_cache_is_offline():
+    cache = _seeded_cache()
+    assert cache.get()[0] == 'FERMI'
+
+    #a new cache on the same directory reads the TLE from disk
+    reopened = gw_cache.TLECache(cache.cache_dir, url=cache.url, timeout=1)
+    assert reopened.get() == cache.get()
+
+    lon, lat, elevation = function.getDataFromTLE(datetime.datetime(2024, 10, 17, 12), tle_cache=cache)
+    assert lon is False or -360 <= lon <= 360
+
+
+def test_stale_cache_falls_back_to_last_good():
+    cache = _seeded_cache(max_age=0)
+    time.sleep(0.01)
+    assert cache.get()[0] == 'FERMI'
+    assert cache.refresh()[0] == 'FERMI'
+
+
+def _write_ft2(path, met_start, n=2000):
+    start = met_start + 30.0*np.arange(n)
+    fits.BinTableHDU.from_columns([
+        fits.Column(name='START', format='D', array=start),
+        fits.Column(name='STOP', format='D', array=start + 30.0),
+        fits.Column(name='RA_SCZ', format='E', array=np.linspace(0, 360, n)),
+        fits.Column(name='DEC_SCZ', format='E', array=np.linspace(-90, 90, n)),
+    ]).writeto(path)
+
+
+def test_ft2_cache_lookup_and_eviction():
+    tmpdir = tempfile.mkdtemp()
+    remote = os.path.join(tmpdir, 'remote')
+    os.makedirs(remote)
+
+    timestamps = [datetime.datetime(2024, 10, 17, 12), datetime.datetime(2024, 10, 30, 12)]
+    index = {}
+    for ts in timestamps:
+        week = gw_cache.ft2_week(ts)
+        filename = f"FERMI_POINTING_FINAL_{week}_2024000_2024007_00.fits"
+        _write_ft2(os.path.join(remote, filename), function.datetime2MET(ts) - 20000)
+        index[week] = filename
+
+    cache = gw_cache.FT2Cache(tmpdir, max_bytes=1, url=f"file://{remote}/")
+    with open(cache.index_path, 'w') as f:
+        json.dump(index, f)
+
+    #the current week's FINAL file is not out yet, the newest published one is
+    assert cache.latest_week() == max(index)
+
+    ts = timestamps[0]
+    pointing = cache.pointing(gw_cache.ft2_week(ts))
+    mid = pointing.start + (pointing.stop - pointing.start)/2.0
+    for met in np.concatenate([mid[::97], mid[::89] + 15.0, [mid[0] - 100, mid[-1] + 100]]):
+        assert pointing.closest(met) == np.abs(mid - met).argmin()
+
+    ra, dec = function.getFermiPointing(ts, ft2_cache=cache)
+    i = np.abs(mid - function.datetime2MET(ts)).argmin()
+    assert (ra, dec) == (pointing.ra[i], pointing.dec[i])
+
+    #max_bytes only leaves room for the latest file
+    cache.path(gw_cache.ft2_week(timestamps[1]))
+    assert sorted(f for f in os.listdir(cache.cache_dir) if f.endswith('.fits')) == [index[gw_cache.ft2_week(timestamps[1])]]
+
+    html = '<a href="FERMI_POINTING_FINAL_845_2024289_2024296_00.fits">x</a> <a href="FERMI_POINTING_PRELIM_846_2024296_2024303_00.fits">y</a>'
+    assert gw_cache.parse_ft2_index(html) == {845: 'FERMI_POINTING_FINAL_845_2024289_2024296_00.fits'}
+
+
+def test_ft2_download_does_not_block_lookups():
+    tmpdir = tempfile.mkdtemp()
+    remote = os.path.join(tmpdir, 'remote')
+    os.makedirs(remote)
+    index = {845: 'FERMI_POINTING_FINAL_845_2024289_2024296_00.fits', 846: 'FERMI_POINTING_FINAL_846_2024296_2024303_00.fits'}
+    for week, filename in index.items():
+        _write_ft2(os.path.join(remote, filename), 1e8 + week)
+
+    cache = gw_cache.FT2Cache(tmpdir, url=f"file://{remote}/")
+    with open(cache.index_path, 'w') as f:
+        json.dump(index, f)
+    cached = cache.pointing(845)
+
+    started, release = threading.Event(), threading.Event()
+    downloads = []
+    real_urlopen = gw_cache.urlopen
+
+    def _slow_urlopen(url, timeout=None):
+        downloads.append(url)
+        started.set()
+        release.wait(5)
+        return real_urlopen(url, timeout=timeout)
+
+    gw_cache.urlopen = _slow_urlopen
+    try:
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.pointing(846))) for _ in range(2)]
+        for t in threads:
+            t.start()
+        started.wait(5)
+        #the week already on disk is there while the other one downloads
+        start = time.time()
+        assert cache.pointing(845) is cached
+        assert time.time() - start < 1.0
+        release.set()
+        for t in threads:
+            t.join(5)
+    finally:
+        gw_cache.urlopen = real_urlopen
+
+    #both callers get the one download
+    assert len(downloads) == 1
+    assert len(results) == 2 and results[0] is results[1]
+
+
+def test_ft2_index_fetch_does_not_block_lookups():
+    tmpdir = tempfile.mkdtemp()
+    remote = os.path.join(tmpdir, 'remote')
+    os.makedirs(remote)
+    filename = 'FERMI_POINTING_FINAL_845_2024289_2024296_00.fits'
+    _write_ft2(os.path.join(remote, filename), 1e8)
+
+    cache = gw_cache.FT2Cache(tmpdir, index_max_age=0, url=f"file://{remote}/")
+    with open(cache.index_path, 'w') as f:
+        json.dump({845: filename}, f)
+    cached = cache.pointing(845)
+
+    started, release = threading.Event(), threading.Event()
+    fetches = []
+
+    class _Listing(object):
+        def read(self):
+            return f'<a href="{filename}">x</a> <a href="FERMI_POINTING_FINAL_846_2024296_2024303_00.fits">y</a>'
+
+    def _slow_urlopen(url, timeout=None):
+        fetches.append(url)
+        started.set()
+        release.wait(5)
+        return _Listing()
+
+    real_urlopen = gw_cache.urlopen
+    gw_cache.urlopen = _slow_urlopen
+    try:
+        #week 846 is not in the index yet, both lookups wait for one fetch of the listing
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.filename(846))) for _ in range(2)]
+        for t in threads:
+            t.start()
+        started.wait(5)
+        start = time.time()
+        assert cache.pointing(845) is cached
+        assert time.time() - start < 1.0
+        release.set()
+        for t in threads:
+            t.join(5)
+    finally:
+        gw_cache.urlopen = real_urlopen
+
+    assert len(fetches) == 1
+    assert results == ['FERMI_POINTING_FINAL_846_2024296_2024303_00.fits']*2
+
+
+def test_default_ft2_cache_is_kept():
+    #without a config the FT2 files go to the configured CACHE_DIR, not a temp dir
+    cache_dir = tempfile.mkdtemp()
+    os.environ['CACHE_DIR'] = cache_dir
+    try:
+        assert gw_cache.get_ft2_cache().cache_dir == os.path.join(cache_dir, 'ft2')
+    finally:
+        del os.environ['CACHE_DIR']
+
+
+if __name__ == '__main__':
+    test_parse_tle()
+    test_seeded_cache_is_offline()
+    test_stale_cache_falls_back_to_last_good()
+    test_ft2_cache_lookup_and_eviction()
+    test_ft2_download_does_not_block_lookups()
+    test_ft2_index_fetch_does_not_block_lookups()
+    test_default_ft2_cache_is_kept()
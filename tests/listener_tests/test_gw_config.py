@@ -0,0 +1,24 @@
+import sys
+import os
+import json
+import tempfile
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gw_config # type: ignore
+
+
+def test_json_booleans():
+    path = os.path.join(tempfile.mkdtemp(), 'config.json')
+    with open(path, 'w') as f:
+        json.dump({'ALERT_LEDGER': 'false', 'STAGED_INGEST': False, 'SPECULATIVE_WARMUP': 'yes'}, f)
+
+    #strings parse the same as the environment variables
+    config = gw_config.Config(path_to_config=path)
+    assert config.ALERT_LEDGER is False
+    assert config.STAGED_INGEST is False
+    assert config.SPECULATIVE_WARMUP is True
+
+
+if __name__ == '__main__':
+    test_json_booleans()
@@ -0,0 +1,46 @@
+import sys
+import numpy as np
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gw_function as function # type: ignore
+
+
+def _project_point_by_point(footprint, ra, dec, pos_angle):
+    x, y, z = function.ra_dec_to_uvec(footprint[:, 0], footprint[:, 1])
+    projected = []
+    for vec in np.c_[x, y, z]:
+        new_vec = vec @ function.x_rot(-pos_angle) @ function.y_rot(dec) @ function.z_rot(-ra)
+        projected.append(function.uvec_to_ra_dec(*[float(v) for v in new_vec.flat]))
+    return np.asarray(projected)
+
+
+def _max_offset(a, b):
+    diff = np.abs(np.asarray(a) - np.asarray(b))
+    diff[..., 0] = np.minimum(diff[..., 0], 360 - diff[..., 0])
+    return diff.max()
+
+
+def test_project_footprints_matches_rotation_per_point():
+    rng = np.random.default_rng(7)
+    n = 50
+    footprints = np.stack([rng.uniform(-5, 5, (n, 6)), rng.uniform(-5, 5, (n, 6))], axis=-1)
+    ras, decs, pos_angles = rng.uniform(0, 360, n), rng.uniform(-89, 89, n), rng.uniform(0, 360, n)
+
+    batched = function.project_footprints(footprints, ras, decs, pos_angles)
+    assert batched.shape == (n, 6, 2)
+    for i in range(n):
+        expected = _project_point_by_point(footprints[i], ras[i], decs[i], pos_angles[i])
+        assert _max_offset(batched[i], expected) < 1e-9
+        assert _max_offset(function.project_footprint(footprints[i].tolist(), ras[i], decs[i], pos_angles[i]), expected) < 1e-9
+
+    #one footprint shared by every pointing
+    shared = function.project_footprints(footprints[0], ras, decs, pos_angles)
+    assert _max_offset(shared[3], _project_point_by_point(footprints[0], ras[3], decs[3], pos_angles[3])) < 1e-9
+
+    contour = function.makeLATFoV(120.0, -30.0)
+    assert len(contour) == 200 and all(0 <= ra < 360 for ra, dec in contour)
+
+
+if __name__ == '__main__':
+    test_project_footprints_matches_rotation_per_point()
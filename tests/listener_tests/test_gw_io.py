@@ -0,0 +1,36 @@
+import sys
+import os
+import tempfile
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gw_io # type: ignore
+from gwtm_cron.gwtm_listener import gw_config # type: ignore
+from gwtm_cron.gwtm_listener import gw_checkpoint # type: ignore
+
+
+def test_failed_stages_are_not_checkpointed():
+    config = gw_config.Config(path_to_config=None)
+    store = gw_checkpoint.CheckpointStore(os.path.join(tempfile.mkdtemp(), 'checkpoints.db'))
+    checkpoint = store.begin('m1')
+    ctx = gw_io.WriterContext(path_info='S1-Preliminary', gwalert_dict={}, skymap=None)
+
+    def _fails(ctx, config, verbose):
+        raise RuntimeError('upload failed')
+
+    stages = {
+        'moc'      : lambda ctx, config, verbose: None,
+        'fermi'    : lambda ctx, config, verbose: False,
+        'contours' : _fails,
+    }
+    jobs = gw_io.WriterJobs(ctx, stages, config=config, checkpoint=checkpoint).wait(raise_errors=False)
+
+    assert list(jobs.errors) == ['contours']
+    #only the stage that succeeded is skipped by the next attempt
+    assert checkpoint.done('S1-Preliminary:moc')
+    assert not checkpoint.done('S1-Preliminary:fermi')
+    assert not checkpoint.done('S1-Preliminary:contours')
+
+
+if __name__ == '__main__':
+    test_failed_stages_are_not_checkpointed()
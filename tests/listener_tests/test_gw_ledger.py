@@ -0,0 +1,119 @@
+import sys
+import os
+import time
+import tempfile
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gw_ledger # type: ignore
+from gwtm_cron.gwtm_listener import gw_checkpoint # type: ignore
+from gwtm_cron.gwtm_listener import ligo_alert # type: ignore
+from gwtm_cron.gwtm_listener import gw_config # type: ignore
+
+
+def _ledger():
+    return gw_ledger.AlertLedger(os.path.join(tempfile.mkdtemp(), 'alerts.db'))
+
+
+def test_prior_alerts_and_duplicates():
+    ledger = _ledger()
+    payload = gw_ledger.payload_hash('{"superevent_id": "S240422ed"}')
+
+    #a superevent older than the ledger has to be asked for, a newer one starts at 0
+    assert ledger.prior_alerts('S240422ed', 'Preliminary') is None
+    tomorrow = time.gmtime(time.time() + 2*24*3600)
+    new_event = time.strftime('S%y%m%dab', tomorrow)
+    assert ledger.prior_alerts(new_event, 'Preliminary') == 0
+    assert ledger.prior_alerts('GW170817', 'Preliminary') is None
+
+    ledger.seed('S240422ed', 'Preliminary', 2)
+    assert ledger.prior_alerts('S240422ed', 'Preliminary') == 2
+    assert ledger.seen('S240422ed', 'Preliminary', payload) is None
+
+    ledger.record('S240422ed', 'Preliminary', payload, 'S240422ed-Preliminary2', 2)
+    assert ledger.seen('S240422ed', 'Preliminary', payload) == 'S240422ed-Preliminary2'
+    assert ledger.prior_alerts('S240422ed', 'Preliminary') == 3
+
+    #a resumed alert recording its post again is not counted twice
+    ledger.record('S240422ed', 'Preliminary', payload, 'S240422ed-Preliminary2', 2)
+    assert ledger.prior_alerts('S240422ed', 'Preliminary') == 3
+
+    #the ledger survives a restart
+    reopened = gw_ledger.AlertLedger(ledger.path)
+    assert reopened.since == ledger.since
+    assert reopened.prior_alerts('S240422ed', 'Preliminary') == 3
+
+
+def test_reconcile_takes_the_api_count():
+    ledger = _ledger()
+    ledger.seed('S240422ed', 'Initial', 0)
+    ledger.record('S240422ed', 'Initial', 'a', 'S240422ed-Initial', 0)
+
+    #someone else posted one too
+    ledger.reconcile('S240422ed', 'Initial', lambda: [{}, {}]).result()
+    assert ledger.prior_alerts('S240422ed', 'Initial') == 2
+
+    #an alert recorded while the API was being asked wins over the API's (then stale) count
+    ledger.reconcile('S240422ed', 'Initial', lambda: ledger.record('S240422ed', 'Initial', 'b', 'S240422ed-Initial2', 2) or [{}]).result()
+    assert ledger.prior_alerts('S240422ed', 'Initial') == 3
+
+    #failures leave the count alone
+    def _down():
+        raise IOError('api down')
+    ledger.reconcile('S240422ed', 'Initial', _down).result()
+    assert ledger.prior_alerts('S240422ed', 'Initial') == 3
+
+
+def test_posts_are_recorded_right_away():
+    ledger = _ledger()
+    ledger.seed('S240422ed', 'Update', 1)
+    gwa = {'graceid': 'S240422ed', 'alert_type': 'Update'}
+
+    post, query = ligo_alert.function.post_gwtm_alert, ligo_alert.function.query_gwtm_alerts
+    ligo_alert.function.post_gwtm_alert = lambda gwa, config: {'id': 1}
+    ligo_alert.function.query_gwtm_alerts = lambda graceid, alert_type, config: [{}, {}]
+    try:
+        response = ligo_alert._post_alert(
+            gwa, 'post_alert', None, gw_checkpoint.NoCheckpoint(), ledger=ledger, posted=('h', 'S240422ed-Update1', 1)
+        )
+    finally:
+        ligo_alert.function.post_gwtm_alert, ligo_alert.function.query_gwtm_alerts = post, query
+
+    #counted before any later stage of the alert could fail
+    assert response == {'id': 1}
+    assert ledger.seen('S240422ed', 'Update', 'h') == 'S240422ed-Update1'
+    assert ledger.prior_alerts('S240422ed', 'Update') == 2
+
+
+def test_staged_post_has_the_skymap_url():
+    config = gw_config.Config(path_to_config=None)
+    config.CACHE_DIR = tempfile.mkdtemp()
+    with open(os.path.join(os.getcwd(), 'alerts', 'MS181101ab-preliminary.json')) as f:
+        alert = f.read()
+
+    posts = []
+    function = ligo_alert.function
+    saved = function.post_gwtm_alert, function.query_gwtm_alerts, function.resolve_skymap_url, function.del_test_alerts
+    function.post_gwtm_alert = lambda gwa, config: posts.append(dict(gwa)) or {}
+    function.query_gwtm_alerts = lambda graceid, alert_type, config: []
+    function.resolve_skymap_url = lambda graceid, timeout=None, deadline=None: 'https://gracedb.ligo.org/MS181101ab/bayestar.multiorder.fits'
+    function.del_test_alerts = lambda config: None
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        #superseded, so only the alert json is written and the alert posted
+        ligo_alert.listen(config, alert, write_to_s3=False, superseded=lambda: True)
+    finally:
+        os.chdir(cwd)
+        function.post_gwtm_alert, function.query_gwtm_alerts, function.resolve_skymap_url, function.del_test_alerts = saved
+
+    #the API can not update an alert, the first post already has the URL
+    assert config.STAGED_INGEST
+    assert [gwa['skymap_fits_url'] for gwa in posts] == ['https://gracedb.ligo.org/MS181101ab/bayestar.multiorder.fits']
+
+
+if __name__ == '__main__':
+    test_prior_alerts_and_duplicates()
+    test_reconcile_takes_the_api_count()
+    test_posts_are_recorded_right_away()
+    test_staged_post_has_the_skymap_url()
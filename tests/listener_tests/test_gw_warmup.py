@@ -0,0 +1,148 @@
+import sys
+import os
+import json
+import time
+import tempfile
+import threading
+import numpy as np
+from astropy.table import Table # type: ignore
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gw_warmup # type: ignore
+from gwtm_cron.gwtm_listener import gw_skymap # type: ignore
+from gwtm_cron.gwtm_listener import find_galaxies as fg # type: ignore
+
+
+GALAXY_CONFIG = '''[GALAXIES]
+CATALOG_PATH = {}
+CREDZONE = 0.5
+NSIGMAS_IN_D = 3
+COMPLETENESSP = 0.5
+MINGALAXIES = 100
+NGALAXIES = 1000
+MINL = 1e40
+MAXL = 1e42
+SENSITIVITY = 22
+MINDISTFACTOR = 0.01
+'''
+
+
+class _Config(object):
+    def __init__(self, galaxy_config_path):
+        self.PATH_TO_GALAXY_CATALOG_CONFIG = galaxy_config_path
+        self.CACHE_DIR = tempfile.mkdtemp()
+
+
+def _galaxy_config(n=20000):
+    tmpdir = tempfile.mkdtemp()
+    catalog_path = os.path.join(tmpdir, 'catalog.fits')
+    rng = np.random.default_rng(7)
+    Table({
+        'objname' : np.array([f'GAL{i:05d}' for i in range(n)]),
+        'ra'      : rng.uniform(0, 360, n),
+        'dec'     : np.rad2deg(np.arcsin(rng.uniform(-1, 1, n))),
+        'DistMpc' : rng.uniform(1, 200, n),
+        'Mstar'   : 10**rng.uniform(7, 12, n)
+    }).write(catalog_path)
+
+    config_path = os.path.join(tmpdir, 'galaxies.ini')
+    with open(config_path, 'w') as f:
+        f.write(GALAXY_CONFIG.format(catalog_path))
+    return config_path
+
+
+def _alert(name='MS181101ab-preliminary.json'):
+    with open(os.path.join(os.getcwd(), 'alerts', name)) as f:
+        record = json.load(f)
+    skymap = gw_skymap.ParsedSkymap.from_base64(record['event']['skymap'])
+    gwa = {
+        'graceid'         : record['superevent_id'],
+        'distance'        : skymap.header_value('DISTMEAN', '-999.9'),
+        'skymap_fits_url' : 'Invalid.Sky.Map.URL',
+        'timesent'        : skymap.header_value('DATE', '1991-12-23T19:15:00'),
+        'time_of_signal'  : 'not a time',
+    }
+    return gwa, skymap
+
+
+def test_speculative_cache():
+    cache = gw_warmup.SpeculativeCache(2)
+    calls = []
+    started, release = threading.Event(), threading.Event()
+
+    def _slow():
+        calls.append('a')
+        started.set()
+        release.wait(5)
+        return 'A'
+
+    #a caller asking while the first run is going waits for it instead of running again
+    first = threading.Thread(target=cache.get, args=('a', _slow))
+    first.start()
+    started.wait(5)
+    waiter = []
+    second = threading.Thread(target=lambda: waiter.append(cache.get('a', _slow)))
+    second.start()
+    time.sleep(0.05)
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert calls == ['a'] and waiter == ['A']
+    assert cache.get('a', lambda: 'other') == 'A'
+
+    #failures and None results are run again
+    def _fail():
+        raise ValueError('no FT2 file')
+    try:
+        cache.get('b', _fail)
+        assert False, "the error was swallowed"
+    except ValueError:
+        pass
+    assert 'b' not in cache
+    assert cache.get('c', lambda: None) is None
+    assert 'c' not in cache
+
+    #only the most recently used keys are kept
+    cache.get('b', lambda: 'B')
+    cache.get('d', lambda: 'D')
+    assert 'a' not in cache and 'b' in cache and 'd' in cache
+
+
+def test_speculated_candidates_are_used():
+    config = _Config(_galaxy_config())
+    gwa, skymap = _alert()
+
+    #the same ranking as the uncached path
+    expected = fg.generate_galaxy_list(fg.EventLocalization(gwa), config.PATH_TO_GALAXY_CATALOG_CONFIG, skymap=skymap.table)
+    assert len(expected['galaxies']) > 0
+
+    #nothing for a profile without the galaxies and LAT stages (EarlyWarning)
+    assert gw_warmup.speculate(gwa, skymap, config, frozenset(['moc', 'contours'])) == []
+
+    jobs = gw_warmup.speculate(gwa, skymap, config, frozenset(['galaxies', 'LAT']))
+    assert len(jobs) == 1, "a time_of_signal that does not parse has no Fermi pointing job"
+    assert all(job.result(60) for job in jobs)
+
+    galaxy_config = fg.read_galaxy_config(config.PATH_TO_GALAXY_CATALOG_CONFIG)
+    candidates = fg.galaxy_candidates(fg.EventLocalization(gwa), galaxy_config, skymap=skymap)
+    #a follow-up with the same map, parsed again, gets the speculated candidates
+    _, again = _alert()
+    assert fg.galaxy_candidates(fg.EventLocalization(gwa), galaxy_config, skymap=again) is candidates
+    #every alert speculates, one repeating the map gets the candidates from the cache
+    jobs = gw_warmup.speculate(gwa, again, config, frozenset(['galaxies']))
+    assert len(jobs) == 1 and jobs[0].result(60)
+    assert fg.galaxy_candidates(fg.EventLocalization(gwa), galaxy_config, skymap=again) is candidates
+
+    ranked = fg.generate_galaxy_list(fg.EventLocalization(gwa), config.PATH_TO_GALAXY_CATALOG_CONFIG, skymap=again)
+    assert ranked == expected
+
+    #another map is not mixed up with it
+    _, update = _alert('MS181101ab-update.json')
+    if update.digest != skymap.digest:
+        assert fg.galaxy_candidates(fg.EventLocalization(gwa), galaxy_config, skymap=update) is not candidates
+
+
+if __name__ == '__main__':
+    test_speculative_cache()
+    test_speculated_candidates_are_used()
@@ -0,0 +1,151 @@
+import sys
+import os
+import time
+import tempfile
+import fsspec  # type: ignore
+
+sys.path.insert(0, '../../src/')
+
+from gwtm_cron.gwtm_listener import gwstorage # type: ignore
+
+
+class _config(object):
+    AWS_BUCKET = 'gwtreasuremap'
+    AWS_ACCESS_KEY_ID = ''
+    AWS_SECRET_ACCESS_KEY = ''
+
+
+def test_exists_and_manifest():
+    config = _config()
+    config.STORAGE_MANIFEST_PATH = os.path.join(tempfile.mkdtemp(), 'manifest.txt')  # type: ignore
+
+    fs = fsspec.filesystem('memory')
+    get_fs = gwstorage._get_fs
+    gwstorage._get_fs = lambda source, config: fs
+    try:
+        key = 'fit/S1-Fermi.json'
+        assert not gwstorage.exists_gwtm_file(key, 's3', config)
+        gwstorage.upload_gwtm_file(b'{}', key, 's3', config)
+        assert gwstorage.exists_gwtm_file(key, 's3', config)
+
+        #the manifest answers without asking the storage, also after a restart
+        gwstorage._get_fs = lambda source, config: None
+        gwstorage._manifests.clear()
+        gwstorage._clients.clear()
+        assert gwstorage.exists_gwtm_file(key, 's3', config)
+
+        gwstorage._get_fs = lambda source, config: fs
+        gwstorage._clients.clear()
+        gwstorage.delete_gwtm_files([key], 's3', config)
+        gwstorage._manifests.clear()
+        assert not gwstorage.exists_gwtm_file(key, 's3', config)
+    finally:
+        gwstorage._get_fs = get_fs
+        gwstorage._manifests.clear()
+        gwstorage._clients.clear()
+
+
+def test_client_is_shared_and_reports_stats():
+    config = _config()
+    config.AWS_ACCESS_KEY_ID, config.AWS_SECRET_ACCESS_KEY = 'id', 'secret'  # type: ignore
+
+    created = []
+    get_fs = gwstorage._get_fs
+    gwstorage._get_fs = lambda source, config: created.append(source) or fsspec.filesystem('memory')
+    calls = []
+    StorageClient = gwstorage.StorageClient
+    StorageClient.stats_hook = lambda source, op, seconds, ok: calls.append((op, ok))
+    try:
+        gwstorage.upload_gwtm_file(b'line1', 'test/vv.text', 's3', config)
+        assert gwstorage.download_gwtm_file('test/vv.text', 's3', config) == 'line1'
+        assert gwstorage.list_gwtm_bucket('test', 's3', config) == ['test/vv.text']
+        gwstorage.delete_gwtm_files('test/vv.text', 's3', config)
+
+        assert created == ['s3']
+        stats = gwstorage.get_client('s3', config).stats()
+        assert stats['upload']['count'] == 1 and stats['download']['count'] == 1
+        assert calls == [('upload', True), ('download', True), ('list', True), ('delete', True)]
+    finally:
+        gwstorage._get_fs = get_fs
+        StorageClient.stats_hook = None
+        gwstorage._clients.clear()
+
+
+class _FlakyFS(object):
+    '''
+        memory filesystem whose first `failures` writes raise, like a bucket outage
+    '''
+    def __init__(self, failures):
+        self.fs = fsspec.filesystem('memory')
+        self.failures = failures
+
+    def open(self, path, mode='rb'):
+        if 'w' in mode and self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('bucket unreachable')
+        return self.fs.open(path, mode)
+
+    def __getattr__(self, name):
+        return getattr(self.fs, name)
+
+
+def test_upload_queue_retries_and_survives_restart():
+    config = _config()
+    config.STORAGE_BUCKET_SOURCE = 's3'  # type: ignore
+    spool_dir = tempfile.mkdtemp()
+
+    flaky = _FlakyFS(failures=2)
+    get_fs = gwstorage._get_fs
+    gwstorage._get_fs = lambda source, config: flaky
+    try:
+        uploads = gwstorage.UploadQueue(spool_dir, 's3', config, workers=2, backoff=0.01)
+        uploads.upload(b'contours', 'fit/S1-contours-smooth.json')
+        uploads.upload(b'skymap', 'fit/S1.fits.gz')
+        uploads.copy('fit/S1.fits.gz', 'fit/S1-ExtCoinc.fits.gz')
+        assert uploads.exists('fit/S1.fits.gz')
+
+        assert uploads.flush(timeout=10)
+        assert flaky.fs.cat('gwtreasuremap/fit/S1-ExtCoinc.fits.gz') == b'skymap'
+        assert flaky.fs.cat('gwtreasuremap/fit/S1-contours-smooth.json') == b'contours'
+        assert os.listdir(spool_dir) == []
+
+        #a job left in the spool by a previous process is uploaded on start
+        job_id = 'leftover'
+        with open(os.path.join(spool_dir, f'{job_id}.data'), 'wb') as f:
+            f.write(b'alert')
+        with open(os.path.join(spool_dir, f'{job_id}.json'), 'w') as f:
+            f.write('{"id": "leftover", "kind": "upload", "filename": "fit/S1_alert.json", "attempts": 3}')
+        restarted = gwstorage.UploadQueue(spool_dir, 's3', config, workers=1, backoff=0.01)
+        assert restarted.flush(timeout=10)
+        assert flaky.fs.cat('gwtreasuremap/fit/S1_alert.json') == b'alert'
+    finally:
+        gwstorage._get_fs = get_fs
+        gwstorage._clients.clear()
+
+
+def test_parked_uploads_are_retried():
+    config = _config()
+    spool_dir = tempfile.mkdtemp()
+
+    flaky = _FlakyFS(failures=2)
+    get_fs = gwstorage._get_fs
+    gwstorage._get_fs = lambda source, config: flaky
+    try:
+        uploads = gwstorage.UploadQueue(spool_dir, 's3', config, workers=1, max_retries=1, backoff=0.01, retry_interval=0.05)
+        uploads.upload(b'skymap', 'fit/S1.fits.gz')
+        #parked after its first failure, then picked up again without anyone calling retry_failed()
+        deadline = time.time() + 10
+        while uploads.is_pending('fit/S1.fits.gz') and time.time() < deadline:
+            time.sleep(0.01)
+        assert flaky.fs.cat('gwtreasuremap/fit/S1.fits.gz') == b'skymap'
+        assert os.listdir(spool_dir) == []
+    finally:
+        gwstorage._get_fs = get_fs
+        gwstorage._clients.clear()
+
+
+if __name__ == '__main__':
+    test_exists_and_manifest()
+    test_client_is_shared_and_reports_stats()
+    test_upload_queue_retries_and_survives_restart()
+    test_parked_uploads_are_retried()
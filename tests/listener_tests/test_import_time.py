@@ -0,0 +1,48 @@
+import sys
+import os
+import json
+import subprocess
+
+sys.path.insert(0, '../../src/')
+
+#seconds a cold `import gwtm_cron.gwtm_listener` may take
+IMPORT_BUDGET = float(os.environ.get("GWTM_IMPORT_BUDGET", 1.5))
+
+#only imported by the stages (or warmup) that need them
+HEAVY_MODULES = ['ligo.skymap.postprocess', 'mocpy', 'healpy', 'scipy.stats', 'astropy.table', 'ephem', 'shapely', 'bs4']
+
+
+def _run(code):
+    env = dict(os.environ, PYTHONPATH=os.path.abspath('../../src/'))
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_cold_import():
+    #best of three, the first run also pays for a cold disk cache
+    results = [_run(
+        'import sys, json, time\n'
+        't = time.perf_counter()\n'
+        'import gwtm_cron.gwtm_listener\n'
+        'elapsed = time.perf_counter() - t\n'
+        f'print(json.dumps([elapsed, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))\n'
+    ) for _ in range(3)]
+
+    elapsed = min(r[0] for r in results)
+    assert results[-1][1] == [], f"imported at startup: {results[-1][1]}"
+    assert elapsed < IMPORT_BUDGET, f"cold import took {elapsed:.2f}s, budget {IMPORT_BUDGET}s"
+
+
+def test_warmup():
+    loaded = _run(
+        'import sys, json\n'
+        'from gwtm_cron.gwtm_listener import listener\n'
+        'listener.warmup()\n'
+        'print(json.dumps([m for m in ["ligo.skymap.postprocess", "mocpy", "healpy", "ephem", "shapely"] if m in sys.modules]))\n'
+    )
+    assert loaded == ["ligo.skymap.postprocess", "mocpy", "healpy", "ephem", "shapely"]
+
+
+if __name__ == '__main__':
+    test_cold_import()
+    test_warmup()
@@ -0,0 +1,347 @@
+import sys
+import os
+import json
+import tempfile
+import time
+import threading
+
+sys.path.insert(0, '../../src/')
+
+from confluent_kafka import TopicPartition # type: ignore
+
+from gwtm_cron.gwtm_listener import listener as gl # type: ignore
+
+
+class _Message(object):
+    def __init__(self, superevent_id, n, topic='igwn.gwalert'):
+        self._value = json.dumps({'superevent_id': superevent_id, 'n': n}).encode()
+        self._offset = n
+        self._topic = topic
+
+    def value(self):
+        return self._value
+
+    def key(self):
+        return None
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self._offset
+
+
+class _FakeConsumer(object):
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.paused = 0
+        self.resumed = 0
+        self.committed: list = []
+        self._paused: set = set()
+
+    def subscribe(self, topics):
+        self.topics = topics
+
+    def assignment(self):
+        return [TopicPartition(topic, 0) for topic in self.topics]
+
+    def pause(self, partitions):
+        self.paused += 1
+        self._paused.update(tp.topic for tp in partitions)
+
+    def resume(self, partitions):
+        self.resumed += 1
+        self._paused.difference_update(tp.topic for tp in partitions)
+
+    def commit(self, offsets, asynchronous=True):
+        self.committed.extend((tp.partition, tp.offset) for tp in offsets)
+
+    def consume(self, timeout=1):
+        for message in self.messages:
+            if message.topic() not in self._paused:
+                self.messages.remove(message)
+                return [message]
+        time.sleep(min(timeout, 0.01))
+        return []
+
+
+def _listener(consumer):
+    listener = gl.Listener('LIGO_ALERT', config_path=None, consumer=consumer)
+    listener.config.CHECKPOINT_DB = os.path.join(tempfile.mkdtemp(), 'checkpoints.db')
+    return listener
+
+
+def test_pipeline_keeps_superevent_order():
+    messages = [_Message(f'S{i % 5}', i) for i in range(40)]
+    consumer = _FakeConsumer(messages)
+    listener = _listener(consumer)
+    listener.config.PIPELINE_WORKERS = 3
+    listener.config.PIPELINE_QUEUE_SIZE = 1
+
+    processed: list = []
+    running = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+
+    def _listen(alert, write_to_s3, verbose, dry_run, alertname=None, checkpoint=None, superseded=None, listener_type=None):
+        alert = json.loads(alert)
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.01)
+        with lock:
+            running['now'] -= 1
+            processed.append((alert['superevent_id'], alert['n']))
+            if len(processed) == len(messages):
+                listener.stop()
+        return alert, None
+
+    listener._listen = _listen
+    thread = threading.Thread(target=listener.run, kwargs={'write_to_s3': False, 'dry_run': True, 'pipeline': True})
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive()
+
+    assert len(processed) == len(messages)
+    for superevent_id in set(s for s, n in processed):
+        order = [n for s, n in processed if s == superevent_id]
+        assert order == sorted(order)
+    #different superevents ran side by side, and the small queues paused the consumer
+    assert running['max'] > 1
+    assert consumer.paused > 0 and consumer.resumed == consumer.paused
+    #commits only ever move forward, and end after the last message
+    assert [offset for partition, offset in consumer.committed] == sorted(offset for partition, offset in consumer.committed)
+    assert consumer.committed[-1] == (0, len(messages))
+
+
+def test_newer_alerts_supersede_queued_ones():
+    messages = [_Message('S1', 0), _Message('S2', 1), _Message('S1', 2), _Message('S1', 3), _Message('S2', 4)]
+    consumer = _FakeConsumer(messages)
+    listener = _listener(consumer)
+    listener.config.PIPELINE_WORKERS = 1
+    listener.config.PIPELINE_QUEUE_SIZE = 8
+
+    started = threading.Event()
+    outcome: dict = {}
+
+    def _listen(alert, write_to_s3, verbose, dry_run, alertname=None, checkpoint=None, superseded=None, listener_type=None):
+        alert = json.loads(alert)
+        if alert['n'] == 0:
+            #everything else gets read while the first alert runs
+            started.set()
+            time.sleep(0.3)
+        outcome[alert['n']] = superseded()
+        if len(outcome) == len(messages):
+            listener.stop()
+        return alert, None
+
+    listener._listen = _listen
+    listener.run(dry_run=True, pipeline=True)
+    assert started.is_set()
+    assert outcome == {0: True, 1: True, 2: True, 3: False, 4: False}
+
+    tracker = gl.SupersedeTracker()
+    first = tracker.arrived(b'S1')
+    assert not tracker.superseded(b'S1', first)
+    tracker.arrived(b'S1')
+    assert tracker.superseded(b'S1', first)
+    #alerts without a superevent never supersede each other
+    assert not tracker.superseded(b'', tracker.arrived(b''))
+
+
+def test_urgent_alerts_go_first_within_superevent_order():
+    q = gl.KeyedPriorityQueue(maxsize=8)
+    q.put((2, b'S1', 'S1 Preliminary'))
+    q.put((2, b'S2', 'S2 Preliminary'))
+    q.put((0, b'S1', 'S1 Retraction'))
+    q.put((0, b'S3', 'S3 Retraction'))
+    q.put((1, b'S4', 'S4 EarlyWarning'))
+    order = [q.get() for _ in range(5)]
+    #the S1 Retraction waits for the S1 Preliminary before it, S3's goes straight to the front
+    assert order == ['S3 Retraction', 'S4 EarlyWarning', 'S1 Preliminary', 'S2 Preliminary', 'S1 Retraction']
+
+    class _config(object):
+        ALERT_PROFILES = {'Retraction': {'budget': 5.0}}
+    profile = gl.gw_profiles.get_profile('Retraction', _config())
+    assert profile['budget'] == 5.0 and profile['priority'] == 0 and 'prior_alerts' not in profile['stages']
+    assert gl.gw_profiles.get_profile('Error')['stages'] == frozenset(gl.gw_profiles.STAGES)
+    assert gl.alert_priority(_Message('S1', 0)) == gl.gw_profiles.DEFAULT_PROFILE['priority']
+
+
+def test_one_listener_for_every_topic():
+    icecube_topic = gl.LISTENER_TYPES['ICECUBE_NOTICE']['domain']
+    messages = [_Message('S1', n) for n in range(4)] + [_Message('', n, topic=icecube_topic) for n in range(3)]
+    consumer = _FakeConsumer(messages)
+    listener = gl.Listener('ALL', config_path=None, consumer=consumer)
+    listener.config.CHECKPOINT_DB = os.path.join(tempfile.mkdtemp(), 'checkpoints.db')
+    listener.config.PIPELINE_WORKERS = 1
+    listener.config.PIPELINE_QUEUE_SIZE = 1
+    listener.retry_backoff = 0.01
+    assert sorted(consumer.topics) == sorted(t['domain'] for t in gl.LISTENER_TYPES.values())
+
+    ligo_blocked = threading.Event()
+    handled: list = []
+
+    def _listen(alert, write_to_s3, verbose, dry_run, alertname=None, checkpoint=None, superseded=None, listener_type=None):
+        alert = json.loads(alert)
+        if listener_type == 'LIGO_ALERT':
+            #a stuck LIGO handler, and one that fails
+            if alert['n'] == 0:
+                ligo_blocked.wait(10)
+            if alert['n'] == 1:
+                raise RuntimeError('bad alert')
+        handled.append((listener_type, alert['n']))
+        if len([t for t, n in handled if t == 'ICECUBE_NOTICE']) == 3:
+            ligo_blocked.set()
+        if len(handled) == 6:
+            listener.stop()
+        return alert, None
+
+    listener._listen = _listen
+    listener.run(dry_run=True, pipeline=True)
+
+    #every IceCube notice went through while the LIGO worker was stuck
+    assert handled[:3] == [('ICECUBE_NOTICE', 0), ('ICECUBE_NOTICE', 1), ('ICECUBE_NOTICE', 2)]
+    assert [n for t, n in handled if t == 'LIGO_ALERT'] == [0, 2, 3]
+
+
+def test_resume_from_checkpoint():
+    message = _Message('S1', 0)
+    calls: list = []
+    crash = [True]
+
+    def _listen(alert, write_to_s3, verbose, dry_run, alertname=None, checkpoint=None, superseded=None, listener_type=None):
+        checkpoint.run('post_alert', lambda: calls.append('post_alert') or {'id': 1})
+        if len(crash):
+            crash.pop()
+            raise RuntimeError('crashed before the galaxies')
+        checkpoint.run('galaxies', lambda: calls.append('galaxies'))
+        return {}, None
+
+    consumer = _FakeConsumer([message])
+    listener = _listener(consumer)
+    listener._listen = _listen
+    try:
+        listener.run(dry_run=True)
+        assert False, 'the crash should stop the listener'
+    except RuntimeError:
+        pass
+    assert consumer.committed == []
+
+    #the restarted listener gets the message again, and only does what is left
+    consumer = _FakeConsumer([message])
+    restarted = gl.Listener('LIGO_ALERT', config_path=None, consumer=consumer)
+    restarted.config.CHECKPOINT_DB = listener.config.CHECKPOINT_DB
+    restarted._listen = _listen
+    threading.Timer(0.5, restarted.stop).start()
+    restarted.run(dry_run=True)
+    assert calls == ['post_alert', 'galaxies']
+    assert consumer.committed == [(0, 1)]
+
+    #a redelivery after it is done is skipped
+    assert restarted.checkpoints().is_finished(gl.gw_checkpoint.message_id(message))
+
+
+def test_failed_alerts_are_retried_before_commit():
+    messages = [_Message('S1', 0), _Message('S2', 1)]
+    failures = {0: 1, 1: 10}
+    calls: list = []
+
+    def _listen(alert, write_to_s3, verbose, dry_run, alertname=None, checkpoint=None, superseded=None, listener_type=None):
+        n = json.loads(alert)['n']
+        calls.append(n)
+        if failures[n] > 0:
+            failures[n] -= 1
+            raise RuntimeError('post failed')
+        return {}, None
+
+    consumer = _FakeConsumer(messages)
+    listener = _listener(consumer)
+    listener.retry_backoff = 0.01
+    listener._listen = _listen
+    threading.Timer(1.0, listener.stop).start()
+    listener.run(dry_run=True, pipeline=True)
+
+    #the first one succeeds on its second try, the second is given up on after MAX_ALERT_ATTEMPTS
+    assert calls.count(0) == 2
+    assert calls.count(1) == listener.config.MAX_ALERT_ATTEMPTS
+    assert max(offset for _, offset in consumer.committed) == 2
+
+    #stopped while it waits to be tried again, the alert is not committed
+    consumer = _FakeConsumer([_Message('S3', 0)])
+    listener = _listener(consumer)
+    listener.retry_backoff = 60
+    listener._listen = lambda *args, **kwargs: calls.append('S3') or 1/0
+    threading.Timer(0.5, listener.stop).start()
+    listener.run(dry_run=True, pipeline=True)
+    assert 'S3' in calls
+    assert consumer.committed == []
+
+
+def test_stop_with_full_queues():
+    messages = [_Message(f'S{n}', n) for n in range(4)]
+    consumer = _FakeConsumer(messages)
+    listener = _listener(consumer)
+    listener.config.PIPELINE_WORKERS = 1
+    listener.config.PIPELINE_QUEUE_SIZE = 1
+
+    handled: list = []
+
+    def _listen(alert, write_to_s3, verbose, dry_run, alertname=None, checkpoint=None, superseded=None, listener_type=None):
+        n = json.loads(alert)['n']
+        if n == 0:
+            #stopped while the only queue is full
+            listener.stop()
+            time.sleep(0.2)
+        handled.append(n)
+        return {}, None
+
+    listener._listen = _listen
+    thread = threading.Thread(target=listener.run, kwargs={'dry_run': True, 'pipeline': True})
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+
+    #the alert it was on is finished and committed, the queued one comes again after a restart
+    assert handled == [0]
+    assert consumer.committed[-1] == (0, 1)
+
+
+def test_consumer_group_survives_restarts():
+    created = []
+
+    class _RecordingConsumer(_FakeConsumer):
+        def __init__(self, config=None, **kwargs):
+            super().__init__([])
+            created.append(config)
+
+    consumer_class = gl.Consumer
+    gl.Consumer = _RecordingConsumer
+    try:
+        gl.Listener('LIGO_ALERT', config_path=None)
+        listener = gl.Listener('LIGO_ALERT', config_path=None)
+    finally:
+        gl.Consumer = consumer_class
+
+    #the same group every start, reading from its committed offsets
+    assert created[0]['group.id'] == created[1]['group.id'] == listener.group_id()
+    assert created[0]['auto.offset.reset'] == 'earliest'
+    assert created[0]['enable.auto.commit'] is False
+
+
+def test_alert_key():
+    assert gl.alert_key(_Message('S240422ed', 0)) == b'S240422ed'
+
+
+if __name__ == '__main__':
+    test_pipeline_keeps_superevent_order()
+    test_newer_alerts_supersede_queued_ones()
+    test_urgent_alerts_go_first_within_superevent_order()
+    test_one_listener_for_every_topic()
+    test_resume_from_checkpoint()
+    test_failed_alerts_are_retried_before_commit()
+    test_stop_with_full_queues()
+    test_consumer_group_survives_restarts()
+    test_alert_key()